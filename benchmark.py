@@ -0,0 +1,245 @@
+"""
+This script benchmarks every stage of the pipeline over a grid of number of customers and months back.
+
+For each combination, the stages run one after the other in a temporary folder, each one in a new process
+(reading its inputs from the files written by the previous stages), so the wall time, peak memory (RSS)
+and size of the output files are measured for every stage on its own.
+Results are written to a JSON file, which can be compared with a previous run (baseline) to catch regressions.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import multiprocessing
+import customer_registration
+import parallel
+import pipeline
+import storage
+
+
+# Default parameter grid
+DEFAULT_CUSTOMERS = [10000, 100000]
+DEFAULT_MONTHS_BACK = [3, 12]
+
+# Predefined grids: numbers of customers, months back and stages measured (with the stages producing their inputs)
+PRESETS = {
+    # Scaling of the cohort date grid (see get_all_date_pairs in customer_cohort.py) with 1, 3 and 5 years of history,
+    # measured in the README
+    'history': {
+        'customers': [10000],
+        'months_back': [12, 36, 60],
+        'stages': ['customer_cohort'],
+    },
+}
+
+# Default tolerance for the comparison with a baseline (0.25 = 25% slower or bigger is a regression)
+DEFAULT_TOLERANCE = 0.25
+
+# Differences in time below this many seconds are never reported as regressions (timing noise)
+DEFAULT_MIN_SECONDS = 0.5
+
+
+def get_peak_rss_mb():
+    """
+    Function to return the peak memory (resident set size) of the current process in MB
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak_rss / 1024 / 1024 if sys.platform == 'darwin' else peak_rss / 1024
+
+
+def get_output_bytes(outputs):
+    """
+    Function to return the size in bytes of all files written for the given outputs (csv and intermediate files)
+    @param outputs <list>: names of the outputs
+    """
+    return sum(
+        os.path.getsize(path)
+        for name in outputs
+        for path in glob.glob(storage.get_output_path(name + '.*'))
+    )
+
+
+def run_stage_benchmark(folder, stage_name, params):
+    """
+    Function to run a single stage inside a folder and measure it (called in a new process)
+    @param folder <string>: folder where the output folder is created
+    @param stage_name <string>: name of the stage module
+    @param params <dict>: pipeline parameters
+    """
+    os.chdir(folder)
+    stage = pipeline.get_stage_declarations()[stage_name]
+
+    start = time.perf_counter()
+    frames = {name: storage.read_intermediate(name) for name in stage['inputs'] if name not in stage['streamed_inputs']}
+    read_seconds = time.perf_counter() - start
+
+    _, timings, _ = pipeline.run_stage(stage_name, frames, params, [])
+
+    return {
+        'stage': stage_name,
+        'wall_seconds': time.perf_counter() - start,
+        'read_seconds': read_seconds,
+        'run_seconds': timings['run'],
+        'write_seconds': timings['write'],
+        'peak_rss_mb': get_peak_rss_mb(),
+        'output_bytes': get_output_bytes(stage['outputs']),
+    }
+
+
+def get_stages_with_inputs(stage_names):
+    """
+    Function to return the given stages and every stage producing their inputs (recursively), in execution order
+    @param stage_names <list>: names of the stage modules
+    """
+    stages = pipeline.get_stage_declarations()
+    producers = {output: stage_name for stage_name, stage in stages.items() for output in stage['outputs']}
+    needed_stages = set()
+    pending_stages = list(stage_names)
+    while pending_stages:
+        stage_name = pending_stages.pop()
+        if stage_name not in needed_stages:
+            needed_stages.add(stage_name)
+            pending_stages.extend(producers[name] for name in stages[stage_name]['inputs'] if name in producers)
+
+    return [stage_name for stage_name in pipeline.STAGE_MODULES if stage_name in needed_stages]
+
+
+def run_benchmark(customers_grid, months_back_grid, seed=None, stage_names=None):
+    """
+    Function to run the stages for every combination of number of customers and months back
+    Returns a list with the measures of each stage and combination
+    @param customers_grid <list>: numbers of customers to be created
+    @param months_back_grid <list>: numbers of months back when customers create account
+    @param seed <int>: seed for the random generators
+    @param stage_names <list>: stages to be measured, with the stages producing their inputs (None for all stages)
+    """
+    # New processes are spawned (not forked), so the peak memory of each stage doesn't include the parent's
+    mp_context = multiprocessing.get_context('spawn')
+    stages_to_run = pipeline.STAGE_MODULES if stage_names is None else get_stages_with_inputs(stage_names)
+    results = []
+
+    for number_of_customers in customers_grid:
+        for months_back in months_back_grid:
+            params = dict(
+                pipeline.DEFAULT_PARAMS,
+                number_of_customers=number_of_customers,
+                months_back=months_back,
+                seed=seed,
+                now=datetime.now(),
+                watermark=None,
+            )
+            params.update(customer_registration.get_dataset_params(
+                number_of_customers, months_back, seed, parallel.get_seed_entropy(seed), params['now']
+            ))
+            with tempfile.TemporaryDirectory() as folder:
+                for stage_name in stages_to_run:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                        result = executor.submit(run_stage_benchmark, folder, stage_name, params).result()
+                    result = dict(customers=number_of_customers, months_back=months_back, **result)
+                    results.append(result)
+                    print("{:>10} {:>6} {:<30} {:>9.2f}s {:>9.1f}MB {:>10.1f}MB".format(
+                        number_of_customers, months_back, stage_name,
+                        result['wall_seconds'], result['peak_rss_mb'], result['output_bytes'] / 1024 / 1024
+                    ))
+
+    return results
+
+
+def get_regressions(results, baseline_results, tolerance=DEFAULT_TOLERANCE, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Function to compare results with a baseline, returning the measures that got worse than the tolerance
+    Only stages and combinations present on both runs are compared
+    @param results <list>: measures of the current run
+    @param baseline_results <list>: measures of the baseline run
+    @param tolerance <float>: allowed relative increase (0.25 = 25%)
+    @param min_seconds <float>: time increases below this many seconds are ignored
+    """
+    baseline = {(result['customers'], result['months_back'], result['stage']): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        key = (result['customers'], result['months_back'], result['stage'])
+        if key not in baseline:
+            continue
+        for measure in ['wall_seconds', 'peak_rss_mb', 'output_bytes']:
+            baseline_value = baseline[key][measure]
+            value = result[measure]
+            if value <= baseline_value * (1 + tolerance):
+                continue
+            if measure == 'wall_seconds' and value - baseline_value < min_seconds:
+                continue
+            regressions.append(dict(zip(['customers', 'months_back', 'stage'], key), measure=measure, baseline=baseline_value, value=value))
+
+    return regressions
+
+
+def print_regressions(regressions):
+    """
+    Function to print the regressions found on the comparison with a baseline
+    @param regressions <list>: regressions returned by get_regressions
+    """
+    if not regressions:
+        print("No regressions found")
+        return
+
+    print("{:>10} {:>6} {:<30} {:<15} {:>12} {:>12}".format("customers", "months", "stage", "measure", "baseline", "current"))
+    for regression in regressions:
+        print("{:>10} {:>6} {:<30} {:<15} {:>12.2f} {:>12.2f}".format(
+            regression['customers'], regression['months_back'], regression['stage'],
+            regression['measure'], regression['baseline'], regression['value']
+        ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline over a grid of customers and months back")
+    parser.add_argument("--preset", choices=sorted(PRESETS),
+                        help="predefined grid (history: cohort scaling with 12, 36 and 60 months back), other arguments override it")
+    parser.add_argument("--customers", type=int, nargs="+", help="numbers of customers to create")
+    parser.add_argument("--months-back", type=int, nargs="+", help="numbers of months back when customers create account")
+    parser.add_argument("--stages", nargs="+", choices=pipeline.STAGE_MODULES,
+                        help="stages to measure, the stages producing their inputs also run (default: all)")
+    parser.add_argument("--seed", type=int, default=42, help="seed for the random generators")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file where the results are written")
+    parser.add_argument("--compare", help="JSON file of a previous run (baseline) to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative increase of time, memory and output size over the baseline")
+    parser.add_argument("--min-seconds", type=float, default=DEFAULT_MIN_SECONDS,
+                        help="time increases below this many seconds are not reported as regressions")
+    args = parser.parse_args()
+
+    preset = PRESETS.get(args.preset, {})
+    customers_grid = args.customers or preset.get('customers', DEFAULT_CUSTOMERS)
+    months_back_grid = args.months_back or preset.get('months_back', DEFAULT_MONTHS_BACK)
+    stage_names = args.stages or preset.get('stages')
+
+    print("{:>10} {:>6} {:<30} {:>10} {:>11} {:>12}".format("customers", "months", "stage", "wall", "peak rss", "output"))
+    results = run_benchmark(customers_grid, months_back_grid, args.seed, stage_names)
+
+    benchmark = {
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(args.output, 'w') as benchmark_file:
+        json.dump(benchmark, benchmark_file, indent=2)
+    print("Results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline_results = json.load(baseline_file)['results']
+        regressions = get_regressions(results, baseline_results, args.tolerance, args.min_seconds)
+        print_regressions(regressions)
+        if regressions:
+            sys.exit(1)
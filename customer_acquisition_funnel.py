@@ -1,22 +1,31 @@
 import pandas as pd
-from customer_cohort import get_analyzed_date
+import numpy as np
+import storage
+import instrumentation
+from customer_funnel import (
+    FUNNEL_STAGES, get_customer_funnel_dataframe, get_funnel_day_numbers, get_day_categorical, get_status_categorical
+)
 
-def get_df_status_date_client(df, status_datetime_columnname, status_name):
+def get_df_status_date_client(df, stage, stage_days, stage_exists, first_day, num_of_days):
     """
     Function to return a dataframe containing only client, status and date of status update
-    @param df <pandas DataFrame>: dataframe from the customer_datasource.csv file
-    @param status_datetime_columnname <string>: name of the column containing the date of the status
-    @param status_name <string>: name of the status to be returned
+    Dates and statuses are categorical columns sharing the same categories for every status,
+    so the statuses can be unioned without converting them to strings
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py)
+    @param stage <int>: index of the status on FUNNEL_STAGES
+    @param stage_days <numpy array>: day numbers of every client and status (see get_funnel_day_numbers)
+    @param stage_exists <numpy array>: flags of the statuses reached by every client (see get_funnel_day_numbers)
+    @param first_day <int>: first day number of the date categories
+    @param num_of_days <int>: number of days of the date categories
     """
+    # keep only the clients that reached the status
+    exists = stage_exists[:, stage]
 
-    # create a new dataframe containing only relevant columns and rows
-    df_status = df[df[status_datetime_columnname].notnull()][["id", status_datetime_columnname]]
-
-    # assign a new column named status, rename the datetime field to a common name (date) and convert to date
-    df_status['status'] = status_name
-    df_status.rename(columns={status_datetime_columnname: "date"}, inplace=True)
-    df_status['date'] = pd.to_datetime(df_status.date)
-    df_status['date'] = df_status['date'].dt.strftime('%Y-%m-%d')
+    df_status = pd.DataFrame({
+        'id': df['id'].to_numpy()[exists],
+        'date': get_day_categorical(stage_days[exists, stage] - first_day, first_day, num_of_days),
+        'status': get_status_categorical(np.full(exists.sum(), stage)),
+    }, index=df.index[exists])
 
     return df_status
 
@@ -25,24 +34,22 @@ def get_final_acquisition_dataframe(df):
     """
     Function to return a dataframe containing all status from all clients with respective dates
     This way Tableau handles better the data to display the acquisition funnel analysis.
-    @param df <pandas DataFrame>: dataframe from the customer_datasource.csv file
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py)
     """
-    # Get clients, status and dates for each status
-    df_acct_reg  = get_df_status_date_client(df, "account_registration_dt", "Account registered")
-    df_eml_conf  = get_df_status_date_client(df, "account_email_confirmation_dt", "Email confirmed")
-    df_cli_reg   = get_df_status_date_client(df, "client_registration_dt", "Client registered")
-    df_cli_anlz  = get_df_status_date_client(df, "client_analysis_dt", "Client analyzed (approved or denied)")
-    df_cli_actv  = get_df_status_date_client(df, "client_initial_deposit_dt", "Initial deposit")
-
-    # Union all datasets and return the dataframe
-    objs=[
-        df_acct_reg,
-        df_eml_conf,
-        df_cli_reg,
-        df_cli_anlz,
-        df_cli_actv
-    ]
-    df_client_status = pd.concat(objs=objs)
+    # Day numbers of every status, the date categories go from the first to the last day on the dataset
+    stage_days, stage_exists = get_funnel_day_numbers(df)
+    first_day = int(stage_days[stage_exists].min()) if stage_exists.any() else 0
+    num_of_days = int(stage_days[stage_exists].max()) - first_day + 1 if stage_exists.any() else 0
+
+    # Get clients, status and dates for each status and union all datasets
+    objs = []
+    for stage, (columnname_date, status) in enumerate(FUNNEL_STAGES):
+        with instrumentation.span('status ' + columnname_date) as record:
+            objs.append(get_df_status_date_client(df, stage, stage_days, stage_exists, first_day, num_of_days))
+            record['rows'] = len(objs[-1])
+    with instrumentation.span('concat') as record:
+        df_client_status = pd.concat(objs=objs)
+        record['rows'] = len(df_client_status)
 
     return df_client_status
 
@@ -53,19 +60,41 @@ def create_customer_acquisition_funnel_file():
     """
     print("Creating new customer_datasource_acquisition_funnel.csv...")
 
-    # reads information from the datasource file
-    df = pd.read_csv('output/customer_datasource.csv')
-
-    # create new column to store analyzed datetime
-    df["client_analysis_dt"] = df.apply(
-        lambda row: get_analyzed_date(row.client_approval_dt, row.client_denial_dt),
-        axis=1
-    )
+    # reads information from the datasource file and parse the funnel stages
+    df = get_customer_funnel_dataframe(storage.read_intermediate('customer_datasource'))
 
     # get final dataframe to be imported to csv
     df_client_status = get_final_acquisition_dataframe(df)
 
     # Output result to a csv file
-    df_client_status.to_csv('output/customer_datasource_acquisition_funnel.csv')
+    storage.write_output(df_client_status, 'customer_datasource_acquisition_funnel')
+
+    print("New file customer_datasource_acquisition_funnel.csv done!")
+
+
+# Pipeline stage declaration (see pipeline.py)
+# In incremental runs, appended outputs only contain the new rows
+STAGE_INPUTS = ['customer_funnel']
+STAGE_OUTPUTS = ['customer_datasource_acquisition_funnel']
+STAGE_APPENDED_OUTPUTS = ['customer_datasource_acquisition_funnel']
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    df = frames['customer_funnel']
+
+    # Only the statuses reached since the last run (by the customers rebuilt by the funnel stage, the only ones
+    # that can reach new statuses), older statuses are set as not reached
+    watermark = params['watermark']
+    if watermark is not None:
+        df = df.copy()
+        for columnname_date, status in FUNNEL_STAGES:
+            df[columnname_date] = df[columnname_date].where(df[columnname_date] >= watermark['last_datetime'])
 
-    print("New file customer_datasource_acquisition_funnel.csv done!")
\ No newline at end of file
+    return {
+        'customer_datasource_acquisition_funnel': get_final_acquisition_dataframe(df),
+    }
@@ -1,64 +1,298 @@
 import pandas as pd
 import numpy as np
 from datetime import datetime
+import storage
+import instrumentation
+import duckdb_backend
 
 
-def create_customer_activity_file():
+def get_month_numbers(dates):
     """
-    Function to create customer_activity.csv file based on transactions file
+    Function to return dates as integer month numbers (months since 1970-01), so months can be compared and offset as integers
+    @param dates <pandas Series>: dates or datetimes
     """
-    print("Creating new customer_activity.csv...")
-    
-    # read from transaction files
-    df_transactions = pd.read_csv('output/customer_transactions.csv')
+    return pd.to_datetime(dates).to_numpy(dtype='datetime64[M]').astype(np.int64)
+
 
-    # create new column for month
-    df_transactions["transaction_month"] = pd.to_datetime(df_transactions.transaction_datetime)
-    df_transactions['transaction_month'] = df_transactions['transaction_month'].dt.strftime('%Y-%m-01')
+def get_month_categorical(month_numbers, month_range=None):
+    """
+    Function to return integer month numbers as a categorical column of '%Y-%m-01' strings,
+    formatting each distinct month only once (rows only keep a small integer code until the file is exported)
+    @param month_numbers <numpy array>: months since 1970-01
+    @param month_range <tuple>: first and last month of the categories (defaults to the months given), so
+        chunks of the same file can share the same categories
+    """
+    if month_range is not None:
+        first_month, last_month = month_range
+    else:
+        first_month = month_numbers.min() if len(month_numbers) else 0
+        last_month = month_numbers.max() if len(month_numbers) else -1
+    months = pd.Series(np.arange(first_month, last_month + 1).astype('datetime64[M]')).dt.strftime('%Y-%m-01').to_numpy(dtype=object)
 
-    # consolidate transactions by month
-    df_transactions_by_month = df_transactions.groupby(["id", "transaction_month"]).size().reset_index()
+    return pd.Categorical.from_codes(month_numbers - first_month, categories=months)
 
-    # rename count column from 0 to num_of_transactions
-    df_transactions_by_month.rename(columns={0:"num_of_transactions"}, inplace=True)
 
-    # gets all months available on the dataset
-    min_month = df_transactions_by_month["transaction_month"].min()
-    max_month = datetime.today()
-    df_months = pd.DataFrame(data=pd.date_range(min_month, max_month, freq='MS').strftime("%Y-%m-01").tolist(), columns=["month"])
-    df_months['index'] = 1
+def get_customer_activity_dataframe(df_transactions, min_month=None, sparse=False, backend='numpy', memory_limit=None, now=None,
+                                    previous_ids=None):
+    """
+    Function to return the number of transactions and new active / churn flags for every client and month
+    Months are handled as integers: the number of transactions by client and month is taken from the sorted
+    (client, month) pairs, and the rows of each client, from its first month until the current month, are
+    laid out with offsets, so no client x month cross join is needed
+    @param df_transactions <pandas DataFrame>: dataframe from the customer_transactions.csv file
+    @param min_month <string>: if set, only returns months on or after this month ('%Y-%m-01')
+    @param sparse <bool>: if True, only returns the months with transactions or churn
+    @param backend <string>: numpy or duckdb (runs the query as SQL, see duckdb_backend.py)
+    @param memory_limit <string>: with the duckdb backend, maximum memory used by DuckDB (e.g. '4GB')
+    @param now <datetime>: clients have rows until the month of this datetime (defaults to current datetime)
+    @param previous_ids <numpy array>: with min_month, clients with transactions before the transactions given
+        (they have rows from min_month on, even without transactions since the month before it)
+    """
+    if now is None:
+        now = datetime.now()
+    if backend == 'duckdb':
+        with instrumentation.span('duckdb activity') as record:
+            df_churn = get_customer_activity_dataframe_duckdb(df_transactions, min_month, sparse, memory_limit, now, previous_ids)
+            record['rows'] = len(df_churn)
+        return df_churn
 
-    # gets minimum transaction date for each id
-    df_client_mindt = df_transactions_by_month.groupby(["id"])[["transaction_month"]].min().reset_index()
-    df_client_mindt['index'] = 1
+    # Sort transactions by client and month
+    with instrumentation.span('parse and sort months') as record:
+        client_ids = df_transactions["id"].to_numpy()
+        transaction_months = get_month_numbers(df_transactions["transaction_datetime"])
+        order = np.lexsort((transaction_months, client_ids))
+        client_ids = client_ids[order]
+        transaction_months = transaction_months[order]
+        record['rows'] = len(order)
 
-    # gets all combinations for future dates for each id
+    # consolidate transactions by month: start of each (id, month) run in the sorted arrays
     #
     # Similar to:
-    # SELECT *
-    # FROM df_client_mindt a,
-    #      df_months b
-    # WHERE b.months >= a.transaction_month
-    df_client_months = pd.merge(df_client_mindt, df_months, how="outer", on=["index"])
-    df_client_months = df_client_months[df_client_months["month"] >= df_client_months["transaction_month"]]
-    df_client_months.drop(columns=["transaction_month", "index"], inplace=True)
-    df_client_months.rename(columns={"month": "transaction_month"}, inplace=True)
-
-    # join dataframes with all possibilities x transactions
-    df_churn = pd.merge(df_client_months, df_transactions_by_month, how="left", on=["id", "transaction_month"])
-    df_churn["num_of_transactions_prev"] = (df_churn.sort_values(by=["transaction_month"], ascending=True)).groupby(["id"])["num_of_transactions"].shift(1)
-
-    # replace nulls and convert to integer
-    df_churn["num_of_transactions"] = df_churn["num_of_transactions"].fillna(0)
-    df_churn["num_of_transactions"] = df_churn["num_of_transactions"].astype('Int64')
-    df_churn["num_of_transactions_prev"] = df_churn["num_of_transactions_prev"].fillna(0)
-    df_churn["num_of_transactions_prev"] = df_churn["num_of_transactions_prev"].astype('Int64')
+    # SELECT id, transaction_month, COUNT(*) AS num_of_transactions
+    # FROM df_transactions
+    # GROUP BY id, transaction_month
+    run_starts = np.flatnonzero(np.concatenate([[True], (client_ids[1:] != client_ids[:-1]) | (transaction_months[1:] != transaction_months[:-1])])) if len(client_ids) else np.array([], dtype=np.int64)
+    active_ids = client_ids[run_starts]
+    active_months = transaction_months[run_starts]
+    active_counts = np.diff(np.append(run_starts, len(client_ids)))
+
+    # gets minimum transaction month for each id (first run of each client)
+    client_starts = np.flatnonzero(np.concatenate([[True], active_ids[1:] != active_ids[:-1]])) if len(active_ids) else np.array([], dtype=np.int64)
+    ids = active_ids[client_starts]
+    first_months = active_months[client_starts]
+
+    # when only recent months are needed, starts every client on the month before the first one returned,
+    # which is enough to get the previous month number of transactions
+    if min_month is not None:
+        prev_month = get_month_numbers(pd.Series([min_month]))[0] - 1
+        first_months = np.maximum(first_months, prev_month)
+
+        # clients that started before the transactions given start on the month before the first one returned too
+        if previous_ids is not None:
+            all_ids = np.union1d(ids, previous_ids)
+            all_first_months = np.zeros(len(all_ids), dtype=first_months.dtype)
+            all_first_months[np.searchsorted(all_ids, ids)] = first_months
+            all_first_months[np.searchsorted(all_ids, previous_ids)] = prev_month
+            ids, first_months = all_ids, all_first_months
+
+    # every client has one row per month from its first month until the current month
+    max_month = get_month_numbers(pd.Series([now]))[0]
+    num_of_months = np.maximum(max_month - first_months + 1, 0)
+    row_offsets = np.concatenate([[0], np.cumsum(num_of_months)])
+    row_ids = np.repeat(ids, num_of_months)
+    row_months = np.repeat(first_months - row_offsets[:-1], num_of_months) + np.arange(row_offsets[-1])
+
+    # place the number of transactions of each active month on the row of its client and month
+    active_clients = np.searchsorted(ids, active_ids)
+    month_offsets = active_months - first_months[active_clients]
+    in_grid = (month_offsets >= 0) & (month_offsets < num_of_months[active_clients])
+    num_of_transactions = np.zeros(len(row_ids), dtype=np.int32)
+    num_of_transactions[row_offsets[active_clients[in_grid]] + month_offsets[in_grid]] = active_counts[in_grid]
+
+    # previous month number of transactions, 0 on the first month of each client
+    #
+    # Similar to:
+    # LAG(num_of_transactions, 1, 0) OVER (PARTITION BY id ORDER BY transaction_month)
+    num_of_transactions_prev = np.zeros_like(num_of_transactions)
+    num_of_transactions_prev[1:] = num_of_transactions[:-1]
+    num_of_transactions_prev[row_offsets[:-1][num_of_months > 0]] = 0
 
     # flags for new_active / churn
-    df_churn["flag_new_active"] = np.where((df_churn["num_of_transactions"] > 0) & (df_churn["num_of_transactions_prev"] == 0), 1, 0)
-    df_churn["flag_churn"] = np.where((df_churn["num_of_transactions"] == 0) & (df_churn["num_of_transactions_prev"] > 0), 1, 0)
+    flag_new_active = ((num_of_transactions > 0) & (num_of_transactions_prev == 0)).astype(np.int8)
+    flag_churn = ((num_of_transactions == 0) & (num_of_transactions_prev > 0)).astype(np.int8)
+
+    rows = np.ones(len(row_ids), dtype=bool)
+    if min_month is not None:
+        rows &= row_months > prev_month
+    if sparse:
+        rows &= (num_of_transactions > 0) | (flag_churn == 1)
+
+    with instrumentation.span('dataframe') as record:
+        df_churn = pd.DataFrame({
+            "id": row_ids[rows],
+            "transaction_month": get_month_categorical(row_months[rows]),
+            "num_of_transactions": num_of_transactions[rows],
+            "num_of_transactions_prev": num_of_transactions_prev[rows],
+            "flag_new_active": flag_new_active[rows],
+            "flag_churn": flag_churn[rows],
+        })
+        record['rows'] = len(df_churn)
+
+    return df_churn
+
+
+def get_customer_activity_dataframe_duckdb(df_transactions, min_month=None, sparse=False, memory_limit=None, now=None, previous_ids=None):
+    """
+    Function to return the number of transactions and new active / churn flags for every client and month,
+    running the query as SQL on DuckDB (see duckdb_backend.py)
+    Rows and dtypes are the same as get_customer_activity_dataframe
+    (parameters are the same as get_customer_activity_dataframe)
+    @param memory_limit <string>: maximum memory used by DuckDB (e.g. '4GB'), the rest is spilled to disk
+    """
+    if now is None:
+        now = datetime.now()
+    parameters = {
+        'prev_month': -2 ** 31 if min_month is None else int(get_month_numbers(pd.Series([min_month]))[0]) - 1,
+        'max_month': int(get_month_numbers(pd.Series([now]))[0]),
+    }
+
+    sql = """
+    WITH monthly AS (
+        SELECT id, (YEAR(transaction_datetime) - 1970) * 12 + MONTH(transaction_datetime) - 1 AS transaction_month,
+               COUNT(*) AS num_of_transactions
+        FROM (SELECT id, CAST(transaction_datetime AS TIMESTAMP) AS transaction_datetime FROM transactions) t
+        GROUP BY 1, 2
+    ),
+    first_months AS (
+        SELECT id, GREATEST(MIN(transaction_month), $prev_month) AS first_month
+        FROM (
+            SELECT id, transaction_month FROM monthly
+            UNION ALL
+            SELECT id, $prev_month AS transaction_month FROM previous
+        ) m
+        GROUP BY id
+    ),
+    activity AS (
+        SELECT g.id, g.transaction_month, COALESCE(m.num_of_transactions, 0) AS num_of_transactions
+        FROM (
+            SELECT id, UNNEST(RANGE(first_month, $max_month + 1)) AS transaction_month
+            FROM first_months
+        ) g
+        LEFT JOIN monthly m ON m.id = g.id AND m.transaction_month = g.transaction_month
+    ),
+    activity_prev AS (
+        SELECT *, LAG(num_of_transactions, 1, 0) OVER (PARTITION BY id ORDER BY transaction_month) AS num_of_transactions_prev
+        FROM activity
+    ),
+    flags AS (
+        SELECT *,
+               CASE WHEN num_of_transactions > 0 AND num_of_transactions_prev = 0 THEN 1 ELSE 0 END AS flag_new_active,
+               CASE WHEN num_of_transactions = 0 AND num_of_transactions_prev > 0 THEN 1 ELSE 0 END AS flag_churn
+        FROM activity_prev
+    )
+    SELECT *
+    FROM flags
+    WHERE transaction_month > $prev_month {sparse_filter}
+    """.format(sparse_filter="AND (num_of_transactions > 0 OR flag_churn = 1)" if sparse else "")
+
+    columns = duckdb_backend.run_query(
+        sql,
+        {
+            'transactions': df_transactions[["id", "transaction_datetime"]],
+            'previous': pd.DataFrame({"id": np.array([] if previous_ids is None else previous_ids, dtype=df_transactions["id"].dtype)}),
+        },
+        "id, transaction_month",
+        {
+            'id': df_transactions["id"].dtype,
+            'transaction_month': np.int64,
+            'num_of_transactions': np.int32,
+            'num_of_transactions_prev': np.int32,
+            'flag_new_active': np.int8,
+            'flag_churn': np.int8,
+        },
+        parameters,
+        memory_limit
+    )
+
+    df_churn = pd.DataFrame({
+        "id": columns['id'],
+        "transaction_month": get_month_categorical(columns['transaction_month']),
+        "num_of_transactions": columns['num_of_transactions'],
+        "num_of_transactions_prev": columns['num_of_transactions_prev'],
+        "flag_new_active": columns['flag_new_active'],
+        "flag_churn": columns['flag_churn'],
+    })
+
+    return df_churn
+
+
+def create_customer_activity_file(sparse=False, now=None):
+    """
+    Function to create customer_activity.csv file based on transactions file
+    @param sparse <bool>: if True, only outputs the months with transactions or churn
+    @param now <datetime>: clients have rows until the month of this datetime (defaults to current datetime)
+    """
+    print("Creating new customer_activity.csv...")
+    
+    # read from transaction files
+    df_transactions = storage.read_intermediate('customer_transactions', columns=['id', 'transaction_datetime'])
+
+    # get number of transactions and flags by client and month
+    df_churn = get_customer_activity_dataframe(df_transactions, sparse=sparse, now=now)
 
     # Output result to a csv file
-    df_churn.to_csv('output/customer_activity.csv')
+    storage.write_output(df_churn, 'customer_activity')
 
     print("New file customer_activity.csv done!")
+
+
+# Pipeline stage declaration (see pipeline.py)
+# Partitioned outputs are written by month of a column, in incremental runs their rows replace the partitions from their first month on
+STAGE_INPUTS = ['customer_transactions']
+STAGE_OUTPUTS = ['customer_activity']
+STAGE_PARTITIONED_OUTPUTS = {'customer_activity': 'transaction_month'}
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    In incremental runs, months before the watermark month can't change: only the transactions from the month before
+    it on are read and only the months from the watermark month on are returned (replacing their partitions)
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    watermark = params['watermark']
+    if watermark is not None:
+        # Similar to:
+        # DELETE FROM df_previous_churn WHERE transaction_month >= watermark_month;
+        # INSERT INTO df_previous_churn SELECT * FROM df_new_churn WHERE transaction_month >= watermark_month;
+        watermark_month = storage.get_month_start(watermark['last_datetime'])
+        prev_month = watermark_month - pd.DateOffset(months=1)
+        with instrumentation.span('read recent transactions') as record:
+            df_transactions = storage.read_intermediate(
+                'customer_transactions', columns=['id', 'transaction_datetime'], since=('transaction_datetime', prev_month)
+            )
+            record['rows'] = len(df_transactions)
+
+        # Without sparse rows, clients without recent transactions still have a row on every month: they are the
+        # clients on the previous month rows
+        previous_ids = None
+        if not params['activity_sparse']:
+            with instrumentation.span('read previous clients') as record:
+                prev_partition = storage.get_partition(prev_month)
+                previous_ids = storage.read_intermediate('customer_activity', ['id'], min_partition=prev_partition, max_partition=prev_partition)['id'].to_numpy()
+                record['rows'] = len(previous_ids)
+
+        df_churn = get_customer_activity_dataframe(
+            df_transactions, watermark_month.strftime('%Y-%m-01'), params['activity_sparse'], params['backend'], params['duckdb_memory_limit'],
+            params['now'], previous_ids
+        )
+    else:
+        df_churn = get_customer_activity_dataframe(
+            frames['customer_transactions'], sparse=params['activity_sparse'], backend=params['backend'], memory_limit=params['duckdb_memory_limit'],
+            now=params['now']
+        )
+
+    return {
+        'customer_activity': df_churn,
+    }
@@ -0,0 +1,290 @@
+"""
+This script builds the balance and revenue aggregates of every client from the transactions file.
+
+Transactions are read from the intermediate file in chunks and split in partitions of client ids, each
+partition being sorted once by client and datetime. A partition is only processed once none of the
+following chunks has transactions of its clients (transactions are written by chunks of clients, so this
+happens right after its last chunk is read), so memory doesn't grow with the number of transactions.
+Parts appended by incremental runs only have transactions of the recent clients (see customer_transactions.py),
+so only their partitions wait until the end of the file.
+Running balances and lifetime values are cumulative sums (in integer cents) restarted at the first transaction
+of each client, and the monthly and per-client aggregates are read at the boundaries of the sorted runs,
+so there are no per-client loops and only one partition is being worked on at a time.
+"""
+
+import pandas as pd
+import numpy as np
+import storage
+import export
+import instrumentation
+from customer_activity import get_month_numbers, get_month_categorical
+
+
+# Operation of the transactions adding to the balance (every other operation is subtracted) and counted as revenue
+INCOME_OPERATION = "Income"
+
+# Default number of client ids on each partition
+DEFAULT_CHUNK_SIZE = 100000
+
+# Number of transactions read from the intermediate file at a time
+READ_CHUNK_SIZE = 100000
+
+# Columns of the transactions file used by the balances
+TRANSACTION_COLUMNS = ['id', 'transaction_datetime', 'amount', 'operation']
+
+
+def get_restarted_cumsum(values, client_starts, client_sizes):
+    """
+    Function to return the cumulative sum of values sorted by client, restarting at the first value of each client
+    @param values <numpy array>: values sorted by client
+    @param client_starts <numpy array>: position of the first value of each client
+    @param client_sizes <numpy array>: number of values of each client
+    """
+    # Similar to:
+    # SUM(value) OVER (PARTITION BY id ORDER BY transaction_datetime ROWS UNBOUNDED PRECEDING)
+    cumsum = np.cumsum(values)
+    cumsum -= np.repeat(cumsum[client_starts] - values[client_starts], client_sizes)
+
+    return cumsum
+
+
+def get_month_range(df_transactions):
+    """
+    Function to return the first and last month (months since 1970-01) of the transactions
+    @param df_transactions <pandas DataFrame>: dataframe from the customer_transactions.csv file
+    """
+    if len(df_transactions) == 0:
+        return 0, -1
+
+    return tuple(get_month_numbers(pd.Series([df_transactions["transaction_datetime"].min(), df_transactions["transaction_datetime"].max()])))
+
+
+def get_balance_dataframes(df_transactions, now, month_range=None):
+    """
+    Function to return the balance of every client (first and last transaction, number of transactions, balance,
+    lifetime value and days since the last transaction) and of every client and month with transactions
+    (number of transactions, revenue, net amount, and balance and lifetime value at the end of the month)
+    Amounts are summed as integer cents, so balances don't drift with the number of transactions
+    @param df_transactions <pandas DataFrame>: transactions of a set of clients (all transactions of each client)
+    @param now <datetime>: date the days since the last transaction are counted until
+    @param month_range <tuple>: first and last month of the transaction_month categories (see customer_activity.get_month_categorical)
+    """
+    # Sort transactions by client and datetime
+    client_ids = df_transactions["id"].to_numpy()
+    transaction_seconds = df_transactions["transaction_datetime"].to_numpy(dtype='datetime64[s]').astype(np.int64)
+    order = np.lexsort((transaction_seconds, client_ids))
+    client_ids = client_ids[order]
+    transaction_seconds = transaction_seconds[order]
+    amount_cents = np.rint(df_transactions["amount"].to_numpy(dtype=np.float64)[order] * 100).astype(np.int64)
+    income = (df_transactions["operation"] == INCOME_OPERATION).to_numpy()[order]
+
+    # Similar to:
+    # SELECT *, CASE WHEN operation = 'Income' THEN amount ELSE -amount END AS signed_amount,
+    #        CASE WHEN operation = 'Income' THEN amount ELSE 0 END AS revenue
+    # FROM df_transactions
+    signed_cents = np.where(income, amount_cents, -amount_cents)
+    revenue_cents = np.where(income, amount_cents, 0)
+
+    # start of each client and of each (client, month) run in the sorted arrays
+    transaction_months = transaction_seconds.astype('datetime64[s]').astype('datetime64[M]').astype(np.int64)
+    new_client = np.ones(len(client_ids), dtype=bool)
+    new_client[1:] = client_ids[1:] != client_ids[:-1]
+    new_run = new_client.copy()
+    new_run[1:] |= transaction_months[1:] != transaction_months[:-1]
+    client_starts = np.flatnonzero(new_client)
+    client_ends = np.append(client_starts[1:], len(client_ids))[:len(client_starts)] - 1
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.append(run_starts[1:], len(client_ids))[:len(run_starts)] - 1
+
+    balance_cents = get_restarted_cumsum(signed_cents, client_starts, client_ends - client_starts + 1)
+    lifetime_value_cents = get_restarted_cumsum(revenue_cents, client_starts, client_ends - client_starts + 1)
+
+    # Similar to:
+    # SELECT id, transaction_month, COUNT(*) AS num_of_transactions, SUM(revenue) AS revenue,
+    #        SUM(signed_amount) AS net_amount, LAST(balance) AS balance, LAST(lifetime_value) AS lifetime_value
+    # FROM df_transactions
+    # GROUP BY id, transaction_month
+    df_monthly = pd.DataFrame({
+        "id": client_ids[run_starts],
+        "transaction_month": get_month_categorical(transaction_months[run_starts], month_range),
+        "num_of_transactions": (run_ends - run_starts + 1).astype(np.int32),
+        "revenue": np.add.reduceat(revenue_cents, run_starts) / 100,
+        "net_amount": np.add.reduceat(signed_cents, run_starts) / 100,
+        "balance": balance_cents[run_ends] / 100,
+        "lifetime_value": lifetime_value_cents[run_ends] / 100,
+    })
+
+    # Similar to:
+    # SELECT id, MIN(transaction_datetime) AS first_transaction_datetime, MAX(transaction_datetime) AS last_transaction_datetime,
+    #        COUNT(*) AS num_of_transactions, SUM(signed_amount) AS balance, SUM(revenue) AS lifetime_value,
+    #        DATEDIFF(day, MAX(transaction_datetime), now) AS days_since_last_transaction
+    # FROM df_transactions
+    # GROUP BY id
+    today = np.datetime64(pd.Timestamp(now).date(), 'D')
+    last_seconds = transaction_seconds[client_ends]
+    df_balance = pd.DataFrame({
+        "id": client_ids[client_starts],
+        "first_transaction_datetime": transaction_seconds[client_starts].astype('datetime64[s]'),
+        "last_transaction_datetime": last_seconds.astype('datetime64[s]'),
+        "num_of_transactions": (client_ends - client_starts + 1).astype(np.int32),
+        "balance": balance_cents[client_ends] / 100,
+        "lifetime_value": lifetime_value_cents[client_ends] / 100,
+        "days_since_last_transaction": (today - last_seconds.astype('datetime64[s]').astype('datetime64[D]')).astype(np.int32),
+    })
+
+    return df_balance, df_monthly
+
+
+def iter_id_partitions(df_transactions, chunk_size):
+    """
+    Generator of the transactions of consecutive ranges of client ids (every transaction of a client is on the same partition)
+    An empty dataframe is returned as a single (empty) partition
+    @param df_transactions <pandas DataFrame>: dataframe from the customer_transactions.csv file
+    @param chunk_size <int>: number of client ids on each partition
+    """
+    client_ids = df_transactions["id"].to_numpy()
+    if len(client_ids) == 0:
+        yield df_transactions
+        return
+    partitions = (client_ids - client_ids.min()) // chunk_size
+
+    # Transactions are written by chunks of clients, so partitions are nearly sorted already
+    order = np.argsort(partitions, kind='stable')
+    partition_starts = np.flatnonzero(np.concatenate([[True], np.diff(partitions[order]) != 0]))
+    for start, end in zip(partition_starts, np.append(partition_starts[1:], len(order))):
+        yield df_transactions.iloc[order[start:end]]
+
+
+def get_transactions_ranges(read_chunk_size=READ_CHUNK_SIZE):
+    """
+    Function to read the ids and datetimes of the transactions file in chunks, returning the first and last
+    month of the transactions and the minimum client id of each chunk (see iter_transaction_partitions)
+    @param read_chunk_size <int>: number of transactions read at a time
+    """
+    month_ranges = []
+    min_ids = []
+    for df_chunk in storage.iter_intermediate_chunks('customer_transactions', ['id', 'transaction_datetime'], read_chunk_size):
+        if len(df_chunk):
+            month_ranges.append(get_month_range(df_chunk))
+        min_ids.append(df_chunk["id"].min() if len(df_chunk) else np.iinfo(np.int64).max)
+
+    if not month_ranges:
+        return (0, -1), np.array(min_ids, dtype=np.int64)
+
+    return (min(first for first, last in month_ranges), max(last for first, last in month_ranges)), np.array(min_ids, dtype=np.int64)
+
+
+def iter_transaction_partitions(min_ids, chunk_size=DEFAULT_CHUNK_SIZE, read_chunk_size=READ_CHUNK_SIZE):
+    """
+    Generator of the transactions of ranges of client ids, read from the transactions file in chunks
+    Transactions are kept until no later chunk can have transactions of their clients (the client id is
+    lower than the minimum id of every later chunk), so only the partitions being completed are in memory
+    when transactions are written by chunks of clients (if not, the partitions just take longer to be complete)
+    An empty file is returned as a single (empty) partition
+    @param min_ids <numpy array>: minimum client id of each chunk (see get_transactions_ranges)
+    @param chunk_size <int>: number of client ids on each partition
+    @param read_chunk_size <int>: number of transactions read at a time (same as get_transactions_ranges)
+    """
+    # Minimum client id of the chunks after each chunk
+    later_min_ids = np.append(np.minimum.accumulate(min_ids[::-1])[::-1][1:], np.iinfo(np.int64).max)
+
+    df_pending = None
+    for chunk_index, df_chunk in enumerate(storage.iter_intermediate_chunks('customer_transactions', TRANSACTION_COLUMNS, read_chunk_size)):
+        df_pending = df_chunk if df_pending is None else pd.concat(objs=[df_pending, df_chunk], ignore_index=True)
+        complete = (df_pending["id"] < later_min_ids[chunk_index]).to_numpy()
+        if complete.all():
+            df_complete, df_pending = df_pending, None
+        elif complete.any():
+            df_complete, df_pending = df_pending[complete], df_pending[~complete].reset_index(drop=True)
+        else:
+            continue
+        yield from iter_id_partitions(df_complete, chunk_size)
+
+    if df_pending is not None:
+        yield from iter_id_partitions(df_pending, chunk_size)
+
+
+def iter_balance_chunks(now, chunk_size=DEFAULT_CHUNK_SIZE, read_chunk_size=READ_CHUNK_SIZE):
+    """
+    Generator of the balance dataframes (per client and per client and month) of each partition of client ids,
+    reading the transactions file in chunks
+    Monthly balances of every partition share the same transaction_month categories
+    @param now <datetime>: date the days since the last transaction are counted until
+    @param chunk_size <int>: number of client ids on each partition
+    @param read_chunk_size <int>: number of transactions read at a time
+    """
+    # Every partition has the same months as categories, so partitions can be written to the same file
+    with instrumentation.span('transaction ranges'):
+        month_range, min_ids = get_transactions_ranges(read_chunk_size)
+
+    partitions = 0
+    for df_partition in iter_transaction_partitions(min_ids, chunk_size, read_chunk_size):
+        partitions += 1
+        yield get_balance_dataframes(df_partition, now, month_range)
+
+    # A file without transactions still has the (empty) balance dataframes
+    if partitions == 0:
+        yield get_balance_dataframes(storage.read_intermediate('customer_transactions', columns=TRANSACTION_COLUMNS), now, month_range)
+
+
+def create_customer_balance_file(now=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Function to create customer_balance.csv and customer_balance_monthly.csv files based on transactions file
+    @param now <datetime>: date the days since the last transaction are counted until (defaults to current datetime)
+    @param chunk_size <int>: number of client ids processed at a time
+    """
+    print("Creating new customer_balance.csv and customer_balance_monthly.csv...")
+
+    # get balances by client and by client and month, reading the transactions file in chunks
+    balance_chunks = list(iter_balance_chunks(now or pd.Timestamp.now(), chunk_size))
+    df_balance = pd.concat(objs=[chunk[0] for chunk in balance_chunks], ignore_index=True)
+    df_monthly = storage.concat_dataframes([chunk[1] for chunk in balance_chunks])
+
+    # Output result to csv files
+    storage.write_output(df_balance, 'customer_balance')
+    storage.write_output(df_monthly, 'customer_balance_monthly')
+
+    print("New files customer_balance.csv and customer_balance_monthly.csv done!")
+
+
+# Pipeline stage declaration (see pipeline.py)
+# Streamed inputs are read by the stage itself from their intermediate files, in chunks
+STAGE_INPUTS = ['customer_transactions']
+STAGE_STREAMED_INPUTS = ['customer_transactions']
+STAGE_OUTPUTS = ['customer_balance', 'customer_balance_monthly']
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    Balances depend on the run date (days since the last transaction), so they are fully recomputed on incremental runs
+    Transactions are read from their intermediate file in chunks, so they are not in the input dataframes
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    balance_chunks = iter_balance_chunks(params['now'], params['chunk_size'] or DEFAULT_CHUNK_SIZE)
+
+    # In streaming mode the monthly balances are written here, one partition at a time
+    if params['chunk_size']:
+        balance_objs = []
+
+        def iter_monthly_chunks():
+            for df_balance, df_monthly in balance_chunks:
+                balance_objs.append(df_balance)
+                yield df_monthly
+
+        with instrumentation.span('write monthly balances') as record:
+            record['rows'] = storage.write_output_chunks(iter_monthly_chunks(), 'customer_balance_monthly', export_options=export.get_export_options(params))
+        return {
+            'customer_balance': pd.concat(objs=balance_objs, ignore_index=True),
+            'customer_balance_monthly': None,
+        }
+
+    with instrumentation.span('balances') as record:
+        balance_chunks = list(balance_chunks)
+        record['rows'] = sum(len(chunk[1]) for chunk in balance_chunks)
+
+    return {
+        'customer_balance': pd.concat(objs=[chunk[0] for chunk in balance_chunks], ignore_index=True),
+        'customer_balance_monthly': storage.concat_dataframes([chunk[1] for chunk in balance_chunks]),
+    }
@@ -1,6 +1,13 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import datetime
+import storage
+import instrumentation
+import duckdb_backend
+from customer_funnel import (
+    FUNNEL_STAGES, MAX_FUNNEL_DAYS, get_client_analysis_dt, get_customer_funnel_dataframe, get_funnel_day_numbers,
+    get_day_categorical, get_day_number_strings, get_status_categorical
+)
 
 
 def days_between_dates(date1, date2):
@@ -32,69 +39,32 @@ def get_analyzed_date(appr_dt, deny_dt):
         return None
 
 
-def get_df_client_count(df, columnname_date_from, columnname_date_to, status_from, status_to):
+def add_client_analysis_dt(df):
     """
-    Function to get the count of clients based on the statuses from and to and dates
-    @param df <pandas DataFrame>: dataframe containing client registration data
-    @param columnname_date_from <string>: name of the datetime column from status from
-    @param columnname_date_to <string>: name of the datetime column from status to
-    @param status_from <string>: status from, starting point
-    @param status_to <string>: status to, end point
+    Function to return the dataframe with a new column storing the analyzed datetime (client_analysis_dt)
+    If the column already exists (e.g. on the funnel table), the dataframe is returned as it is
+    @param df <pandas DataFrame>: dataframe containing customer registration data (base file)
     """
+    if "client_analysis_dt" in df.columns:
+        return df
 
-    # filter only relevant values based on date
-    df_client_count = df[df[columnname_date_from].notnull()][["id", columnname_date_from, columnname_date_to]]
-
-    # rename date columns
-    columns_rename = {
-    columnname_date_from : 'status_datetime_from', 
-    columnname_date_to : 'status_datetime_to'
-    }
-    df_client_count.rename(columns=columns_rename, inplace=True)
-
-    # add numbers to count customers in the end
-    df_client_count['status_from_count'] = 1
-    df_client_count['status_to_count'] = np.where(df_client_count.status_datetime_to.notnull(), 1, 0)
+    return df.assign(client_analysis_dt=get_client_analysis_dt(df))
 
-    # transform columns from datetime to date
-    df_client_count['status_datetime_from'] = pd.to_datetime(df_client_count.status_datetime_from)
-    df_client_count['status_datetime_from'] = df_client_count['status_datetime_from'].dt.strftime('%Y-%m-%d')
-    df_client_count['status_datetime_to'] = pd.to_datetime(df_client_count.status_datetime_to)
-    df_client_count['status_datetime_to'] = df_client_count['status_datetime_to'].dt.strftime('%Y-%m-%d')
 
-    # count clients: first calculate whole population from, then get conversions and in the end merge both info
-    df_client_count_status_from = df_client_count.groupby(["status_datetime_from"]).sum().reset_index()[["status_datetime_from", "status_from_count"]]
-    df_client_count_status_to = df_client_count.groupby(["status_datetime_from", "status_datetime_to"]).sum().reset_index()[["status_datetime_from", "status_datetime_to", "status_to_count"]]
-    df_client_count = pd.merge(df_client_count_status_to, df_client_count_status_from, how="left", on=["status_datetime_from"])
-
-    # create status columns
-    df_client_count['status_from'] = status_from
-    df_client_count['status_to'] = status_to
+def get_status_pairs():
+    """
+    Function to return the (stage from, stage to) pairs of the cohort, in order: every stage to any later stage
+    """
+    num_of_stages = len(FUNNEL_STAGES)
 
-    return df_client_count
+    return [(i, j) for i in range(num_of_stages) for j in range(i + 1, num_of_stages)]
 
 
 def get_all_statuses_dataframe():
     """
     Function to return a dataframe with all status combinations available (from and to)
+    Statuses are categorical columns, like the statuses of the counts they are joined with
     """
-    statuses = {
-        "order": [1, 2, 3, 4, 5],
-        "status": [
-        'Account registered',
-        'Email confirmed',
-        'Client registered',
-        'Client analyzed (approved or denied)',
-        'Initial deposit'      
-        ]
-    }
-
-    # Creates 2 different dataframes from the statuses
-    df_status_list1 = pd.DataFrame(statuses)
-    df_status_list1['id'] = 1
-    df_status_list2 = pd.DataFrame(statuses)
-    df_status_list2['id'] = 1
-
     # Create a final dataframe with all possible status combinations
     #
     # Similar to:
@@ -102,8 +72,11 @@ def get_all_statuses_dataframe():
     # FROM df_status_list a,
     #      df_status_list b
     # WHERE a.order < b.order
-    df_statuses_final = pd.merge(df_status_list1, df_status_list2, on="id", how="outer")
-    df_statuses_final = df_statuses_final[df_statuses_final["order_x"] < df_statuses_final["order_y"]][["status_x", "status_y"]]
+    status_pairs = np.array(get_status_pairs())
+    df_statuses_final = pd.DataFrame({
+        'status_x': get_status_categorical(status_pairs[:, 0]),
+        'status_y': get_status_categorical(status_pairs[:, 1]),
+    })
 
     # Create a new field to do all possible combinations with date later
     df_statuses_final['id'] = 1
@@ -111,45 +84,75 @@ def get_all_statuses_dataframe():
     return df_statuses_final
 
 
-def get_all_dates_dataframe(df):
+def get_all_date_pairs(df, max_lag_days=None, min_date_to=None, now=None, first_date=None):
     """
-    Function that return a dataframe with all date combinations available (from and to)
-    It uses the minimum account registration date as a starting date and current date as end date
-    @param df <pandas DataFrame>: dataframe containing customer registration data (base file)
+    Function that returns all date combinations available (from and to) as integer day offsets
+    It uses the minimum account registration date (or the first date given) as a starting date and current date as end date
+    Returns the first day number, the number of days and, for every combination, the day from (offset)
+    and the number of days until the date to, plus the first lag and the number of combinations of each day from
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param max_lag_days <int>: if set, only keeps combinations up to this many days apart
+    @param min_date_to <string>: if set, only keeps combinations with date to on or after this date ('%Y-%m-%d')
+    @param now <datetime>: end datetime of the cohort (defaults to current datetime)
+    @param first_date <datetime>: starting date, when df only has the recent clients (incremental runs)
     """
-    # Create all days from min date to today
-    min_registration_date = datetime.strptime(df["account_registration_dt"].min(), '%Y-%m-%d %H:%M:%S')
-    start_date = min_registration_date.date()
-    end_date = datetime.now().date()
-    delta = end_date - start_date
-    dates_list = []
-    for i in range(delta.days + 1):
-        date = start_date + timedelta(days=i)
-        dates_list.append(date.strftime('%Y-%m-%d'))
-
-    df_dates = pd.DataFrame(data=dates_list, columns=['date'])
-
-    # Do all possible combinations
-    df_dates_list1 = pd.DataFrame(df_dates)
-    df_dates_list1['id'] = 1
-    df_dates_list2 = pd.DataFrame(df_dates)
-    df_dates_list2['id'] = 1
-
-    # Create dataframe with just relevant data (feasible dates)
+    if now is None:
+        now = datetime.now()
+
+    # Create all days from min date to today, as integer day offsets
+    if first_date is None:
+        first_date = pd.to_datetime(df["account_registration_dt"]).min()
+    start_date = pd.Timestamp(first_date).normalize()
+    end_date = pd.Timestamp(pd.Timestamp(now).date())
+    num_of_days = (end_date - start_date).days + 1
+
+    # Create just relevant data (feasible dates)
+    # Each day offset a is repeated once for every day offset b >= a (from the min date to and
+    # up to the max lag), so the date difference is just b - a
     #
     # Similar to:
-    # SELECT a.date as date_from, b.date as date_to
+    # SELECT a.date as date_from, b.date as date_to, b.date - a.date as datetime_diff_days
     # FROM df_dates_list a,
     #      df_dates_list b
     # WHERE a.date <= b.date
-    df_dates_final = pd.merge(df_dates_list1, df_dates_list2, on="id", how="outer")
-    df_dates_final = df_dates_final[df_dates_final["date_x"] <= df_dates_final["date_y"]][["date_x", "date_y"]]
+    days_from = np.arange(num_of_days, dtype=np.int32)
+    max_lag = num_of_days - 1 if max_lag_days is None else max_lag_days
+    min_day_to = 0 if min_date_to is None else (pd.Timestamp(min_date_to) - start_date).days
+    first_lag = np.maximum(min_day_to - days_from, 0)
+    last_lag = np.minimum(max_lag, num_of_days - 1 - days_from)
+    num_of_combinations = np.maximum(last_lag - first_lag + 1, 0)
+    pair_days_from = np.repeat(days_from, num_of_combinations)
+    pair_first_position = np.repeat(np.cumsum(num_of_combinations) - num_of_combinations, num_of_combinations)
+    datetime_diff_days = (np.repeat(first_lag, num_of_combinations) + np.arange(len(pair_days_from)) - pair_first_position).astype(np.int32)
+
+    return {
+        'first_day': (start_date - pd.Timestamp(0)).days,
+        'num_of_days': num_of_days,
+        'days_from': pair_days_from,
+        'datetime_diff_days': datetime_diff_days,
+        'first_lag': first_lag,
+        'num_of_combinations': num_of_combinations,
+    }
 
-    # Calculate date difference in days
-    df_dates_final['datetime_diff_days'] = df_dates_final.apply(
-        lambda row: days_between_dates(row.date_x, row.date_y), 
-        axis=1
-    )
+
+def get_all_dates_dataframe(df, max_lag_days=None, min_date_to=None, now=None, first_date=None):
+    """
+    Function that return a dataframe with all date combinations available (from and to)
+    It uses the minimum account registration date as a starting date and current date as end date
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param max_lag_days <int>: if set, only keeps combinations up to this many days apart
+    @param min_date_to <string>: if set, only keeps combinations with date to on or after this date ('%Y-%m-%d')
+    @param now <datetime>: end datetime of the cohort (defaults to current datetime)
+    @param first_date <datetime>: starting date, when df only has the recent clients (incremental runs)
+    """
+    date_pairs = get_all_date_pairs(df, max_lag_days, min_date_to, now, first_date)
+
+    # Dates are categorical columns until the file is exported
+    df_dates_final = pd.DataFrame({
+        'date_x': get_day_categorical(date_pairs['days_from'], date_pairs['first_day'], date_pairs['num_of_days']),
+        'date_y': get_day_categorical(date_pairs['days_from'] + date_pairs['datetime_diff_days'], date_pairs['first_day'], date_pairs['num_of_days']),
+        'datetime_diff_days': date_pairs['datetime_diff_days'],
+    })
 
     # Create a new field to do all possible combinations with statuses
     df_dates_final['id'] = 1
@@ -157,112 +160,665 @@ def get_all_dates_dataframe(df):
     return df_dates_final
 
 
-def get_all_counts_dataframe(df):
+def get_all_counts(df):
     """
-    Function that returns a dataframe with all counts for statuses and dates from -> to
-    @param df <pandas DataFrame>: dataframe containing customer registration data (base file)
+    Function that returns all counts for statuses and dates from -> to as integer arrays
+    All stage pairs are counted in a single pass: the stage datetimes are parsed once into day numbers and
+    every (status pair, day from, day to) combination is encoded as one integer key to be counted
+    Returns the first day number, the number of days and, for every counted combination, the status pair
+    (index on get_status_pairs), the day from and day to (offsets from the first day) and the int32 counts,
+    plus the number of clients reaching each status per day (stages x days)
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
     """
+    stage_days, stage_exists = get_funnel_day_numbers(df)
+    num_of_stages = len(FUNNEL_STAGES)
+    status_pairs = get_status_pairs()
 
-    # Counts for status from = Account Registration
-    df_case1_2 = get_df_client_count(df, "account_registration_dt", "account_email_confirmation_dt", "Account registered", "Email confirmed")
-    df_case1_3 = get_df_client_count(df, "account_registration_dt", "client_registration_dt", "Account registered", "Client registered")
-    df_case1_4 = get_df_client_count(df, "account_registration_dt", "client_analysis_dt", "Account registered", "Client analyzed (approved or denied)")
-    df_case1_5 = get_df_client_count(df, "account_registration_dt", "client_initial_deposit_dt", "Account registered", "Initial deposit")
+    # Day numbers relative to the first day on the dataset
+    first_day = int(stage_days[stage_exists].min()) if stage_exists.any() else 0
+    stage_days = stage_days - first_day
+    num_of_days = int(stage_days[stage_exists].max()) + 1 if stage_exists.any() else 1
 
-    # Counts for status from = Email Confirmation
-    df_case2_3 = get_df_client_count(df, "account_email_confirmation_dt", "client_registration_dt", "Email confirmed", "Client registered")
-    df_case2_4 = get_df_client_count(df, "account_email_confirmation_dt", "client_analysis_dt", "Email confirmed", "Client analyzed (approved or denied)")
-    df_case2_5 = get_df_client_count(df, "account_email_confirmation_dt", "client_initial_deposit_dt", "Email confirmed", "Initial deposit")
-
-    # Counts for status from = Client Registration
-    df_case3_4 = get_df_client_count(df, "client_registration_dt", "client_analysis_dt", "Client registered", "Client analyzed (approved or denied)")
-    df_case3_5 = get_df_client_count(df, "client_registration_dt", "client_initial_deposit_dt", "Client registered", "Initial deposit")
+    # Encode every client conversion as (status pair, day from, day to) and count each key
+    #
+    # Similar to:
+    # SELECT status_from, status_to, status_datetime_from, status_datetime_to, COUNT(*) AS status_to_count
+    # FROM (clients x status pairs)
+    # WHERE status_datetime_from IS NOT NULL AND status_datetime_to IS NOT NULL
+    # GROUP BY 1, 2, 3, 4
+    keys = []
+    for pair, (i, j) in enumerate(status_pairs):
+        converted = stage_exists[:, i] & stage_exists[:, j]
+        keys.append((pair * num_of_days + stage_days[converted, i].astype(np.int64)) * num_of_days + stage_days[converted, j])
+    keys, status_to_count = np.unique(np.concatenate(keys), return_counts=True)
+    pair, day_from, day_to = keys // (num_of_days * num_of_days), (keys // num_of_days) % num_of_days, keys % num_of_days
+
+    # Count whole population of each status per day, to be used as status from count
+    stage_population = np.stack([
+        np.bincount(stage_days[stage_exists[:, stage], stage], minlength=num_of_days)
+        for stage in range(num_of_stages)
+    ])
+    stage_from = np.array([i for i, j in status_pairs])[pair]
+
+    return {
+        'first_day': first_day,
+        'num_of_days': num_of_days,
+        'pair': pair.astype(np.int32),
+        'day_from': day_from.astype(np.int32),
+        'day_to': day_to.astype(np.int32),
+        'status_to_count': status_to_count.astype(np.int32),
+        'status_from_count': stage_population[stage_from, day_from].astype(np.int32),
+        'stage_population': stage_population.astype(np.int32),
+    }
 
-    # Counts for status from = Client Analysis
-    df_case4_5 = get_df_client_count(df, "client_analysis_dt", "client_initial_deposit_dt", "Client analyzed (approved or denied)", "Initial deposit")
 
-    # Union all dataframes
-    objs=[
-        df_case1_2, df_case1_3, df_case1_4, df_case1_5,
-        df_case2_3, df_case2_4, df_case2_5,
-        df_case3_4, df_case3_5,
-        df_case4_5
-    ]
-    df_client_counts = pd.concat(objs=objs)
+def get_all_counts_dataframe(df):
+    """
+    Function that returns a dataframe with all counts for statuses and dates from -> to
+    Dates and statuses are categorical columns until the file is exported
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    """
+    counts = get_all_counts(df)
+    status_pairs = np.array(get_status_pairs())
+
+    df_client_counts = pd.DataFrame({
+        'status_datetime_from': get_day_categorical(counts['day_from'], counts['first_day'], counts['num_of_days']),
+        'status_datetime_to': get_day_categorical(counts['day_to'], counts['first_day'], counts['num_of_days']),
+        'status_to_count': counts['status_to_count'],
+        'status_from_count': counts['status_from_count'],
+        'status_from': get_status_categorical(status_pairs[counts['pair'], 0]),
+        'status_to': get_status_categorical(status_pairs[counts['pair'], 1]),
+    })
 
     return df_client_counts
 
 
-def create_customer_cohort_file():
+def get_dense_cohort_dataframe(df, min_date_to=None, now=None, first_date=None):
     """
-    Function that uses the customer registration information and puts
-    into a better format for Tableau
+    Function that returns the cohort rows for all dates and statuses from -> to (zero counts included)
+    Every row is a (date combination, status pair) position computed with integer arithmetic, so the counts
+    are placed on their rows directly instead of joining all combinations with the counts on string keys
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param min_date_to <string>: if set, only returns rows with date to on or after this date ('%Y-%m-%d')
+    @param now <datetime>: end datetime of the cohort (defaults to current datetime)
+    @param first_date <datetime>: starting date, when df only has the recent clients (incremental runs)
     """
-    print("Creating new customer_datasource_cohort.csv...")
-
-    # read the file containing all client information
-    df = pd.read_csv('output/customer_datasource.csv')
-
-    # create new column to store analyzed datetime
-    df["client_analysis_dt"] = df.apply(
-        lambda row: get_analyzed_date(row.client_approval_dt, row.client_denial_dt),
-        axis=1
-    )
-
-    # get all date combinations
-    df_dates_final = get_all_dates_dataframe(df)
-
-    # get all statuses combinations
-    df_statuses_final = get_all_statuses_dataframe()
+    date_pairs = get_all_date_pairs(df, min_date_to=min_date_to, now=now, first_date=first_date)
+    status_pairs = np.array(get_status_pairs())
+    num_of_pairs = len(status_pairs)
 
-    # Create a dataframe with all combinations of dates and statuses
+    # All combinations of dates and statuses, every date combination is followed by its status pairs
     #
     # Similar to:
     # SELECT a.date_from, a.date_to, a.status_from, a.status_to
     # FROM df_dates_final a,
     #      df_statuses_final b
-    df_final_cohort = pd.merge(df_dates_final, df_statuses_final, on="id", how="outer")
-
-    # Rename columns for the join with client counts and drop unused field (id)
-    columns_rename = {
-        'date_x': 'status_datetime_from',
-        'date_y': 'status_datetime_to',
-        'status_x': 'status_from',
-        'status_y': 'status_to',
-    }
-    df_final_cohort.rename(columns=columns_rename, inplace=True)
-    df_final_cohort.drop(columns=['id'], inplace=True)
-
-    # get all customer counts
-    df_client_counts = get_all_counts_dataframe(df)
+    num_of_rows = len(date_pairs['days_from']) * num_of_pairs
+    rows_days_from = np.repeat(date_pairs['days_from'], num_of_pairs)
+    rows_datetime_diff_days = np.repeat(date_pairs['datetime_diff_days'], num_of_pairs)
+    rows_pair = np.tile(np.arange(num_of_pairs, dtype=np.int8), len(date_pairs['days_from']))
 
-    # Join information from all dates and statuses with client counts
+    # Place the client counts on the row of their date combination and status pair, the rest keep 0
     #
     # Similar to:
-    # SELECT a.*, b.*
+    # SELECT a.*, COALESCE(b.status_to_count, 0), COALESCE(b.status_from_count, 0)
     # FROM df_final_cohort a
     # LEFT JOIN df_client_counts b ON a.status_datetime_from = b.status_datetime_from
     #                             AND a.status_datetime_to = b.status_datetime_to
     #                             AND a.status_from = b.status_from
     #                             AND a.status_to = b.status_to
-    df_final_cohort = df_final_cohort.merge(
-        df_client_counts, 
-        on=[
-            "status_datetime_from", 
-            "status_datetime_to", 
-            "status_from", 
-            "status_to"
-        ], 
-        how="left"
+    counts = get_all_counts(df)
+    day_offset = counts['first_day'] - date_pairs['first_day']
+    counts_day_from = counts['day_from'] + day_offset
+    counts_lag = counts['day_to'] - counts['day_from']
+    in_grid = (counts_day_from >= 0) & (counts_day_from < date_pairs['num_of_days'])
+    in_grid[in_grid] &= (counts_lag[in_grid] >= date_pairs['first_lag'][counts_day_from[in_grid]]) & (
+        counts_lag[in_grid] < date_pairs['first_lag'][counts_day_from[in_grid]] + date_pairs['num_of_combinations'][counts_day_from[in_grid]]
     )
+    first_positions = np.cumsum(date_pairs['num_of_combinations']) - date_pairs['num_of_combinations']
+    date_positions = first_positions[counts_day_from[in_grid]] + counts_lag[in_grid] - date_pairs['first_lag'][counts_day_from[in_grid]]
+    rows = date_positions * num_of_pairs + counts['pair'][in_grid]
+    status_to_count = np.zeros(num_of_rows, dtype=np.int32)
+    status_to_count[rows] = counts['status_to_count'][in_grid]
+    status_from_count = np.zeros(num_of_rows, dtype=np.int32)
+    status_from_count[rows] = counts['status_from_count'][in_grid]
+
+    df_final_cohort = pd.DataFrame({
+        'status_datetime_from': get_day_categorical(rows_days_from, date_pairs['first_day'], date_pairs['num_of_days']),
+        'status_datetime_to': get_day_categorical(rows_days_from + rows_datetime_diff_days, date_pairs['first_day'], date_pairs['num_of_days']),
+        'datetime_diff_days': rows_datetime_diff_days,
+        'status_from': get_status_categorical(status_pairs[rows_pair, 0]),
+        'status_to': get_status_categorical(status_pairs[rows_pair, 1]),
+        'status_to_count': status_to_count,
+        'status_from_count': status_from_count,
+    })
+
+    return df_final_cohort
+
+
+def get_all_denominators_dataframe(df):
+    """
+    Function that returns a dataframe with the number of clients reaching each status per day
+    These are the denominators of the cohort conversions (status_from_count), stored only once per day
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    """
+    stage_days, stage_exists = get_funnel_day_numbers(add_client_analysis_dt(df))
+
+    # Last stage is never a status from
+    objs = []
+    for stage, (columnname_date, status_from) in enumerate(FUNNEL_STAGES[:-1]):
+        days, status_from_count = np.unique(stage_days[stage_exists[:, stage], stage], return_counts=True)
+        df_status_from = pd.DataFrame({
+            'status_datetime_from': np.datetime_as_string(days.astype('datetime64[D]')).astype(object),
+            'status_from': status_from,
+            'status_from_count': status_from_count,
+        })
+        objs.append(df_status_from)
+
+    df_denominators = pd.concat(objs=objs, ignore_index=True)
+
+    return df_denominators
 
-    # Replace non matching rows with 0 on the count
-    df_final_cohort['status_from_count'] = df_final_cohort['status_from_count'].fillna(0)
-    df_final_cohort['status_from_count'] = df_final_cohort['status_from_count'].astype('Int64')
-    df_final_cohort['status_to_count'] = df_final_cohort['status_to_count'].fillna(0)
-    df_final_cohort['status_to_count'] = df_final_cohort['status_to_count'].astype('Int64')
+
+def get_cumulative_conversions(df, max_lag_days, now=None):
+    """
+    Function that returns, for every day from and status pair, the number of clients reaching the status to
+    within each number of days (0 up to max_lag_days), computed as cumulative sums of the counts over the lag
+    Returns the first day number, the number of days (until the current date) and int32 arrays (days x status pairs):
+    the cumulative counts (x lags), the status from population and a (days x lags) matrix flagging which lags
+    were already observed (date from plus lag not after the current date)
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param max_lag_days <int>: maximum number of days between date from and date to
+    @param now <datetime>: current datetime, lags after it are not observed yet (defaults to current datetime)
+    """
+    if now is None:
+        now = datetime.now()
+    counts = get_all_counts(df)
+    status_pairs = np.array(get_status_pairs())
+    num_of_lags = max_lag_days + 1
+
+    # Days from the first day on the dataset until the current date
+    first_day = counts['first_day']
+    end_day = int(np.datetime64(pd.Timestamp(now).date(), 'D').astype(np.int64))
+    num_of_days = max(end_day - first_day + 1, counts['num_of_days'])
+
+    # Place every count on its (day from, status pair, lag) cell, counts are unique per cell
+    lag = counts['day_to'] - counts['day_from']
+    in_window = (lag >= 0) & (lag < num_of_lags)
+    conversions = np.zeros((num_of_days, len(status_pairs), num_of_lags), dtype=np.int32)
+    conversions[counts['day_from'][in_window], counts['pair'][in_window], lag[in_window]] = counts['status_to_count'][in_window]
+
+    # Similar to:
+    # SELECT status_datetime_from, status_from, status_to, datetime_diff_days,
+    #        SUM(status_to_count) OVER (PARTITION BY status_datetime_from, status_from, status_to ORDER BY datetime_diff_days)
+    # FROM df_client_counts
+    cumulative = np.cumsum(conversions, axis=2, dtype=np.int32)
+
+    population = np.zeros((num_of_days, len(status_pairs)), dtype=np.int32)
+    population[:counts['num_of_days']] = counts['stage_population'][status_pairs[:, 0]].T
+    observed = (first_day + np.arange(num_of_days)[:, None] + np.arange(num_of_lags)[None, :]) <= end_day
+
+    return {
+        'first_day': first_day,
+        'num_of_days': num_of_days,
+        'cumulative': cumulative,
+        'population': population,
+        'observed': observed,
+    }
+
+
+def get_period_start_days(days, period):
+    """
+    Function that returns the first day of the period (day, week starting on monday or month) of every day number
+    @param days <numpy array>: day numbers (days since 1970-01-01)
+    @param period <string>: day, week or month
+    """
+    if period == 'week':
+        # 1970-01-01 was a thursday
+        return days - (days + 3) % 7
+    if period == 'month':
+        return days.astype('datetime64[D]').astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)
+
+    return days
+
+
+def get_conversion_dataframe(conversions, period='day'):
+    """
+    Function that returns a conversion table: clients reaching the status to within each number of days,
+    out of the clients reaching the status from, per date from (or first day of the week or month) and status pair
+    On weekly and monthly tables, each lag only sums the days from on which that lag was already observed
+    @param conversions <dict>: cumulative conversions (get_cumulative_conversions)
+    @param period <string>: day, week or month
+    """
+    status_pairs = np.array(get_status_pairs())
+    observed = conversions['observed']
+
+    # Group consecutive days from by their period
+    #
+    # Similar to:
+    # SELECT period_start, status_from, status_to, datetime_diff_days,
+    #        SUM(status_from_count), SUM(status_to_cumulative_count)
+    # FROM df_conversion
+    # WHERE status_datetime_from + datetime_diff_days <= CURRENT_DATE
+    # GROUP BY 1, 2, 3, 4
+    days = conversions['first_day'] + np.arange(conversions['num_of_days'])
+    period_days = get_period_start_days(days, period)
+    period_starts = np.flatnonzero(np.r_[True, period_days[1:] != period_days[:-1]])
+    cumulative = np.add.reduceat(conversions['cumulative'] * observed[:, None, :], period_starts, axis=0)
+    population = np.add.reduceat(conversions['population'][:, :, None] * observed[:, None, :], period_starts, axis=0)
+
+    # Keep only the rows with clients on the status from
+    rows_period, rows_pair, rows_lag = np.nonzero(population > 0)
+    period_strings = np.datetime_as_string(period_days[period_starts].astype('datetime64[D]')).astype(object)
+
+    df_conversion = pd.DataFrame({
+        'status_datetime_from': pd.Categorical.from_codes(rows_period, categories=period_strings),
+        'status_from': get_status_categorical(status_pairs[rows_pair, 0]),
+        'status_to': get_status_categorical(status_pairs[rows_pair, 1]),
+        'datetime_diff_days': rows_lag.astype(np.int32),
+        'status_from_count': population[rows_period, rows_pair, rows_lag].astype(np.int32),
+        'status_to_cumulative_count': cumulative[rows_period, rows_pair, rows_lag].astype(np.int32),
+    })
+
+    return df_conversion
+
+
+def get_conversion_dataframes(df, max_lag_days, now=None, min_date_from=None):
+    """
+    Function that returns the daily, weekly and monthly conversion tables by output name
+    These are small pre-aggregated tables, so Tableau doesn't have to sum the cohort rows of every lag
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param max_lag_days <int>: maximum number of days between date from and date to
+    @param now <datetime>: current datetime, lags after it are not observed yet (defaults to current datetime)
+    @param min_date_from <string>: if set, only returns the periods starting on or after this date ('%Y-%m-%d'),
+        when df only has the clients reaching a status from that date on (incremental runs)
+    """
+    df = add_client_analysis_dt(df)
+    conversions = get_cumulative_conversions(df, max_lag_days, now)
+
+    conversion_dataframes = {}
+    for period, name in [
+        ('day', 'customer_datasource_cohort_conversion'),
+        ('week', 'customer_datasource_cohort_conversion_weekly'),
+        ('month', 'customer_datasource_cohort_conversion_monthly'),
+    ]:
+        with instrumentation.span(period + ' conversion') as record:
+            df_conversion = get_conversion_dataframe(conversions, period)
+            if min_date_from is not None:
+                df_conversion = df_conversion[~storage.get_values_before(df_conversion['status_datetime_from'], min_date_from)].reset_index(drop=True)
+            conversion_dataframes[name] = df_conversion
+            record['rows'] = len(conversion_dataframes[name])
+
+    return conversion_dataframes
+
+
+def get_sparse_cohort_dataframe(df_client_counts, df_dates_final=None, df_statuses_final=None):
+    """
+    Function that returns the cohort rows that were actually observed (at least one client converting)
+    Optionally it also densifies the rows inside a bounded date window (given by df_dates_final)
+    @param df_client_counts <pandas DataFrame>: dataframe with all client counts (get_all_counts_dataframe)
+    @param df_dates_final <pandas DataFrame>: date combinations to densify (get_all_dates_dataframe) or None
+    @param df_statuses_final <pandas DataFrame>: status combinations to densify (get_all_statuses_dataframe) or None
+    """
+    # Keep only rows where the status to was reached
+    df_sparse_cohort = df_client_counts[df_client_counts["status_datetime_to"].notnull()].copy()
+    # Both dates have one category per day of the same range, so the difference in days is the difference of their codes
+    df_sparse_cohort["datetime_diff_days"] = (
+        df_sparse_cohort["status_datetime_to"].cat.codes.astype(np.int32) - df_sparse_cohort["status_datetime_from"].cat.codes.astype(np.int32)
+    )
+
+    if df_dates_final is not None:
+        # Similar to:
+        # SELECT COALESCE(a.status_datetime_from, b.status_datetime_from), ...
+        # FROM (df_dates_final x df_statuses_final) a
+        # FULL OUTER JOIN df_sparse_cohort b ON a.status_datetime_from = b.status_datetime_from
+        #                                   AND a.status_datetime_to = b.status_datetime_to
+        #                                   AND a.status_from = b.status_from
+        #                                   AND a.status_to = b.status_to
+        df_window = pd.merge(df_dates_final, df_statuses_final, on="id", how="outer")
+        df_window.rename(columns={
+            'date_x': 'status_datetime_from',
+            'date_y': 'status_datetime_to',
+            'status_x': 'status_from',
+            'status_y': 'status_to',
+        }, inplace=True)
+        df_window.drop(columns=['id'], inplace=True)
+
+        # The window ends on the current date and the counts on the last date observed, so both dates are
+        # set to the same range of day categories before joining (joined categoricals only stay categorical
+        # when their categories are the same)
+        date_columns = ["status_datetime_from", "status_datetime_to"]
+        first_days = [np.datetime64(df_part[columnname].cat.categories[0], 'D') for df_part in [df_window, df_sparse_cohort] for columnname in date_columns]
+        last_days = [np.datetime64(df_part[columnname].cat.categories[-1], 'D') for df_part in [df_window, df_sparse_cohort] for columnname in date_columns]
+        first_day = int(min(first_days).astype(np.int64))
+        day_categories = get_day_number_strings(first_day, int(max(last_days).astype(np.int64)) - first_day + 1)
+        for df_part in [df_window, df_sparse_cohort]:
+            for columnname in date_columns:
+                df_part[columnname] = df_part[columnname].cat.set_categories(day_categories)
+
+        df_sparse_cohort = df_window.merge(
+            df_sparse_cohort,
+            on=[
+                "status_datetime_from",
+                "status_datetime_to",
+                "datetime_diff_days",
+                "status_from",
+                "status_to"
+            ],
+            how="outer"
+        )
+
+    df_sparse_cohort = df_sparse_cohort.sort_values(by=["status_datetime_from", "status_datetime_to"]).reset_index(drop=True)
+
+    return df_sparse_cohort[[
+        "status_datetime_from",
+        "status_datetime_to",
+        "datetime_diff_days",
+        "status_from",
+        "status_to",
+        "status_to_count",
+        "status_from_count",
+    ]]
+
+
+def get_customer_cohort_dataframe_duckdb(df, sparse=False, max_lag_days=None, min_date_to=None, memory_limit=None, now=None, first_date=None):
+    """
+    Function that returns the cohort dataframe running its joins as SQL on DuckDB (see duckdb_backend.py)
+    Rows and dtypes are the same as get_customer_cohort_dataframe (rows with the same dates are ordered by status pair)
+    (parameters are the same as get_customer_cohort_dataframe)
+    @param memory_limit <string>: maximum memory used by DuckDB (e.g. '4GB'), the rest is spilled to disk
+    """
+    if now is None:
+        now = datetime.now()
+    if first_date is None:
+        first_date = pd.to_datetime(df["account_registration_dt"]).min()
+    first_day = (pd.Timestamp(first_date).normalize() - pd.Timestamp(0)).days
+    end_day = (pd.Timestamp(pd.Timestamp(now).date()) - pd.Timestamp(0)).days
+    parameters = {
+        'first_day': first_day,
+        'end_day': end_day,
+        'max_lag': end_day - first_day if max_lag_days is None else max_lag_days,
+        'min_day_to': first_day if min_date_to is None else (pd.Timestamp(min_date_to) - pd.Timestamp(0)).days,
+    }
+
+    # One row per client and stage reached, with the day number of the stage
+    stages_sql = "\n        UNION ALL\n".join(
+        "        SELECT id, {} AS stage, CAST(CAST({} AS TIMESTAMP) AS DATE) - DATE '1970-01-01' AS day FROM funnel WHERE {} IS NOT NULL".format(
+            stage, columnname_date, columnname_date
+        )
+        for stage, (columnname_date, status) in enumerate(FUNNEL_STAGES)
+    )
+    status_pairs_sql = ", ".join("({}, {})".format(i, j) for i, j in get_status_pairs())
+
+    if not sparse:
+        # All combinations of dates (range join) and statuses, with their counts
+        cohort_sql = """
+        SELECT d.day_from, d.day_to, s.stage_from, s.stage_to,
+               COALESCE(c.status_to_count, 0) AS status_to_count, COALESCE(c.status_from_count, 0) AS status_from_count
+        FROM date_pairs d
+        CROSS JOIN status_pairs s
+        LEFT JOIN client_counts c ON c.day_from = d.day_from AND c.day_to = d.day_to
+                                 AND c.stage_from = s.stage_from AND c.stage_to = s.stage_to
+        """
+    elif max_lag_days is not None:
+        # Observed counts, densified only within the max lag window
+        cohort_sql = """
+        SELECT day_from, day_to, stage_from, stage_to,
+               COALESCE(c.status_to_count, 0) AS status_to_count, COALESCE(c.status_from_count, 0) AS status_from_count
+        FROM (SELECT * FROM date_pairs CROSS JOIN status_pairs) w
+        FULL OUTER JOIN (SELECT * FROM client_counts WHERE day_to >= $min_day_to) c
+        USING (day_from, day_to, stage_from, stage_to)
+        """
+    else:
+        # Observed counts only
+        cohort_sql = """
+        SELECT day_from, day_to, stage_from, stage_to, status_to_count, status_from_count
+        FROM client_counts
+        WHERE day_to >= $min_day_to
+        """
+
+    sql = """
+    WITH stages AS (
+{stages_sql}
+    ),
+    status_pairs AS (
+        SELECT * FROM (VALUES {status_pairs_sql}) t(stage_from, stage_to)
+    ),
+    population AS (
+        SELECT stage, day, COUNT(*) AS status_from_count
+        FROM stages
+        GROUP BY stage, day
+    ),
+    client_counts AS (
+        SELECT a.stage AS stage_from, b.stage AS stage_to, a.day AS day_from, b.day AS day_to,
+               COUNT(*) AS status_to_count, ANY_VALUE(p.status_from_count) AS status_from_count
+        FROM stages a
+        JOIN stages b ON a.id = b.id AND a.stage < b.stage
+        JOIN population p ON p.stage = a.stage AND p.day = a.day
+        GROUP BY a.stage, b.stage, a.day, b.day
+    ),
+    days AS (
+        SELECT range AS day FROM range($first_day, $end_day + 1)
+    ),
+    date_pairs AS (
+        SELECT a.day AS day_from, b.day AS day_to
+        FROM days a
+        JOIN days b ON a.day <= b.day AND b.day - a.day <= $max_lag AND b.day >= $min_day_to
+    )
+    SELECT * FROM ({cohort_sql}) cohort
+    """.format(stages_sql=stages_sql, status_pairs_sql=status_pairs_sql, cohort_sql=cohort_sql)
+
+    columns = duckdb_backend.run_query(
+        sql,
+        {'funnel': add_client_analysis_dt(df)},
+        "day_from, day_to, stage_from, stage_to",
+        {
+            'day_from': np.int32,
+            'day_to': np.int32,
+            'stage_from': np.int8,
+            'stage_to': np.int8,
+            'status_to_count': np.int32,
+            'status_from_count': np.int32,
+        },
+        parameters,
+        memory_limit
+    )
+
+    # Dates and statuses are categorical columns until the file is exported, with the same day categories as the
+    # numpy backend: from the first day until the current day (the last day with a funnel stage, with observed counts only)
+    day_from = columns['day_from']
+    day_to = columns['day_to']
+    last_day = end_day
+    if sparse and max_lag_days is None:
+        stage_days, stage_exists = get_funnel_day_numbers(add_client_analysis_dt(df))
+        last_day = int(stage_days[stage_exists].max()) if stage_exists.any() else first_day
+    num_of_days = max(last_day, int(day_to.max()) if len(day_to) else first_day) - first_day + 1
+    df_final_cohort = pd.DataFrame({
+        'status_datetime_from': get_day_categorical(day_from - first_day, first_day, num_of_days),
+        'status_datetime_to': get_day_categorical(day_to - first_day, first_day, num_of_days),
+        'datetime_diff_days': day_to - day_from,
+        'status_from': get_status_categorical(columns['stage_from']),
+        'status_to': get_status_categorical(columns['stage_to']),
+        'status_to_count': columns['status_to_count'],
+        'status_from_count': columns['status_from_count'],
+    })
+
+    return df_final_cohort
+
+
+def get_customer_cohort_dataframe(df, sparse=False, max_lag_days=None, min_date_to=None, backend='numpy', memory_limit=None, now=None,
+                                  first_date=None):
+    """
+    Function that returns the cohort dataframe (counts for all dates and statuses from -> to)
+    @param df <pandas DataFrame>: funnel table (see customer_funnel.py) or customer registration data (base file)
+    @param sparse <bool>: if True, only returns the observed date and status combinations
+    @param max_lag_days <int>: in sparse mode, also returns every combination (even with zero clients)
+        up to this many days between date from and date to
+    @param min_date_to <string>: if set, only returns rows with date to on or after this date ('%Y-%m-%d')
+    @param backend <string>: numpy or duckdb (runs the joins as SQL, see duckdb_backend.py)
+    @param memory_limit <string>: with the duckdb backend, maximum memory used by DuckDB (e.g. '4GB')
+    @param now <datetime>: end datetime of the cohort (defaults to current datetime)
+    @param first_date <datetime>: first date of the cohort, when df only has the recent clients (incremental runs)
+    """
+    if backend == 'duckdb':
+        with instrumentation.span('duckdb cohort') as record:
+            df_final_cohort = get_customer_cohort_dataframe_duckdb(df, sparse, max_lag_days, min_date_to, memory_limit, now, first_date)
+            record['rows'] = len(df_final_cohort)
+        return df_final_cohort
+
+    df = add_client_analysis_dt(df)
+
+    if sparse:
+        # get all customer counts
+        with instrumentation.span('counts') as record:
+            df_client_counts = get_all_counts_dataframe(df)
+            if min_date_to is not None:
+                df_client_counts = df_client_counts[~storage.get_values_before(df_client_counts["status_datetime_to"], min_date_to)]
+            record['rows'] = len(df_client_counts)
+
+        # get observed counts, densified only within the max lag window
+        with instrumentation.span('sparse cohort') as record:
+            if max_lag_days is not None:
+                df_final_cohort = get_sparse_cohort_dataframe(
+                    df_client_counts,
+                    get_all_dates_dataframe(df, max_lag_days, min_date_to, now, first_date),
+                    get_all_statuses_dataframe()
+                )
+            else:
+                df_final_cohort = get_sparse_cohort_dataframe(df_client_counts)
+            record['rows'] = len(df_final_cohort)
+
+        # Replace non matching rows (inside the max lag window) with 0 on the count
+        df_final_cohort['status_from_count'] = df_final_cohort['status_from_count'].fillna(0).astype(np.int32)
+        df_final_cohort['status_to_count'] = df_final_cohort['status_to_count'].fillna(0).astype(np.int32)
+
+    else:
+        # get all combinations of dates and statuses with their counts
+        with instrumentation.span('dense cohort') as record:
+            df_final_cohort = get_dense_cohort_dataframe(df, min_date_to, now, first_date)
+            record['rows'] = len(df_final_cohort)
+
+    return df_final_cohort
+
+
+def create_customer_cohort_file(sparse=False, max_lag_days=None, conversion_max_lag_days=None, now=None):
+    """
+    Function that uses the customer registration information and puts
+    into a better format for Tableau
+    @param sparse <bool>: if True, only outputs the observed date and status combinations
+        and writes the daily denominators to customer_datasource_cohort_denominators.csv
+    @param max_lag_days <int>: in sparse mode, also outputs every combination (even with zero clients)
+        up to this many days between date from and date to
+    @param conversion_max_lag_days <int>: if set, also writes the daily, weekly and monthly conversion tables
+        (customer_datasource_cohort_conversion*.csv) up to this many days between date from and date to
+    @param now <datetime>: end datetime of the cohort (defaults to current datetime)
+    """
+    print("Creating new customer_datasource_cohort.csv...")
+
+    # read the file containing all client information and parse the funnel stages
+    df = get_customer_funnel_dataframe(storage.read_intermediate('customer_datasource'))
+
+    # get all counts for dates and statuses
+    df_final_cohort = get_customer_cohort_dataframe(df, sparse, max_lag_days, now=now)
 
     # Output information into csv file
-    df_final_cohort.to_csv('output/customer_datasource_cohort.csv')
+    storage.write_output(df_final_cohort, 'customer_datasource_cohort')
+
+    if sparse:
+        storage.write_output(get_all_denominators_dataframe(df), 'customer_datasource_cohort_denominators')
+
+    if conversion_max_lag_days is not None:
+        for name, df_conversion in get_conversion_dataframes(df, conversion_max_lag_days, now).items():
+            storage.write_output(df_conversion, name)
 
-    print("New file customer_datasource_cohort.csv done!")
\ No newline at end of file
+    print("New file customer_datasource_cohort.csv done!")
+
+
+def get_incremental_first_dates(last_datetime, conversion_max_lag_days=None):
+    """
+    Function to return the first dates of the rows that can change after a datetime ('%Y-%m-%d', always the first day
+    of a month, so whole partitions are replaced): cohort rows with date to from the month of the datetime on,
+    conversion rows of the periods (days, weeks and months) starting up to the max lag before it
+    Returns the first cohort date, the first conversion date and the first registration date of the clients needed to
+    recompute them: clients converting from those dates on registered at most MAX_FUNNEL_DAYS before, and so
+    did the rest of the clients on their status from
+    @param last_datetime <datetime>: datetime until when data was generated
+    @param conversion_max_lag_days <int>: maximum number of days between date from and date to of the conversion tables
+    """
+    cohort_first_date = storage.get_month_start(last_datetime)
+    conversion_first_date = cohort_first_date
+    if conversion_max_lag_days is not None:
+        last_day = np.array([(pd.Timestamp(last_datetime).normalize() - pd.Timestamp(0)).days - conversion_max_lag_days])
+        conversion_first_date = storage.get_month_start(pd.Timestamp(get_period_start_days(last_day, 'week')[0], unit='D'))
+    registration_first_date = min(cohort_first_date, conversion_first_date) - pd.Timedelta(days=2 * MAX_FUNNEL_DAYS)
+
+    return cohort_first_date.strftime('%Y-%m-%d'), conversion_first_date.strftime('%Y-%m-%d'), registration_first_date
+
+
+# Pipeline stage declaration (see pipeline.py)
+# Partitioned outputs are written by month of a column, in incremental runs their rows replace the partitions from their first month on
+STAGE_INPUTS = ['customer_funnel']
+STAGE_OUTPUTS = [
+    'customer_datasource_cohort',
+    'customer_datasource_cohort_denominators',
+    'customer_datasource_cohort_conversion',
+    'customer_datasource_cohort_conversion_weekly',
+    'customer_datasource_cohort_conversion_monthly',
+]
+STAGE_PARTITIONED_OUTPUTS = {
+    'customer_datasource_cohort': 'status_datetime_to',
+    'customer_datasource_cohort_denominators': 'status_datetime_from',
+    'customer_datasource_cohort_conversion': 'status_datetime_from',
+    'customer_datasource_cohort_conversion_weekly': 'status_datetime_from',
+    'customer_datasource_cohort_conversion_monthly': 'status_datetime_from',
+}
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    The denominators are only returned in sparse mode, and the conversion tables if their max lag is set
+    In incremental runs, only the clients registered recently enough to change the rows from the first dates given by
+    get_incremental_first_dates are counted, and only those rows are returned (replacing their partitions)
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    df = frames['customer_funnel']
+    cohort_first_date = None
+    conversion_first_date = None
+    first_date = None
+
+    watermark = params['watermark']
+    if watermark is not None:
+        # Similar to:
+        # DELETE FROM df_previous_cohort WHERE status_datetime_to >= cohort_first_date;
+        # INSERT INTO df_previous_cohort SELECT * FROM df_new_cohort WHERE status_datetime_to >= cohort_first_date;
+        cohort_first_date, conversion_first_date, registration_first_date = get_incremental_first_dates(
+            watermark['last_datetime'], params['cohort_conversion_max_lag_days']
+        )
+        with instrumentation.span('read recent clients') as record:
+            df = storage.read_intermediate('customer_funnel', min_partition=storage.get_partition(registration_first_date))
+            record['rows'] = len(df)
+
+        # The dates of the cohort still start on the first registration
+        first_partition = storage.read_partitions('customer_funnel')['partitions'][0]['partition']
+        first_date = storage.read_intermediate('customer_funnel', ['account_registration_dt'], max_partition=first_partition)['account_registration_dt'].min()
+
+    df_final_cohort = get_customer_cohort_dataframe(
+        df, params['cohort_sparse'], params['cohort_max_lag_days'], cohort_first_date, params['backend'], params['duckdb_memory_limit'], params['now'],
+        first_date
+    )
+
+    outputs = {
+        'customer_datasource_cohort': df_final_cohort,
+    }
+    if params['cohort_sparse']:
+        with instrumentation.span('denominators'):
+            df_denominators = get_all_denominators_dataframe(df)
+            if cohort_first_date is not None:
+                df_denominators = df_denominators[~storage.get_values_before(df_denominators['status_datetime_from'], cohort_first_date)]
+            outputs['customer_datasource_cohort_denominators'] = df_denominators
+    if params['cohort_conversion_max_lag_days'] is not None:
+        outputs.update(get_conversion_dataframes(df, params['cohort_conversion_max_lag_days'], params['now'], conversion_first_date))
+
+    return outputs
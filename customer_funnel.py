@@ -0,0 +1,163 @@
+"""
+This script builds the funnel table shared by the cohort and acquisition funnel stages.
+
+The datetime of each funnel stage is parsed only once into a typed timestamp column (including the
+analysis datetime, which is the approval datetime or, if the client was denied, the denial datetime),
+so the stages consuming it don't have to parse or derive the same columns again.
+"""
+
+import pandas as pd
+import numpy as np
+import storage
+import instrumentation
+
+
+# Funnel stages in order: datetime column and status name
+FUNNEL_STAGES = [
+    ("account_registration_dt", "Account registered"),
+    ("account_email_confirmation_dt", "Email confirmed"),
+    ("client_registration_dt", "Client registered"),
+    ("client_analysis_dt", "Client analyzed (approved or denied)"),
+    ("client_initial_deposit_dt", "Initial deposit"),
+]
+
+# Format of the datetime columns on the customer_datasource.csv file
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Maximum number of days between consecutive funnel stages of a client (see customer_registration.py)
+MAX_STAGE_DAYS = 14
+
+# Maximum number of days between the account registration and the last funnel stage of a client
+MAX_FUNNEL_DAYS = 4 * MAX_STAGE_DAYS
+
+
+def get_client_analysis_dt(df):
+    """
+    Function to return the analyzed datetime of every client (approval datetime, or denial datetime if not approved)
+    @param df <pandas DataFrame>: dataframe containing customer registration data (base file)
+    """
+    # Similar to:
+    # SELECT COALESCE(client_approval_dt, client_denial_dt) AS client_analysis_dt
+    # FROM df
+    client_approval_dt = pd.to_datetime(df["client_approval_dt"], format=DATETIME_FORMAT)
+    client_denial_dt = pd.to_datetime(df["client_denial_dt"], format=DATETIME_FORMAT)
+
+    return client_approval_dt.fillna(client_denial_dt)
+
+
+def get_customer_funnel_dataframe(df):
+    """
+    Function to return the funnel table: client id and a typed timestamp column for each funnel stage
+    The index of the base file is kept, so rows can still be traced back to it
+    @param df <pandas DataFrame>: dataframe containing customer registration data (base file)
+    """
+    df_funnel = pd.DataFrame({"id": df["id"]}, index=df.index)
+    for columnname_date, status in FUNNEL_STAGES:
+        with instrumentation.span('parse ' + columnname_date) as record:
+            if columnname_date == "client_analysis_dt":
+                df_funnel[columnname_date] = get_client_analysis_dt(df)
+            else:
+                df_funnel[columnname_date] = pd.to_datetime(df[columnname_date], format=DATETIME_FORMAT)
+            record['rows'] = int(df_funnel[columnname_date].notnull().sum())
+
+    return df_funnel
+
+
+def get_funnel_day_numbers(df):
+    """
+    Function to parse the funnel stage datetime columns once into integer day numbers
+    Returns a (clients x stages) int32 matrix of days since 1970-01-01 and a matrix flagging which values exist
+    @param df <pandas DataFrame>: funnel table or customer registration data (base file)
+    """
+    stage_days = np.zeros((len(df), len(FUNNEL_STAGES)), dtype=np.int32)
+    stage_exists = np.zeros((len(df), len(FUNNEL_STAGES)), dtype=bool)
+    for stage, (columnname_date, status) in enumerate(FUNNEL_STAGES):
+        stage_datetimes = pd.to_datetime(df[columnname_date]).to_numpy(dtype='datetime64[D]')
+        stage_exists[:, stage] = ~np.isnat(stage_datetimes)
+        stage_days[:, stage] = np.where(stage_exists[:, stage], stage_datetimes.astype(np.int64), 0)
+
+    return stage_days, stage_exists
+
+
+def get_day_number_strings(first_day, num_of_days):
+    """
+    Function to format a range of day numbers (days since 1970-01-01) as '%Y-%m-%d' strings
+    @param first_day <int>: first day number
+    @param num_of_days <int>: number of days in the range
+    """
+    return np.datetime_as_string(np.arange(first_day, first_day + num_of_days).astype('datetime64[D]')).astype(object)
+
+
+def get_day_categorical(day_offsets, first_day, num_of_days):
+    """
+    Function to return day numbers as a categorical column of '%Y-%m-%d' strings, so each date is stored
+    only once (as a category) and rows only keep a small integer code, until the file is exported
+    @param day_offsets <numpy array>: days since first_day (-1 for missing dates)
+    @param first_day <int>: first day number (days since 1970-01-01)
+    @param num_of_days <int>: number of days in the range of categories
+    """
+    return pd.Categorical.from_codes(day_offsets, categories=get_day_number_strings(first_day, num_of_days))
+
+
+def get_status_categorical(stages):
+    """
+    Function to return funnel stage indexes as a categorical column of status names
+    @param stages <numpy array>: index of the stage on FUNNEL_STAGES of each row
+    """
+    return pd.Categorical.from_codes(stages, categories=[status for columnname_date, status in FUNNEL_STAGES])
+
+
+def get_open_funnel_start(last_datetime):
+    """
+    Function to return the first day of the month of the oldest account registration that can still reach new
+    funnel stages after a datetime (the last stage is reached at most MAX_FUNNEL_DAYS after the registration),
+    so incremental runs only rebuild the customers registered from that day on
+    @param last_datetime <datetime>: datetime until when data was generated
+    """
+    return storage.get_month_start(pd.Timestamp(last_datetime) - pd.Timedelta(days=MAX_FUNNEL_DAYS))
+
+
+def create_customer_funnel_file():
+    """
+    Function to create the funnel table file shared by the cohort and acquisition funnel stages
+    """
+    print("Creating new customer_funnel file...")
+
+    # reads information from the datasource file
+    df = storage.read_intermediate('customer_datasource')
+
+    # Output the funnel table as an intermediate file only (it's not used by Tableau)
+    storage.write_output(get_customer_funnel_dataframe(df), 'customer_funnel', intermediate=True, export=False)
+
+    print("New customer_funnel file done!")
+
+
+# Pipeline stage declaration (see pipeline.py)
+# Internal outputs are only written as intermediate files, not exported to Tableau
+# Partitioned outputs are written by month of a column, in incremental runs their rows replace the partitions from their first month on
+STAGE_INPUTS = ['customer_datasource']
+STAGE_OUTPUTS = ['customer_funnel']
+STAGE_INTERNAL_OUTPUTS = ['customer_funnel']
+STAGE_PARTITIONED_OUTPUTS = {'customer_funnel': 'account_registration_dt'}
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    In incremental runs, only the customers rebuilt by the registration stage (the partitions from the month of the
+    open funnels on) are read and parsed again
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    df = frames['customer_datasource']
+
+    watermark = params['watermark']
+    if watermark is not None:
+        open_funnel_partition = storage.get_partition(get_open_funnel_start(watermark['last_datetime']))
+        with instrumentation.span('read open customers') as record:
+            df = storage.read_intermediate('customer_datasource', min_partition=open_funnel_partition)
+            record['rows'] = len(df)
+
+    return {
+        'customer_funnel': get_customer_funnel_dataframe(df),
+    }
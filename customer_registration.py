@@ -3,9 +3,50 @@ This script creates the first source (output/customer_datasource.csv) file conta
 all customers basic information and registration statuses.
 """
 
+import json
+import math
+import os
 import pandas as pd
 import numpy as np
-from faker import Faker
+from datetime import datetime
+import storage
+import export
+import instrumentation
+import parallel
+from customer_funnel import MAX_STAGE_DAYS, get_open_funnel_start
+
+
+# Average month length used by Faker when parsing "-{n}M" date strings
+DAYS_PER_MONTH = 30.42
+
+# Default number of customers generated per batch and size of the faker address pool
+DEFAULT_BATCH_SIZE = 100000
+DEFAULT_POOL_SIZE = 10000
+
+# Faker locale of the value pools
+DEFAULT_LOCALE = 'en_US'
+
+# Number of faker draws used to collect the first and last names of the locale
+NAME_SAMPLES = 20000
+
+# Folder inside the output folder where the faker value pools are cached
+POOLS_FOLDER = '.pools'
+
+# Faker instances by locale, created only once per process (see get_faker)
+FAKERS = {}
+
+
+def get_faker(locale=DEFAULT_LOCALE):
+    """
+    Function to return the faker instance of a locale, created only once per process
+    Faker is only imported here, so runs using cached value pools never load it
+    @param locale <string>: faker locale
+    """
+    if locale not in FAKERS:
+        from faker import Faker
+        FAKERS[locale] = Faker([locale])
+
+    return FAKERS[locale]
 
 
 def create_new_random_user(account_id, months_back):
@@ -18,8 +59,8 @@ def create_new_random_user(account_id, months_back):
     @param months_back <int>: how many months back the client registered the account
     """
     
-    # Create a new faker instance
-    fake = Faker(['en_US'])
+    # Shared faker instance (unique names are tracked across calls)
+    fake = get_faker()
 
     # Set initial statuses and dates
     status = "Account registered"
@@ -94,26 +135,457 @@ def create_new_random_user(account_id, months_back):
     return user
 
 
-def create_customer_registration_file(number_of_customers, months_back):
+def create_faker_value_pools(pool_size=DEFAULT_POOL_SIZE, seed=None, locale=DEFAULT_LOCALE):
+    """
+    Function to generate pools of first names, last names and addresses with faker
+    Also draws the parameters of the permutation used to give every account id a unique name (see get_unique_names)
+    @param pool_size <int>: number of addresses generated
+    @param seed <int>: seed used by faker (None for a random pool)
+    @param locale <string>: faker locale
+    """
+    fake = get_faker(locale)
+    if seed is not None:
+        fake.seed_instance(seed)
+
+    # Faker names are weighted, so they are drawn many times to get (almost) all of them
+    pools = {
+        'first_name': sorted(set(fake.first_name() for i in range(NAME_SAMPLES))),
+        'last_name': sorted(set(fake.last_name() for i in range(NAME_SAMPLES))),
+        'address': [fake.address() for i in range(pool_size)],
+    }
+
+    # Multiplier must be coprime with the number of names, so the permutation is a bijection
+    num_of_names = len(pools['first_name']) * len(pools['first_name']) * len(pools['last_name'])
+    rng = np.random.default_rng(seed)
+    name_multiplier = int(rng.integers(1, num_of_names))
+    while math.gcd(name_multiplier, num_of_names) != 1:
+        name_multiplier = name_multiplier % (num_of_names - 1) + 1
+    pools['name_multiplier'] = name_multiplier
+    pools['name_offset'] = int(rng.integers(0, num_of_names))
+
+    return pools
+
+
+def get_faker_value_pools(pool_size=DEFAULT_POOL_SIZE, seed=None, locale=DEFAULT_LOCALE):
+    """
+    Function to return pools of names and addresses, so batches can sample from them instead of calling
+    faker once per customer
+    Pools are generated once and cached on output/.pools (by locale, seed and pool size), so next runs
+    don't call faker at all. Without seed, the first pool generated is reused by every run
+    @param pool_size <int>: number of addresses generated
+    @param seed <int>: seed used by faker (None for a random pool)
+    @param locale <string>: faker locale
+    """
+    pools_path = os.path.join(
+        storage.get_output_path(POOLS_FOLDER),
+        '{}_{}_{}.json'.format(locale, 'noseed' if seed is None else seed, pool_size)
+    )
+    if os.path.exists(pools_path):
+        with open(pools_path) as pools_file:
+            pools = json.load(pools_file)
+    else:
+        pools = create_faker_value_pools(pool_size, seed, locale)
+        os.makedirs(os.path.dirname(pools_path), exist_ok=True)
+        with open(pools_path + '.tmp', 'w') as pools_file:
+            json.dump(pools, pools_file)
+        os.replace(pools_path + '.tmp', pools_path)
+
+    for pool in ['first_name', 'last_name', 'address']:
+        pools[pool] = np.array(pools[pool], dtype=object)
+
+    return pools
+
+
+def get_unique_names(ids, pools):
+    """
+    Function to return a unique name (first name, middle name and last name) for every account id
+    Ids are shuffled by an affine permutation (multiplier * id + offset modulo the number of names) and
+    decoded as mixed-radix numbers into the name pools, so no name repeats without tracking the names used
+    Ids beyond the number of names get a numeric suffix (e.g. "John Paul Smith 2"), so names are always unique
+    @param ids <numpy array>: account ids
+    @param pools <dict>: faker value pools (see get_faker_value_pools)
+    """
+    first_names, last_names = pools['first_name'], pools['last_name']
+    num_of_names = len(first_names) * len(first_names) * len(last_names)
+
+    # Unsigned integers, so the product doesn't overflow even with large name pools
+    ids = np.asarray(ids, dtype=np.uint64)
+    keys = (np.uint64(pools['name_multiplier']) * (ids % np.uint64(num_of_names)) + np.uint64(pools['name_offset'])) % np.uint64(num_of_names)
+    keys = keys.astype(np.int64)
+
+    names = (
+        first_names[keys % len(first_names)] + ' '
+        + first_names[(keys // len(first_names)) % len(first_names)] + ' '
+        + last_names[keys // (len(first_names) * len(first_names))]
+    )
+
+    cycles = (ids // np.uint64(num_of_names)).astype(np.int64)
+    if cycles.any():
+        names = np.where(cycles > 0, names + ' ' + (cycles + 1).astype(str).astype(object), names)
+
+    return names
+
+
+def get_epoch_seconds(value):
+    """
+    Function to return a datetime as whole epoch seconds
+    @param value <datetime>: datetime to be converted
+    """
+    return int(pd.Timestamp(value).timestamp())
+
+
+def get_registration_window_seconds(months_back):
+    """
+    Function to return the length in seconds of the window in which the accounts of a full run register
+    @param months_back <int>: how many months back the client registered the account
+    """
+    return int(months_back * DAYS_PER_MONTH * 24 * 60 * 60)
+
+
+def get_registration_start(months_back, now):
+    """
+    Function to return the default start of the account registrations: months_back before now
+    @param months_back <int>: how many months back the client registered the account
+    @param now <datetime>: current datetime
+    """
+    return pd.Timestamp(get_epoch_seconds(now) - get_registration_window_seconds(months_back), unit='s').to_pydatetime()
+
+
+def get_registration_seconds(ids, entropy, start, number_of_customers, months_back):
+    """
+    Function to return the account registration datetime (in epoch seconds) of every account id
+    Accounts register in id order at a constant rate (number_of_customers every months_back): the window after start
+    is split into number_of_customers intervals and account i registers at a random second of the i-th one (intervals
+    repeat after the window), so every account keeps its registration datetime on every run
+    @param ids <numpy array>: account ids
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param start <datetime>: start of the account registrations
+    @param numer_of_customers <int>: amount of customers registering every months_back
+    @param months_back <int>: how many months back the client registered the account
+    """
+    window_seconds = get_registration_window_seconds(months_back)
+    offsets = (parallel.get_id_random(entropy, ids, 'account_registration') * window_seconds).astype(np.int64)
+
+    return get_epoch_seconds(start) + (ids.astype(np.int64) * window_seconds + offsets) // number_of_customers
+
+
+def get_number_of_customers(entropy, start, number_of_customers, months_back, end):
+    """
+    Function to return how many accounts registered before a datetime (accounts register in id order,
+    so they are the ids from 0 up to the number returned, exclusive)
+    (parameters are the same as get_registration_seconds)
+    @param end <datetime>: datetime until when accounts are counted (exclusive)
+    """
+    elapsed_seconds = get_epoch_seconds(end) - get_epoch_seconds(start)
+    if elapsed_seconds <= 0:
+        return 0
+
+    # Accounts before this id registered in earlier intervals and accounts after it in later ones,
+    # so only its own registration has to be checked
+    last_id = elapsed_seconds * number_of_customers // get_registration_window_seconds(months_back)
+    last_registration = get_registration_seconds(np.array([last_id]), entropy, start, number_of_customers, months_back)[0]
+
+    return int(last_id + (last_registration < get_epoch_seconds(end)))
+
+
+def get_random_birthdates(entropy, ids, account_registration):
+    """
+    Function to draw random birthdates from the beginning of the century until the account registration, as '%Y-%m-%d' strings
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param ids <numpy array>: account ids
+    @param account_registration <numpy array>: account registration datetimes in epoch seconds
+    """
+    first_day = np.datetime64('2000-01-01', 'D').astype(np.int64)
+    last_days = account_registration // (24 * 60 * 60)
+    days = first_day + (parallel.get_id_random(entropy, ids, 'birthdate') * (last_days - first_day + 1)).astype(np.int64)
+
+    return np.datetime_as_string(days.astype('datetime64[D]')).astype(object)
+
+
+def get_random_flags(entropy, ids, stream):
+    """
+    Function to draw a random boolean (50% chance) for every account id
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param ids <numpy array>: account ids
+    @param stream <string>: name of the random value (see parallel.get_id_random)
+    """
+    return parallel.get_id_random(entropy, ids, stream) < 0.5
+
+
+def get_random_datetimes_after(entropy, ids, stream, datetime_start):
+    """
+    Function to draw one random datetime (in epoch seconds) within MAX_STAGE_DAYS after each start datetime
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param ids <numpy array>: account ids
+    @param stream <string>: name of the random value (see parallel.get_id_random)
+    @param datetime_start <numpy array>: start datetimes in epoch seconds
+    """
+    return datetime_start + (parallel.get_id_random(entropy, ids, stream) * MAX_STAGE_DAYS * 24 * 60 * 60).astype(np.int64)
+
+
+def format_epoch_seconds(seconds, mask):
+    """
+    Function to format an array of epoch seconds as '%Y-%m-%d %H:%M:%S' strings
+    Positions outside the mask are returned as null values
+    @param seconds <numpy array>: datetimes in epoch seconds
+    @param mask <numpy array>: boolean array, True where the datetime exists
+    """
+    formatted = pd.Series(pd.to_datetime(seconds, unit='s')).dt.strftime('%Y-%m-%d %H:%M:%S')
+    return formatted.where(mask, None)
+
+
+def get_random_users_batch(ids, entropy, pools, start, number_of_customers, months_back, now):
+    """
+    Function to create a batch of random users at once
+    It follows the same registration workflow as create_new_random_user, but every
+    funnel outcome and datetime is drawn for the whole batch as numpy arrays
+    New Account > Confirm email > New Client Info > Approve / Deny > Initial Deposit
+    Every value is drawn from the account id (see parallel.get_id_random), and each stage happens within
+    MAX_STAGE_DAYS after the previous one, if it happened before now: running again with a later now gives
+    the same accounts, only further along the funnel
+
+    @param ids <numpy array>: ids of the accounts in the batch
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param pools <dict>: faker value pools (see get_faker_value_pools)
+    @param start <datetime>: start of the account registrations
+    @param numer_of_customers <int>: amount of customers registering every months_back
+    @param months_back <int>: how many months back the client registered the account
+    @param now <datetime>: datetime until when the funnel stages happened
+    """
+    now_seconds = get_epoch_seconds(now)
+
+    # Registration datetime for every account
+    account_registration = get_registration_seconds(ids, entropy, start, number_of_customers, months_back)
+
+    # Randomly sets if client confirmed email
+    account_email_confirmation = get_random_datetimes_after(entropy, ids, 'account_email_confirmation', account_registration)
+    has_email_confirmation = get_random_flags(entropy, ids, 'has_email_confirmation') & (account_email_confirmation < now_seconds)
+
+    # Randomly sets if client finished registration
+    client_registration = get_random_datetimes_after(entropy, ids, 'client_registration', account_email_confirmation)
+    has_client_registration = has_email_confirmation & get_random_flags(entropy, ids, 'has_client_registration') & (client_registration < now_seconds)
+
+    # Randomly sets if client was approved
+    client_approval = get_random_datetimes_after(entropy, ids, 'client_approval', client_registration)
+    has_client_approval = has_client_registration & get_random_flags(entropy, ids, 'has_client_approval') & (client_approval < now_seconds)
+
+    # Randomly sets if client was denied
+    client_denial = get_random_datetimes_after(entropy, ids, 'client_denial', client_registration)
+    has_client_denial = has_client_approval & get_random_flags(entropy, ids, 'has_client_denial') & (client_denial < now_seconds)
+
+    # Randomly sets initial deposit (only for approved clients)
+    client_initial_deposit = get_random_datetimes_after(entropy, ids, 'client_initial_deposit', client_approval)
+    has_client_initial_deposit = has_client_approval & get_random_flags(entropy, ids, 'has_client_initial_deposit') & (client_initial_deposit < now_seconds)
+
+    # Last status reached by each client (same precedence as create_new_random_user)
+    status = np.select(
+        [
+            has_client_initial_deposit | has_client_denial,
+            has_client_approval,
+            has_client_registration,
+            has_email_confirmation,
+        ],
+        [
+            "Client denied",
+            "Client approved",
+            "Client registered",
+            "Email confirmed",
+        ],
+        default="Account registered"
+    )
+
+    # Unique names by account id, addresses sampled from the pool and random birthdates
+    addresses = (parallel.get_id_random(entropy, ids, 'address') * len(pools['address'])).astype(np.int64)
+    df = pd.DataFrame({
+        'id': ids,
+        'name': get_unique_names(ids, pools),
+        'address': pools['address'][addresses],
+        'birthdate': get_random_birthdates(entropy, ids, account_registration),
+        'status': status,
+        'account_registration_dt': format_epoch_seconds(account_registration, np.ones(len(ids), dtype=bool)),
+        'account_email_confirmation_dt': format_epoch_seconds(account_email_confirmation, has_email_confirmation),
+        'client_registration_dt': format_epoch_seconds(client_registration, has_client_registration),
+        'client_approval_dt': format_epoch_seconds(client_approval, has_client_approval),
+        'client_denial_dt': format_epoch_seconds(client_denial, has_client_denial),
+        'client_initial_deposit_dt': format_epoch_seconds(client_initial_deposit, has_client_initial_deposit),
+    })
+
+    return df
+
+
+def iter_customer_registration_chunks(number_of_customers, months_back, batch_size=DEFAULT_BATCH_SIZE, seed=None, entropy=None,
+                                      start=None, now=None, first_id=0, workers=1):
+    """
+    Generator of dataframes with the fake customers registered before now and their registration datetimes, one batch at a time
+    Values are drawn from the account ids, so the same seed (or entropy) always creates the same customers,
+    no matter the batch size, how many workers are used or which ids are generated
+
+    @param numer_of_customers <int>: amount of customers registering every months_back
+    @param months_back <int>: how many months back the client registered the account
+    @param batch_size <int>: amount of customers generated at once (rows per chunk)
+    @param seed <int>: seed of the faker value pools and, if no entropy is given, of the random values (None for a random dataset)
+    @param entropy <int>: global entropy of the random values (see parallel.get_seed_entropy)
+    @param start <datetime>: start of the account registrations (defaults to months_back before now)
+    @param now <datetime>: datetime until when customers registered and reached funnel stages (defaults to current datetime)
+    @param first_id <int>: id of the first account generated (older accounts are skipped)
+    @param workers <int>: number of processes generating batches at the same time
+    """
+    # Create random users in batches, sampling faker values from pre-generated pools
+    if entropy is None:
+        entropy = parallel.get_seed_entropy(seed)
+    with instrumentation.span('faker pools'):
+        pools = get_faker_value_pools(seed=seed)
+    if now is None:
+        now = datetime.now()
+    if start is None:
+        start = get_registration_start(months_back, now)
+    last_id = get_number_of_customers(entropy, start, number_of_customers, months_back, now)
+    shards_args = (
+        (np.arange(offset, min(offset + batch_size, last_id)), entropy, pools, start, number_of_customers, months_back, now)
+        for offset in range(first_id, max(last_id, first_id + 1), batch_size)
+    )
+
+    yield from parallel.imap_shards(get_random_users_batch, shards_args, workers)
+
+
+def get_customer_registration_dataframe(number_of_customers, months_back, batch_size=DEFAULT_BATCH_SIZE, seed=None,
+                                        now=None, first_id=0, workers=1):
+    """
+    Function to create a dataframe containing all fake customers and registration datetimes
+
+    @param numer_of_customers <int>: amount of fake customers to create
+    @param months_back <int>: how many months back the client registered the account
+    @param batch_size <int>: amount of customers generated at once
+    @param seed <int>: seed for the random generators (None for a random dataset)
+    @param now <datetime>: end datetime for all random datetimes (defaults to current datetime)
+    @param first_id <int>: id of the first account
+    @param workers <int>: number of processes generating batches at the same time
+    """
+    batches = iter_customer_registration_chunks(number_of_customers, months_back, batch_size, seed, now=now, first_id=first_id, workers=workers)
+
+    # Creates a dataframe based on the user batches
+    df = pd.concat(objs=list(batches), ignore_index=True)
+
+    return df
+
+
+def create_customer_registration_file(number_of_customers, months_back, batch_size=DEFAULT_BATCH_SIZE, seed=None, streaming=False, workers=1):
     """
     Function to create a new file (customer_datasource.csv) into the output folder
     containing all fake customers and registration datetimes
     
     @param numer_of_customers <int>: amount of fake customers to create
     @param months_back <int>: how many months back the client registered the account
+    @param batch_size <int>: amount of customers generated at once
+    @param seed <int>: seed for the random generators (None for a random dataset)
+    @param streaming <bool>: if True, each batch is written as soon as it's created, so memory
+        usage doesn't grow with the number of customers
+    @param workers <int>: number of processes generating batches at the same time
     """    
 
     print("Creating new customer_datasource.csv with {} customers, {} months back...".format(number_of_customers, months_back))
 
-    # Create list of random users
-    users_list = []
-    for i in range(number_of_customers):
-        users_list.append(create_new_random_user(i, months_back))
+    # Customers and their transactions (see customer_transactions.py) share the same random values
+    now = datetime.now()
+    dataset_params = get_dataset_params(number_of_customers, months_back, seed, parallel.get_seed_entropy(seed), now)
+    batches = iter_customer_registration_chunks(
+        number_of_customers, months_back, batch_size, seed, dataset_params['entropy'], dataset_params['start'], now, workers=workers
+    )
+    if streaming:
+        # Create and output random users one batch at a time
+        storage.write_output_partitions(batches, 'customer_datasource', 'account_registration_dt')
+    else:
+        # Create random users
+        df = pd.concat(objs=list(batches), ignore_index=True)
+
+        # Output result to a csv file (and to an intermediate file read by the next stages)
+        storage.write_partitioned_output(df, 'customer_datasource', 'account_registration_dt')
 
-    # Creates a dataframe based on the user list
-    df = pd.DataFrame(users_list)
+    storage.write_watermark(now, dataset_params)
 
-    # Output result to a csv file
-    df.to_csv('output/customer_datasource.csv')
+    print("New file customer_datasource.csv done!")
 
-    print("New file customer_datasource.csv done!")
\ No newline at end of file
+
+def get_dataset_params(number_of_customers, months_back, seed, entropy, now, start=None):
+    """
+    Function to return the parameters defining a generated dataset, kept on the watermark so incremental runs
+    generate the same customers (with the same random values) further in time
+    @param numer_of_customers <int>: amount of customers registering every months_back
+    @param months_back <int>: how many months back the client registered the account
+    @param seed <int>: seed of the faker value pools
+    @param entropy <int>: global entropy of the random values (see parallel.get_seed_entropy)
+    @param now <datetime>: datetime of the full run
+    @param start <datetime>: start of the account registrations (defaults to months_back before now)
+    """
+    # Registration times are spread over the months back window by customer (see get_registration_seconds)
+    if number_of_customers < 1:
+        raise ValueError("number_of_customers must be at least 1, got {}".format(number_of_customers))
+    if months_back <= 0:
+        raise ValueError("months_back must be positive, got {}".format(months_back))
+    if start is not None and start >= now:
+        raise ValueError("start ({}) must be before now ({})".format(start, now))
+
+    return {
+        'number_of_customers': number_of_customers,
+        'months_back': months_back,
+        'seed': seed,
+        'entropy': entropy,
+        'start': get_registration_start(months_back, now) if start is None else start,
+    }
+
+
+# Pipeline stage declaration (see pipeline.py)
+# Partitioned outputs are written by month of a column, in incremental runs their rows replace the partitions from their first month on
+# Random stages are only cached (see stage_cache.py) when a seed is given
+STAGE_INPUTS = []
+STAGE_OUTPUTS = ['customer_datasource']
+STAGE_PARTITIONED_OUTPUTS = {'customer_datasource': 'account_registration_dt'}
+STAGE_RANDOM = True
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    In incremental runs, the customers registered before the month of the open funnels can't change (see
+    customer_funnel.get_open_funnel_start), only the ones from that month on are generated again, with the
+    funnel stages reached until now, plus the new customers
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    first_id = 0
+    watermark = params['watermark']
+    if watermark is not None:
+        first_id = get_number_of_customers(
+            params['entropy'], params['start'], params['number_of_customers'], params['months_back'],
+            get_open_funnel_start(watermark['last_datetime'])
+        )
+
+    batches = iter_customer_registration_chunks(
+        params['number_of_customers'],
+        params['months_back'],
+        params['chunk_size'] or DEFAULT_BATCH_SIZE,
+        seed=params['seed'],
+        entropy=params['entropy'],
+        start=params['start'],
+        now=params['now'],
+        first_id=first_id,
+        workers=params['generation_workers']
+    )
+
+    # In streaming mode the output is written here, one batch at a time
+    if params['chunk_size']:
+        with instrumentation.span('generate and write') as record:
+            record['rows'] = storage.write_output_partitions(
+                batches, 'customer_datasource', 'account_registration_dt', watermark is not None, export_options=export.get_export_options(params)
+            )
+        return {
+            'customer_datasource': None,
+        }
+
+    with instrumentation.span('generate') as record:
+        df = pd.concat(objs=list(batches), ignore_index=True)
+        record['rows'] = len(df)
+
+    return {
+        'customer_datasource': df,
+    }
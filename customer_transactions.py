@@ -1,67 +1,204 @@
 import pandas as pd
-import random
-import decimal
+import numpy as np
 from datetime import datetime
-from faker import Faker
+import storage
+import export
+import instrumentation
+import parallel
+from customer_funnel import MAX_FUNNEL_DAYS
 
 
-def create_customer_transactions_file():
+# Transactions amounts range in cents (same as random.randrange(15500, 38900))
+MIN_AMOUNT_CENTS = 15500
+MAX_AMOUNT_CENTS = 38900
+
+# Maximum number of extra transactions after the initial deposit (exclusive)
+MAX_NUM_OF_TRANSACTIONS = 10
+
+# Maximum number of days between the initial deposit and the extra transactions of a client
+MAX_TRANSACTION_DAYS = 180
+
+# Default number of customers per shard
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def get_transactions_dataframe(df, entropy, now=None, min_datetime=None):
+    """
+    Function to generate the initial deposit and the fake transactions after it for every client
+    All values are drawn at once as numpy arrays: transaction counts per client, datetimes within
+    MAX_TRANSACTION_DAYS after each initial deposit (only the ones before now already happened) and amounts
+    in integer cents. Values are drawn from the client id and the transaction number (see parallel.get_id_random),
+    so every transaction keeps its datetime and amount on every run
+    @param df <pandas DataFrame>: dataframe from the customer_datasource.csv file
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param now <datetime>: end datetime for the fake transactions (defaults to current datetime)
+    @param min_datetime <datetime>: if set, only transactions on or after this datetime are returned
+    """
+    if now is None:
+        now = datetime.now()
+    now_seconds = int(pd.Timestamp(now).timestamp())
+
+    # Gets the initial deposit datetimes since this is supposed to be
+    # the first transaction of a customer
+    df_initial_deposit = df[df['client_initial_deposit_dt'].notnull()][['id', 'client_initial_deposit_dt']]
+    client_ids = df_initial_deposit['id'].to_numpy()
+    initial_deposit_seconds = pd.to_datetime(df_initial_deposit['client_initial_deposit_dt']).to_numpy(dtype='datetime64[s]').astype(np.int64)
+
+    # Generate a random number of transactions (up to 10) for each client
+    # and repeat the client info once per transaction
+    num_of_transactions = (parallel.get_id_random(entropy, client_ids, 'num_of_transactions') * MAX_NUM_OF_TRANSACTIONS).astype(np.int64)
+    transaction_ids = np.repeat(client_ids, num_of_transactions)
+    transaction_start_seconds = np.repeat(initial_deposit_seconds, num_of_transactions)
+
+    # Transactions are numbered within each client (0 is the initial deposit), so each one has its own random values
+    transaction_numbers = np.arange(1, len(transaction_ids) + 1) - np.repeat(np.cumsum(num_of_transactions) - num_of_transactions, num_of_transactions)
+    transaction_keys = transaction_ids.astype(np.int64) * MAX_NUM_OF_TRANSACTIONS + transaction_numbers
+
+    # Random datetimes within MAX_TRANSACTION_DAYS after the initial deposit
+    transaction_seconds = transaction_start_seconds + (
+        parallel.get_id_random(entropy, transaction_keys, 'transaction_datetime') * MAX_TRANSACTION_DAYS * 24 * 60 * 60
+    ).astype(np.int64)
+
+    # Union initial deposits and fake transactions
+    # Sets the type of transaction as income, this way we don't have to
+    # worry about clients with negative balances in the end (for now)
+    ids = np.concatenate([client_ids, transaction_ids])
+    seconds = np.concatenate([initial_deposit_seconds, transaction_seconds])
+    keys = np.concatenate([client_ids.astype(np.int64) * MAX_NUM_OF_TRANSACTIONS, transaction_keys])
+    amount_cents = MIN_AMOUNT_CENTS + (parallel.get_id_random(entropy, keys, 'amount') * (MAX_AMOUNT_CENTS - MIN_AMOUNT_CENTS)).astype(np.int64)
+
+    # Only the transactions that already happened (since the min datetime)
+    happened = seconds < now_seconds
+    if min_datetime is not None:
+        happened &= seconds >= int(pd.Timestamp(min_datetime).timestamp())
+
+    df_final_transactions = pd.DataFrame({
+        'id': ids[happened],
+        'transaction_datetime': pd.Series(seconds[happened].astype('datetime64[s]')).dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'operation': "Income",
+        'amount': amount_cents[happened] / 100,
+    })
+
+    return df_final_transactions
+
+
+def iter_dataframe_chunks(df, chunk_size):
+    """
+    Generator of consecutive chunks of a dataframe
+    @param df <pandas DataFrame>: dataframe to be split
+    @param chunk_size <int>: maximum number of rows on each chunk
+    """
+    for offset in range(0, max(len(df), 1), chunk_size):
+        yield df.iloc[offset:offset + chunk_size]
+
+
+def iter_transactions_chunks(df_chunks, entropy, now=None, min_datetime=None, workers=1):
+    """
+    Generator of dataframes with the fake transactions, one chunk of customers at a time
+    Values are drawn from the client ids, so the same entropy always creates the same transactions,
+    no matter how customers are split into chunks or how many workers are used
+    @param df_chunks <iterable>: chunks of the customer_datasource.csv file
+    @param entropy <int>: global entropy (see parallel.get_seed_entropy)
+    @param now <datetime>: end datetime for the fake transactions (defaults to current datetime)
+    @param min_datetime <datetime>: if set, only transactions on or after this datetime are generated
+    @param workers <int>: number of processes generating transactions at the same time
+    """
+    if now is None:
+        now = datetime.now()
+    shards_args = ((df, entropy, now, min_datetime) for df in df_chunks)
+
+    yield from parallel.imap_shards(get_transactions_dataframe, shards_args, workers)
+
+
+def create_customer_transactions_file(chunk_size=None, workers=1):
     """
     Function responsible for generating a file (customer_transactions.csv) containing fake transactions
     to be used in customer activity related analysis
+    Transactions use the random values and datetime of the customer_datasource.csv file (kept on its watermark)
+    @param chunk_size <int>: if set, customers are read, and their transactions generated and written,
+        this many customers at a time, so memory usage doesn't grow with the number of transactions
+    @param workers <int>: number of processes generating transactions at the same time
     """
     print("Creating new customer_transactions.csv...")
 
-    # Reads original customer datasource
-    df = pd.read_csv('output/customer_datasource.csv')
+    watermark = storage.read_watermark()
+    entropy, now = watermark['dataset']['entropy'], watermark['last_datetime']
 
-    # Create a new faker object to be used later
-    fake = Faker(['en_US'])
+    if chunk_size:
+        # Reads customer datasource, generates and outputs the transactions one chunk at a time
+        df_chunks = storage.iter_intermediate_chunks('customer_datasource', ['id', 'client_initial_deposit_dt'], chunk_size)
+        storage.write_output_chunks(iter_transactions_chunks(df_chunks, entropy, now, workers=workers), 'customer_transactions')
+    else:
+        # Reads original customer datasource
+        df = storage.read_intermediate('customer_datasource', columns=['id', 'client_initial_deposit_dt'])
 
-    # Gets the initial deposit datetimes since this is supposed to be 
-    # the first transaction of a customer
-    df_initial_deposit = df[df['client_initial_deposit_dt'].notnull()][['id', 'client_initial_deposit_dt']]
-    df_initial_deposit.rename(columns={'client_initial_deposit_dt': 'transaction_datetime'}, inplace=True)
+        # Generate initial deposits and fake transactions
+        df_chunks = iter_dataframe_chunks(df, DEFAULT_CHUNK_SIZE)
+        df_final_transactions = pd.concat(objs=list(iter_transactions_chunks(df_chunks, entropy, now, workers=workers)), ignore_index=True)
 
-    # Sets the type of transaction as income, this way we don't have to
-    # worry about clients with negative balances in the end (for now)
-    df_initial_deposit['operation'] = "Income"
-
-    # Sets a random value to the transaction
-    df_initial_deposit['amount'] = df_initial_deposit.apply(
-        lambda row: float(decimal.Decimal(random.randrange(15500, 38900))/100),
-        axis = 1
-    )
-
-    # Creates a new set of transactions after the initial deposit
-    transaction_list = []
-    # For each client with initial deposit
-    for ix, row in df_initial_deposit.iterrows():        
-        # Generate a random number of transactions (up to 10)
-        num_of_transactions = random.randrange(0,10)
-        for i in range(0, num_of_transactions, 1):
-            # Create a new transaction dictionary
-            transaction_row = {        
-                'id': row.id,
-                'transaction_datetime': fake.date_time_between_dates(
-                    datetime_start = datetime.strptime(row.transaction_datetime, '%Y-%m-%d %H:%M:%S')
-                ).strftime('%Y-%m-%d %H:%M:%S'),
-                'operation': "Income",
-                'amount': float(decimal.Decimal(random.randrange(15500, 38900))/100),
-            }
-            transaction_list.append(transaction_row)
-    
-    # Create a new dataframe from the list of fake transactions
-    df_fake_transactions = pd.DataFrame(data=transaction_list)
-
-    # Union both dataframes into a final one
-    objs = [
-        df_initial_deposit, 
-        df_fake_transactions
-    ]
-    df_final_transactions = pd.concat(objs=objs)
-
-    # Output the information into customer_transactions.csv
-    df_final_transactions.to_csv('output/customer_transactions.csv')
-
-    print("New file customer_transactions.csv done!")
\ No newline at end of file
+        # Output the information into customer_transactions.csv
+        storage.write_output(df_final_transactions, 'customer_transactions', intermediate=True)
+
+    print("New file customer_transactions.csv done!")
+
+
+def get_open_transactions_start(last_datetime):
+    """
+    Function to return the first day of the month of the oldest account registration that can still get new
+    transactions after a datetime (the initial deposit is at most MAX_FUNNEL_DAYS after the registration and
+    the last transaction MAX_TRANSACTION_DAYS after it)
+    @param last_datetime <datetime>: datetime until when data was generated
+    """
+    return storage.get_month_start(pd.Timestamp(last_datetime) - pd.Timedelta(days=MAX_FUNNEL_DAYS + MAX_TRANSACTION_DAYS))
+
+
+# Pipeline stage declaration (see pipeline.py)
+# In incremental runs, appended outputs only contain the new rows
+# Random stages are only cached (see stage_cache.py) when a seed is given
+STAGE_INPUTS = ['customer_datasource']
+STAGE_OUTPUTS = ['customer_transactions']
+STAGE_APPENDED_OUTPUTS = ['customer_transactions']
+STAGE_RANDOM = True
+
+
+def run_stage(frames, params):
+    """
+    Function to run this stage inside the pipeline, returning the output dataframes by name
+    In incremental runs, only the transactions since the last run are generated, from the customers
+    that can still get new transactions (registered from the month given by get_open_transactions_start on)
+    @param frames <dict>: input dataframes by name
+    @param params <dict>: pipeline parameters
+    """
+    min_datetime = None
+    min_partition = None
+    watermark = params['watermark']
+    if watermark is not None:
+        min_datetime = watermark['last_datetime']
+        min_partition = storage.get_partition(get_open_transactions_start(watermark['last_datetime']))
+
+    # In streaming mode customers are read from the intermediate file and the output is written here, one chunk at a time
+    if params['chunk_size']:
+        df_chunks = storage.iter_intermediate_chunks('customer_datasource', ['id', 'client_initial_deposit_dt'], params['chunk_size'], min_partition)
+        transactions_chunks = iter_transactions_chunks(df_chunks, params['entropy'], params['now'], min_datetime, params['generation_workers'])
+        with instrumentation.span('generate and write') as record:
+            record['rows'] = storage.write_output_chunks(transactions_chunks, 'customer_transactions', watermark is not None, export.get_export_options(params))
+        return {
+            'customer_transactions': None,
+        }
+
+    if watermark is not None:
+        with instrumentation.span('read open customers') as record:
+            df = storage.read_intermediate('customer_datasource', columns=['id', 'client_initial_deposit_dt'], min_partition=min_partition)
+            record['rows'] = len(df)
+    else:
+        df = frames['customer_datasource'][['id', 'client_initial_deposit_dt']]
+
+    df_chunks = iter_dataframe_chunks(df, DEFAULT_CHUNK_SIZE)
+    transactions_chunks = iter_transactions_chunks(df_chunks, params['entropy'], params['now'], min_datetime, params['generation_workers'])
+    with instrumentation.span('generate') as record:
+        df_final_transactions = pd.concat(objs=list(transactions_chunks), ignore_index=True)
+        record['rows'] = len(df_final_transactions)
+
+    return {
+        'customer_transactions': df_final_transactions,
+    }
@@ -0,0 +1,78 @@
+"""
+This script has the optional DuckDB backend of the cohort and activity stages.
+
+The input dataframes are registered on an embedded DuckDB database (without copying them) and the stages
+run as the SQL queries described on their "Similar to" comments, using every core, range joins for the
+date combinations and spilling joins, aggregations and sorts to disk (output/.duckdb) when they don't fit
+the memory limit. Results are fetched in chunks as compact numpy arrays, so the stages build the same
+dataframes as with the default (numpy) backend.
+"""
+
+import os
+import numpy as np
+import instrumentation
+import storage
+
+
+# Folder inside the output folder where DuckDB spills data that doesn't fit the memory limit
+TEMP_FOLDER = '.duckdb'
+
+# Number of vectors (of 2048 rows) fetched at a time from the query results
+FETCH_VECTORS = 100
+
+
+def get_connection(memory_limit=None):
+    """
+    Function to return a new in-memory DuckDB connection, spilling to the output folder
+    @param memory_limit <string>: maximum memory used by DuckDB (e.g. '4GB'), None for DuckDB's default (80% of RAM)
+    """
+    # duckdb is only imported when the backend is used
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("duckdb is required to use the duckdb backend (pip install duckdb)")
+
+    connection = duckdb.connect()
+    connection.execute("SET temp_directory = '{}'".format(os.path.abspath(storage.get_output_path(TEMP_FOLDER))))
+    # Rows are sorted explicitly by every query, so DuckDB doesn't need to keep the insertion order
+    connection.execute("SET preserve_insertion_order = false")
+    if memory_limit is not None:
+        connection.execute("SET memory_limit = '{}'".format(memory_limit))
+
+    return connection
+
+
+def run_query(sql, tables, order_by, dtypes, parameters=None, memory_limit=None):
+    """
+    Function to run a query over dataframes, returning its columns as numpy arrays by name
+    The result is stored on a temporary table (spilled to disk if needed) and read sorted a few chunks at a time,
+    converting every chunk to the given dtypes, so only the compact arrays are kept in memory
+    @param sql <string>: query to be run (without ORDER BY)
+    @param tables <dict>: dataframes by the table name used on the query
+    @param order_by <string>: columns the result is sorted by
+    @param dtypes <dict>: numpy dtype of each column returned
+    @param parameters <dict>: values of the $parameters used on the query
+    @param memory_limit <string>: maximum memory used by DuckDB (e.g. '4GB')
+    """
+    connection = get_connection(memory_limit)
+    try:
+        for name, df in tables.items():
+            connection.register(name, df)
+        with instrumentation.span('duckdb query'):
+            connection.execute("CREATE TEMP TABLE result AS " + sql, parameters or {})
+
+        with instrumentation.span('duckdb fetch') as record:
+            result = connection.execute("SELECT * FROM result ORDER BY " + order_by)
+            chunks = {columnname: [np.array([], dtype=dtype)] for columnname, dtype in dtypes.items()}
+            while True:
+                df_chunk = result.fetch_df_chunk(FETCH_VECTORS)
+                if len(df_chunk) == 0:
+                    break
+                for columnname, dtype in dtypes.items():
+                    chunks[columnname].append(df_chunk[columnname].to_numpy(dtype=dtype))
+            columns = {columnname: np.concatenate(arrays) for columnname, arrays in chunks.items()}
+            record['rows'] = len(next(iter(columns.values())))
+    finally:
+        connection.close()
+
+    return columns
@@ -0,0 +1,466 @@
+"""
+This script replays the registration funnel events and transactions of the output folder in timestamp order,
+streaming them as NDJSON (one JSON event per line) to a local sink, to load test ingestion services.
+
+Events are read once into typed columns and sorted by datetime. An asyncio producer takes the events that are
+due (at a fixed number of events per second, or at the original pace compressed by a speedup factor), serializes
+them in batches and puts them on a bounded queue, while a consumer sends each batch to the sink (stdout, a Unix
+socket or a local HTTP endpoint). When the sink is slower than the replay, the queue fills up and the producer
+waits for it (falling behind schedule) instead of keeping unsent events in memory.
+Counters (events per second, throughput, queue size, lag behind schedule and delivery latency) are printed to
+stderr while the replay runs. The same script can also run a stand-in receiver for the Unix socket and HTTP sinks.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from urllib.parse import urlparse
+import numpy as np
+import pandas as pd
+import storage
+
+
+# Registration funnel events: datetime column on customer_datasource.csv and event name
+REGISTRATION_EVENTS = [
+    ("account_registration_dt", "account_registered"),
+    ("account_email_confirmation_dt", "email_confirmed"),
+    ("client_registration_dt", "client_registered"),
+    ("client_approval_dt", "client_approved"),
+    ("client_denial_dt", "client_denied"),
+    ("client_initial_deposit_dt", "initial_deposit"),
+]
+
+# Event name of the rows on customer_transactions.csv
+TRANSACTION_EVENT = "transaction"
+
+# Maximum number of events serialized and sent at a time
+DEFAULT_BATCH_SIZE = 5000
+
+# Maximum number of batches waiting to be sent (the producer waits when the queue is full)
+DEFAULT_QUEUE_SIZE = 8
+
+# Seconds between the counters printed while replaying
+DEFAULT_REPORT_SECONDS = 1.0
+
+# Seconds the producer waits after catching up with the schedule, so events due meanwhile are sent together
+BATCH_INTERVAL_SECONDS = 0.01
+
+
+def get_events_dataframe(max_events=None):
+    """
+    Function to return every registration funnel event and transaction sorted by datetime
+    Columns: ts (datetime), id (client id), event, operation and amount (only set for transactions)
+    @param max_events <int>: only return the first events (None for all events)
+    """
+    df = storage.read_intermediate('customer_datasource', columns=['id'] + [columnname for columnname, event in REGISTRATION_EVENTS])
+    df_transactions = storage.read_intermediate('customer_transactions')
+
+    # Similar to:
+    # SELECT account_registration_dt AS ts, id, 'account_registered' AS event, NULL AS operation, NULL AS amount
+    # FROM df WHERE account_registration_dt IS NOT NULL
+    # UNION ALL ... (one SELECT for each registration event)
+    # UNION ALL
+    # SELECT transaction_datetime AS ts, id, 'transaction' AS event, operation, amount
+    # FROM df_transactions
+    # ORDER BY ts
+    timestamps = []
+    ids = []
+    event_codes = []
+    for event_code, (columnname, event) in enumerate(REGISTRATION_EVENTS):
+        observed = df[columnname].notnull().to_numpy()
+        timestamps.append(df[columnname].to_numpy(dtype='datetime64[s]')[observed])
+        ids.append(df['id'].to_numpy()[observed])
+        event_codes.append(np.full(observed.sum(), event_code, dtype=np.int8))
+    timestamps.append(df_transactions['transaction_datetime'].to_numpy(dtype='datetime64[s]'))
+    ids.append(df_transactions['id'].to_numpy())
+    event_codes.append(np.full(len(df_transactions), len(REGISTRATION_EVENTS), dtype=np.int8))
+
+    operations = df_transactions['operation'].astype('category')
+    num_of_registration_events = sum(len(values) for values in ids[:-1])
+    operation_codes = np.concatenate([np.full(num_of_registration_events, -1, dtype=np.int8), operations.cat.codes.to_numpy(dtype=np.int8)])
+    amounts = np.concatenate([np.full(num_of_registration_events, np.nan), df_transactions['amount'].to_numpy(dtype=np.float64)])
+
+    timestamps = np.concatenate(timestamps)
+    order = np.argsort(timestamps, kind='stable')[:max_events]
+
+    return pd.DataFrame({
+        'ts': timestamps[order],
+        'id': np.concatenate(ids)[order],
+        'event': pd.Categorical.from_codes(np.concatenate(event_codes)[order], [event for columnname, event in REGISTRATION_EVENTS] + [TRANSACTION_EVENT]),
+        'operation': pd.Categorical.from_codes(operation_codes[order], operations.cat.categories),
+        'amount': amounts[order],
+    })
+
+
+def get_due_seconds(df_events, rate=None, speedup=None):
+    """
+    Function to return the second (since the replay started) each event is due, or None to send events as fast as possible
+    @param df_events <pandas DataFrame>: events sorted by datetime
+    @param rate <float>: number of events sent per second
+    @param speedup <float>: time compression factor (e.g. 3600 replays an hour of events every second)
+    """
+    if rate is not None:
+        return np.arange(len(df_events)) / rate
+    if speedup is not None and len(df_events) > 0:
+        ts = df_events['ts'].to_numpy()
+        return (ts - ts[0]) / np.timedelta64(1, 's') / speedup
+
+    return None
+
+
+def get_batch_data(df_batch):
+    """
+    Function to serialize a batch of events as NDJSON (one JSON object per line)
+    @param df_batch <pandas DataFrame>: events to be serialized
+    """
+    data = df_batch.to_json(orient='records', lines=True, date_format='iso', date_unit='s', double_precision=2)
+
+    # Older pandas versions don't end the last line
+    return (data if data.endswith('\n') else data + '\n').encode('utf-8')
+
+
+def get_stats():
+    """
+    Function to return the counters updated while replaying (or receiving) events
+    """
+    return {'events': 0, 'bytes': 0, 'batches': 0, 'lag_seconds': 0.0, 'latencies': [], 'start': time.perf_counter()}
+
+
+async def produce_batches(df_events, due_seconds, queue, stats, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Coroutine putting the events on the queue in batches, as soon as they are due
+    Each batch is put with the time its oldest event was due (to measure the delivery latency)
+    @param df_events <pandas DataFrame>: events sorted by datetime
+    @param due_seconds <numpy array>: second each event is due since the replay started (None to send them as fast as possible)
+    @param queue <asyncio Queue>: bounded queue of batches waiting to be sent
+    @param stats <dict>: replay counters
+    @param batch_size <int>: maximum number of events on each batch
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    position = 0
+    while position < len(df_events):
+        if due_seconds is None:
+            end = min(position + batch_size, len(df_events))
+            scheduled = loop.time()
+        else:
+            elapsed = loop.time() - start
+            end = min(int(np.searchsorted(due_seconds, elapsed, side='right')), position + batch_size)
+            if end == position:
+                await asyncio.sleep(due_seconds[position] - elapsed)
+                continue
+            scheduled = start + due_seconds[position]
+            stats['lag_seconds'] = max(elapsed - due_seconds[position], 0.0)
+
+        # Waits for the consumer when the queue is full
+        await queue.put((get_batch_data(df_events.iloc[position:end]), end - position, scheduled))
+
+        caught_up = due_seconds is not None and end - position < batch_size
+        position = end
+        if caught_up:
+            await asyncio.sleep(BATCH_INTERVAL_SECONDS)
+
+    await queue.put(None)
+
+
+async def consume_batches(queue, send, stats):
+    """
+    Coroutine sending the batches on the queue to the sink until the producer is done
+    @param queue <asyncio Queue>: bounded queue of batches waiting to be sent
+    @param send <coroutine function>: function sending a batch to the sink
+    @param stats <dict>: replay counters
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            break
+        data, num_of_events, scheduled = batch
+        await send(data)
+        stats['events'] += num_of_events
+        stats['bytes'] += len(data)
+        stats['batches'] += 1
+        stats['latencies'].append(loop.time() - scheduled)
+
+
+async def get_stdout_sink():
+    """
+    Coroutine returning the functions sending batches to stdout and closing it
+    When stdout is a pipe (or a terminal), it's written without blocking the event loop, and sends wait until
+    the reader took every byte, so a slow reader slows down the replay
+    Regular files (stdout redirected to a file) can't be waited for, so they are written directly
+    """
+    sys.stdout.flush()
+    loop = asyncio.get_running_loop()
+    stdout_fd = sys.stdout.fileno()
+    pipe = os.fdopen(os.dup(stdout_fd), 'wb')
+    try:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+    except ValueError:
+        pipe.close()
+
+        async def send(data):
+            sys.stdout.buffer.write(data)
+
+        async def close():
+            sys.stdout.buffer.flush()
+
+        return send, close
+
+    # Drains wait until the pipe buffer is empty
+    transport.set_write_buffer_limits(high=0)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    async def send(data):
+        writer.write(data)
+        await writer.drain()
+
+    async def close():
+        writer.close()
+        await asyncio.sleep(0)
+        # The duplicated descriptor shares the non blocking mode with stdout
+        os.set_blocking(stdout_fd, True)
+
+    return send, close
+
+
+async def get_unix_sink(path):
+    """
+    Coroutine returning the functions sending batches to a Unix socket and closing it
+    Sends wait until the socket buffer is drained, so a slow reader slows down the replay
+    @param path <string>: path of the Unix socket
+    """
+    reader, writer = await asyncio.open_unix_connection(path)
+
+    async def send(data):
+        writer.write(data)
+        await writer.drain()
+
+    async def close():
+        writer.close()
+        await writer.wait_closed()
+
+    return send, close
+
+
+async def get_http_sink(url):
+    """
+    Coroutine returning the functions sending batches to an HTTP endpoint (one POST per batch, on a keep-alive connection)
+    and closing it
+    @param url <string>: URL of the endpoint (e.g. http://127.0.0.1:8080/events)
+    """
+    parsed_url = urlparse(url)
+    reader, writer = await asyncio.open_connection(parsed_url.hostname, parsed_url.port or 80)
+    request_header = "POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/x-ndjson\r\nContent-Length: ".format(
+        parsed_url.path or '/', parsed_url.netloc
+    ).encode('ascii')
+
+    async def send(data):
+        writer.write(request_header + str(len(data)).encode('ascii') + b"\r\n\r\n" + data)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        status_parts = status_line.split()
+        if len(status_parts) < 2 or not status_parts[1].startswith(b'2'):
+            raise ConnectionError("HTTP sink answered: {}".format(status_line.decode('latin-1').strip() or "nothing"))
+        content_length = 0
+        while True:
+            header_line = await reader.readline()
+            if header_line in (b'\r\n', b'\n', b''):
+                break
+            header_name, _, header_value = header_line.partition(b':')
+            if header_name.strip().lower() == b'content-length':
+                content_length = int(header_value)
+        await reader.readexactly(content_length)
+
+    async def close():
+        writer.close()
+        await writer.wait_closed()
+
+    return send, close
+
+
+async def get_sink(sink):
+    """
+    Coroutine returning the functions sending batches to a sink and closing it
+    @param sink <string>: stdout, unix:<path of the socket> or http://<host>:<port>/<path>
+    """
+    if sink == 'stdout':
+        return await get_stdout_sink()
+    if sink.startswith('unix:'):
+        return await get_unix_sink(sink[len('unix:'):])
+    if sink.startswith('http://'):
+        return await get_http_sink(sink)
+
+    raise ValueError("Unknown sink: {} (use stdout, unix:<path> or http://<host>:<port>/<path>)".format(sink))
+
+
+def print_progress(stats, last_stats, queue=None):
+    """
+    Function to print (to stderr) the counters since the last report: events per second, throughput and latency
+    @param stats <dict>: current counters
+    @param last_stats <dict>: counters on the last report (events, bytes and time)
+    @param queue <asyncio Queue>: queue of batches waiting to be sent, if replaying
+    """
+    now = time.perf_counter()
+    seconds = max(now - last_stats['time'], 1e-9)
+    latencies = stats['latencies'][last_stats['batches']:]
+    latency = "p50 {:>7.1f}ms p99 {:>7.1f}ms".format(*np.percentile(latencies, [50, 99]) * 1000) if latencies else "-"
+    print("{:>8.1f}s {:>12} events {:>10.0f} events/s {:>8.1f} MB/s  queue {:>3}  lag {:>6.2f}s  latency {}".format(
+        now - stats['start'],
+        stats['events'],
+        (stats['events'] - last_stats['events']) / seconds,
+        (stats['bytes'] - last_stats['bytes']) / seconds / 1024 / 1024,
+        queue.qsize() if queue is not None else 0,
+        stats['lag_seconds'],
+        latency,
+    ), file=sys.stderr)
+    last_stats.update(events=stats['events'], bytes=stats['bytes'], batches=len(stats['latencies']), time=now)
+
+
+async def report_progress(stats, report_seconds=DEFAULT_REPORT_SECONDS, queue=None):
+    """
+    Coroutine printing the counters every few seconds until cancelled
+    @param stats <dict>: replay (or receiver) counters
+    @param report_seconds <float>: seconds between reports
+    @param queue <asyncio Queue>: queue of batches waiting to be sent, if replaying
+    """
+    last_stats = {'events': 0, 'bytes': 0, 'batches': 0, 'time': stats['start']}
+    while True:
+        await asyncio.sleep(report_seconds)
+        print_progress(stats, last_stats, queue)
+
+
+def print_summary(stats):
+    """
+    Function to print (to stderr) the totals of a replay
+    @param stats <dict>: replay counters
+    """
+    seconds = max(time.perf_counter() - stats['start'], 1e-9)
+    print("Replayed {} events in {:.2f}s: {:.0f} events/s, {:.1f} MB/s".format(
+        stats['events'], seconds, stats['events'] / seconds, stats['bytes'] / seconds / 1024 / 1024
+    ), file=sys.stderr)
+    if stats['latencies']:
+        print("Latency (oldest event of each batch, from due to sent): p50 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            *np.percentile(stats['latencies'], [50, 99, 100]) * 1000
+        ), file=sys.stderr)
+
+
+async def replay_events(df_events, sink='stdout', rate=None, speedup=None, batch_size=DEFAULT_BATCH_SIZE,
+                        queue_size=DEFAULT_QUEUE_SIZE, report_seconds=DEFAULT_REPORT_SECONDS):
+    """
+    Coroutine replaying the events to a sink, printing the counters while it runs
+    Returns the replay counters
+    @param df_events <pandas DataFrame>: events sorted by datetime
+    @param sink <string>: stdout, unix:<path of the socket> or http://<host>:<port>/<path>
+    @param rate <float>: number of events sent per second
+    @param speedup <float>: time compression factor (None with no rate sends events as fast as possible)
+    @param batch_size <int>: maximum number of events on each batch
+    @param queue_size <int>: maximum number of batches waiting to be sent
+    @param report_seconds <float>: seconds between the counters printed
+    """
+    send, close = await get_sink(sink)
+    queue = asyncio.Queue(maxsize=queue_size)
+    stats = get_stats()
+    tasks = [
+        asyncio.create_task(produce_batches(df_events, get_due_seconds(df_events, rate, speedup), queue, stats, batch_size)),
+        asyncio.create_task(consume_batches(queue, send, stats)),
+    ]
+    reporter = asyncio.create_task(report_progress(stats, report_seconds, queue))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If the producer or the sink failed, the other task is stopped too
+        for task in tasks + [reporter]:
+            task.cancel()
+        await close()
+    print_summary(stats)
+
+    return stats
+
+
+async def receive_events(sink, report_seconds=DEFAULT_REPORT_SECONDS, stats=None):
+    """
+    Coroutine running a stand-in receiver for the Unix socket or HTTP sinks, counting the events received until cancelled
+    @param sink <string>: unix:<path of the socket> or http://<host>:<port>/<path>
+    @param report_seconds <float>: seconds between the counters printed
+    @param stats <dict>: receiver counters to be updated (see get_stats), new ones if None
+    """
+    stats = get_stats() if stats is None else stats
+
+    async def handle_stream(reader, writer):
+        while True:
+            data = await reader.read(1024 * 1024)
+            if not data:
+                break
+            stats['events'] += data.count(b'\n')
+            stats['bytes'] += len(data)
+        writer.close()
+
+    async def handle_http(reader, writer):
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            content_length = 0
+            while True:
+                header_line = await reader.readline()
+                if header_line in (b'\r\n', b'\n', b''):
+                    break
+                header_name, _, header_value = header_line.partition(b':')
+                if header_name.strip().lower() == b'content-length':
+                    content_length = int(header_value)
+            data = await reader.readexactly(content_length)
+            stats['events'] += data.count(b'\n')
+            stats['bytes'] += len(data)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        writer.close()
+
+    if sink.startswith('unix:'):
+        path = sink[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(handle_stream, path)
+    elif sink.startswith('http://'):
+        parsed_url = urlparse(sink)
+        server = await asyncio.start_server(handle_http, parsed_url.hostname, parsed_url.port or 80)
+    else:
+        raise ValueError("Only the unix:<path> and http://<host>:<port>/<path> sinks have a receiver")
+
+    print("Receiving events on {}".format(sink), file=sys.stderr)
+    async with server:
+        await asyncio.gather(server.serve_forever(), report_progress(stats, report_seconds))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay the registration events and transactions of the output folder in timestamp order, for load testing")
+    parser.add_argument("--sink", default="stdout",
+                        help="where events are sent as NDJSON: stdout, unix:<path of the socket> or http://<host>:<port>/<path>")
+    pacing = parser.add_mutually_exclusive_group()
+    pacing.add_argument("--rate", type=float, help="number of events sent per second (default: as fast as possible)")
+    pacing.add_argument("--speedup", type=float,
+                        help="replay events at their original pace compressed by this factor (e.g. 3600 replays an hour every second)")
+    parser.add_argument("--max-events", type=int, help="only replay the first events")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="maximum number of events serialized and sent at a time")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="maximum number of batches waiting to be sent (the replay waits for slow sinks beyond it)")
+    parser.add_argument("--report-seconds", type=float, default=DEFAULT_REPORT_SECONDS, help="seconds between the counters printed to stderr")
+    parser.add_argument("--receive", action="store_true", help="run a stand-in receiver on the sink (unix or http) instead of replaying")
+    args = parser.parse_args()
+
+    try:
+        if args.receive:
+            asyncio.run(receive_events(args.sink, args.report_seconds))
+        else:
+            df_events = get_events_dataframe(args.max_events)
+            print("Replaying {} events to {}".format(len(df_events), args.sink), file=sys.stderr)
+            asyncio.run(replay_events(df_events, args.sink, args.rate, args.speedup, args.batch_size, args.queue_size, args.report_seconds))
+    except KeyboardInterrupt:
+        pass
+    except (BrokenPipeError, ConnectionError) as error:
+        print("Replay stopped, the sink closed the connection: {}".format(error), file=sys.stderr)
+        sys.exit(1)
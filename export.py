@@ -0,0 +1,161 @@
+"""
+This script writes the files used by Tableau (the final export of each output).
+
+Dataframes are written to csv in chunks, without the index: chunks can be formatted (and gzip compressed)
+by several processes at the same time, while the current process only writes the bytes in order.
+Date columns of the largest files (cohort, acquisition funnel and activity) are already formatted
+by their stages, once per distinct day or month, so the csv formatter only copies strings.
+Optionally, a Tableau Hyper extract is also written, if the tableauhyperapi library is installed.
+"""
+
+import gzip
+import pandas as pd
+import parallel
+
+
+# Default number of rows formatted at a time
+DEFAULT_CHUNK_SIZE = 200000
+
+# Compression level of gzip files (lower is faster, higher gives smaller files)
+GZIP_COMPRESSLEVEL = 6
+
+# Default export options (see get_export_options)
+DEFAULT_EXPORT_OPTIONS = {
+    'workers': 1,
+    'compression': None,
+    'hyper': False,
+}
+
+
+def get_export_options(params):
+    """
+    Function to return the export options from the pipeline parameters
+    @param params <dict>: pipeline parameters
+    """
+    return {
+        'workers': params.get('export_workers', DEFAULT_EXPORT_OPTIONS['workers']),
+        'compression': params.get('export_compression', DEFAULT_EXPORT_OPTIONS['compression']),
+        'hyper': params.get('export_hyper', DEFAULT_EXPORT_OPTIONS['hyper']),
+    }
+
+
+def get_csv_extension(compression=None):
+    """
+    Function to return the extension of the exported csv files
+    @param compression <string>: gzip or None
+    """
+    return '.csv.gz' if compression == 'gzip' else '.csv'
+
+
+def get_csv_chunk(df, header, compression=None):
+    """
+    Function to format a chunk of a dataframe as csv bytes (called on the export worker processes)
+    gzip chunks are compressed on their own: concatenated gzip members are still a valid gzip file
+    (without a modification time, so the same rows always give the same bytes)
+    @param df <pandas DataFrame>: chunk to be formatted
+    @param header <bool>: if True, the header is written before the rows
+    @param compression <string>: gzip or None
+    """
+    csv_bytes = df.to_csv(index=False, header=header).encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(csv_bytes, compresslevel=GZIP_COMPRESSLEVEL, mtime=0)
+
+    return csv_bytes
+
+
+def write_csv(df, path, append=False, workers=1, compression=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Function to write a dataframe to a csv file, formatting it in chunks
+    Returns the number of rows written
+    @param df <pandas DataFrame>: dataframe to be written
+    @param path <string>: path of the file
+    @param append <bool>: if True, rows are appended to the existing file (without header)
+    @param workers <int>: number of processes formatting chunks at the same time
+    @param compression <string>: gzip or None
+    @param chunk_size <int>: number of rows formatted at a time
+    """
+    shards_args = (
+        (df.iloc[offset:offset + chunk_size], offset == 0 and not append, compression)
+        for offset in range(0, max(len(df), 1), chunk_size)
+    )
+    with open(path, 'ab' if append else 'wb') as csv_file:
+        for csv_bytes in parallel.imap_shards(get_csv_chunk, shards_args, workers):
+            csv_file.write(csv_bytes)
+
+    return len(df)
+
+
+def get_hyper_sql_type(dtype):
+    """
+    Function to return the Hyper column type of a pandas dtype
+    @param dtype <numpy dtype>: type of the column
+    """
+    from tableauhyperapi import SqlType
+
+    if pd.api.types.is_bool_dtype(dtype):
+        return SqlType.bool()
+    if pd.api.types.is_integer_dtype(dtype):
+        return SqlType.big_int()
+    if pd.api.types.is_float_dtype(dtype):
+        return SqlType.double()
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return SqlType.timestamp()
+
+    return SqlType.text()
+
+
+def write_hyper(df, path, append=False):
+    """
+    Function to write a dataframe to a Tableau Hyper extract (table Extract.Extract)
+    @param df <pandas DataFrame>: dataframe to be written
+    @param path <string>: path of the file
+    @param append <bool>: if True, rows are inserted into the existing extract
+    """
+    # tableauhyperapi is only imported when Hyper extracts are written
+    try:
+        from tableauhyperapi import (
+            HyperProcess, Telemetry, Connection, CreateMode, TableDefinition, TableName, Inserter, NULLABLE
+        )
+    except ImportError:
+        raise ImportError("tableauhyperapi is required to write Hyper extracts (pip install tableauhyperapi)")
+
+    table = TableDefinition(
+        TableName('Extract', 'Extract'),
+        [TableDefinition.Column(str(columnname), get_hyper_sql_type(dtype), NULLABLE) for columnname, dtype in df.dtypes.items()]
+    )
+
+    # Values are converted to python objects (missing values to None), one column at a time
+    columns = []
+    for columnname, dtype in df.dtypes.items():
+        values = df[columnname]
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            values = values.astype('datetime64[us]')
+        columns.append(values.astype(object).where(values.notnull(), None).tolist())
+
+    create_mode = CreateMode.CREATE_IF_NOT_EXISTS if append else CreateMode.CREATE_AND_REPLACE
+    with HyperProcess(telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU) as hyper:
+        with Connection(endpoint=hyper.endpoint, database=path, create_mode=create_mode) as connection:
+            connection.catalog.create_schema_if_not_exists('Extract')
+            connection.catalog.create_table_if_not_exists(table)
+            with Inserter(connection, table) as inserter:
+                inserter.add_rows(zip(*columns))
+                inserter.execute()
+
+
+def delete_hyper_rows(path, columnname, min_value):
+    """
+    Function to delete the rows of a Tableau Hyper extract with a column on or after a value
+    Values are compared as text, so '%Y-%m-%d' values work on both date strings and timestamps
+    @param path <string>: path of the file
+    @param columnname <string>: name of the column
+    @param min_value <string>: first value deleted
+    """
+    from tableauhyperapi import HyperProcess, Telemetry, Connection, escape_name, escape_string_literal
+
+    # Similar to:
+    # DELETE FROM Extract.Extract WHERE CAST(columnname AS TEXT) >= min_value
+    with HyperProcess(telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU) as hyper:
+        with Connection(endpoint=hyper.endpoint, database=path) as connection:
+            connection.execute_command('DELETE FROM "Extract"."Extract" WHERE CAST({} AS TEXT) >= {}'.format(
+                escape_name(columnname), escape_string_literal(min_value)
+            ))
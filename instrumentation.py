@@ -0,0 +1,112 @@
+"""
+This script has the instrumentation used to see where time and memory go inside each stage.
+
+Sub-steps are wrapped in spans (with instrumentation.span("name") as record: ...), which record
+their duration, the change in memory (RSS) and, when set on the record, the number of rows produced.
+Spans are kept per process: the pipeline collects the spans of each stage (including the ones
+running in worker processes) and prints a summary at the end.
+Optionally, each stage can also be run under cProfile, dumping its stats to the output folder.
+"""
+
+import cProfile
+import os
+import time
+from contextlib import contextmanager
+import storage
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Folder inside the output folder where the cProfile stats of each stage are dumped
+PROFILE_FOLDER = 'profiles'
+
+# Spans recorded in the current process, in the order they started
+SPANS = []
+
+# Depth of the span currently open (nested spans are indented on the report)
+current_depth = 0
+
+
+def get_rss_mb():
+    """
+    Function to return the current memory (resident set size) of the process in MB
+    Where /proc is not available, the peak memory is returned instead
+    """
+    try:
+        with open('/proc/self/statm') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return 0.0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def span(name):
+    """
+    Context manager recording the duration and memory change of the code inside it
+    Yields the span record, where the number of rows produced can be set (record['rows'] = len(df))
+    @param name <string>: name of the span
+    """
+    global current_depth
+
+    record = {'name': name, 'depth': current_depth, 'seconds': None, 'memory_delta_mb': None, 'rows': None}
+    SPANS.append(record)
+    start_rss = get_rss_mb()
+    start = time.perf_counter()
+    current_depth += 1
+    try:
+        yield record
+    finally:
+        current_depth -= 1
+        record['seconds'] = time.perf_counter() - start
+        record['memory_delta_mb'] = get_rss_mb() - start_rss
+
+
+def pop_spans():
+    """
+    Function to return the spans recorded in the current process, clearing them
+    """
+    spans = list(SPANS)
+    SPANS.clear()
+
+    return spans
+
+
+def run_profiled(name, function, *args):
+    """
+    Function to run a function under cProfile, dumping its stats to output/profiles/<name>.prof
+    Stats can be read with: python -m pstats output/profiles/<name>.prof
+    @param name <string>: name of the stats file (without extension)
+    @param function <function>: function to be profiled
+    @param args: arguments of the function
+    """
+    profile_folder = storage.get_output_path(PROFILE_FOLDER)
+    os.makedirs(profile_folder, exist_ok=True)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args)
+    finally:
+        profile.dump_stats(os.path.join(profile_folder, name + '.prof'))
+
+
+def print_spans_report(stage_spans):
+    """
+    Function to print the spans of each stage: time, memory change and rows of every sub-step
+    @param stage_spans <dict>: spans of each stage, in the order the stages are reported
+    """
+    print("{:<60} {:>10} {:>12} {:>12}".format("span", "time", "memory", "rows"))
+    for stage_name, spans in stage_spans.items():
+        print(stage_name)
+        for record in spans:
+            print("{:<60} {:>9.2f}s {:>+10.1f}MB {:>12}".format(
+                "  " * (record['depth'] + 1) + record['name'],
+                record['seconds'],
+                record['memory_delta_mb'],
+                "" if record['rows'] is None else record['rows']
+            ))
@@ -1,26 +1,84 @@
-import customer_registration
-import customer_cohort
-import customer_acquisition_funnel
-import customer_transactions
-import customer_activity
+import time
+STARTUP_START = time.perf_counter()
+
+import argparse
+import pipeline
 
 if __name__ == "__main__":
 
     ## PARAMETERS ##
     NUM_OF_CUSTOMERS = 22785 # Number of customers to create
     MONTHS_BACK = 7 # Number of months back when customers create account
+    COHORT_SPARSE = False # Only output observed cohort rows (plus a daily denominators file)
+    COHORT_MAX_LAG_DAYS = None # In sparse mode, output every cohort row up to this many days of lag
+    COHORT_CONVERSION_MAX_LAG_DAYS = 30 # Output cumulative conversion tables up to this many days of lag (None to skip them)
+    ACTIVITY_SPARSE = False # Only output activity months with transactions or churn
+    BACKENDS = ['numpy', 'duckdb'] # Backends available for the cohort and activity stages (see duckdb_backend.py)
+    BACKEND = 'numpy' # Backend of the cohort and activity stages: numpy or duckdb (requires duckdb)
+    DUCKDB_MEMORY_LIMIT = None # Maximum memory used by DuckDB (e.g. '4GB'), the rest is spilled to disk (None for 80% of RAM)
+    SEED = None # Seed for the random generators (None for a different dataset on every run)
+    WORKERS = None # Number of processes running stages concurrently (None for one per CPU)
+    CHUNK_SIZE = None # Customers generated and written at a time, keeping memory bounded (None to generate all in memory)
+    GENERATION_WORKERS = 1 # Number of processes generating customers and transactions shards
+    EXPORT_WORKERS = 1 # Number of processes formatting the csv files used by Tableau
+    EXPORT_GZIP = False # Compress the csv files used by Tableau (customer_*.csv.gz)
+    EXPORT_HYPER = False # Also write Tableau Hyper extracts (requires tableauhyperapi)
+    PROFILE = False # Run each stage under cProfile, dumping its stats to output/profiles
+    CACHE = False # Restore the files of stages whose inputs, parameters and code didn't change from output/.cache
+    CACHE_MAX_MB = 2048 # Maximum size of the cache, least recently used entries are removed beyond it
 
-    # Create 1st file: customer_registration.csv
-    customer_registration.create_customer_registration_file(NUM_OF_CUSTOMERS, MONTHS_BACK)
-
-    # Create 2nd file: customer_datasource_cohort.csv
-    customer_cohort.create_customer_cohort_file()
-
-    # Create 3rd file: customer_datasource_acquisition_funnel.csv
-    customer_acquisition_funnel.create_customer_acquisition_funnel_file()
+    parser = argparse.ArgumentParser(description="Create the source files for the Tableau dashboard inside the output folder")
+    parser.add_argument("--outputs", nargs="+", choices=pipeline.get_all_outputs(),
+                        help="outputs to build (default: all). Inputs of the stages not built are read from the output folder")
+    parser.add_argument("--customers", type=int, default=NUM_OF_CUSTOMERS, help="number of customers to create")
+    parser.add_argument("--months-back", type=int, default=MONTHS_BACK, help="number of months back when customers create account")
+    parser.add_argument("--seed", type=int, default=SEED, help="seed for the random generators")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of processes running stages concurrently")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="stream customers and transactions to the output files this many customers at a time")
+    parser.add_argument("--generation-workers", type=int, default=GENERATION_WORKERS,
+                        help="number of processes generating customers and transactions (the output doesn't depend on it)")
+    parser.add_argument("--export-workers", type=int, default=EXPORT_WORKERS,
+                        help="number of processes formatting the csv files used by Tableau")
+    parser.add_argument("--gzip", action="store_true", default=EXPORT_GZIP, help="compress the csv files used by Tableau")
+    parser.add_argument("--hyper", action="store_true", default=EXPORT_HYPER,
+                        help="also write Tableau Hyper extracts (requires tableauhyperapi)")
+    parser.add_argument("--backend", choices=BACKENDS, default=BACKEND,
+                        help="backend of the cohort and activity stages (duckdb runs them as SQL, spilling to disk, and requires duckdb)")
+    parser.add_argument("--duckdb-memory-limit", default=DUCKDB_MEMORY_LIMIT,
+                        help="maximum memory used by the duckdb backend (e.g. 4GB), the rest is spilled to output/.duckdb")
+    parser.add_argument("--profile", action="store_true", default=PROFILE,
+                        help="run each stage under cProfile, dumping its stats to output/profiles/<stage>.prof")
+    parser.add_argument("--cache", action="store_true", default=CACHE,
+                        help="restore the files of stages whose inputs, parameters and code didn't change from output/.cache")
+    parser.add_argument("--cache-max-mb", type=float, default=CACHE_MAX_MB,
+                        help="maximum size of the cache in MB, least recently used entries are removed beyond it")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only append customers and transactions created since the last run and recompute the affected cohort and activity rows")
+    args = parser.parse_args()
 
-    # Create 4th file: customer_transactions.csv
-    customer_transactions.create_customer_transactions_file()
+    params = {
+        'number_of_customers': args.customers,
+        'months_back': args.months_back,
+        'seed': args.seed,
+        'cohort_sparse': COHORT_SPARSE,
+        'cohort_max_lag_days': COHORT_MAX_LAG_DAYS,
+        'cohort_conversion_max_lag_days': COHORT_CONVERSION_MAX_LAG_DAYS,
+        'activity_sparse': ACTIVITY_SPARSE,
+        'backend': args.backend,
+        'duckdb_memory_limit': args.duckdb_memory_limit,
+        'chunk_size': args.chunk_size,
+        'generation_workers': args.generation_workers,
+        'profile': args.profile,
+        'export_workers': args.export_workers,
+        'export_compression': 'gzip' if args.gzip else None,
+        'export_hyper': args.hyper,
+        'cache': args.cache,
+        'cache_max_mb': args.cache_max_mb,
+    }
 
-    # Create 5th file: customer_activity.csv
-    customer_activity.create_customer_activity_file()
\ No newline at end of file
+    # Create files: customer_datasource.csv, customer_datasource_cohort.csv (plus its conversion tables),
+    # customer_datasource_acquisition_funnel.csv, customer_transactions.csv, customer_activity.csv,
+    # customer_balance.csv and customer_balance_monthly.csv
+    # Startup: imports and arguments (stage modules are only imported when their stage runs)
+    pipeline.run_pipeline(args.outputs, params, args.workers, args.incremental, time.perf_counter() - STARTUP_START)
@@ -0,0 +1,62 @@
+"""
+This script has the helpers used to split data generation into shards processed by several worker processes.
+
+Random values are derived from a global seed and the id they belong to (e.g. the account id),
+not from the shard they were drawn on, so the generated data is the same no matter how many workers
+are used, how rows are split into shards or when (on which run) each row is generated.
+"""
+
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def get_seed_entropy(seed=None):
+    """
+    Function to return the global entropy shared by all shards
+    If no seed is given, a random one is drawn (once) so all shards still share it
+    @param seed <int>: global seed (None for a random seed)
+    """
+    return np.random.SeedSequence(seed).entropy
+
+
+def get_id_random(entropy, ids, stream):
+    """
+    Function to return a pseudo-random value in [0, 1) for every id (splitmix64 hash of the id, the stream and
+    the global entropy), the same for the same id on every shard and run
+    @param entropy <int>: global entropy (see get_seed_entropy)
+    @param ids <numpy array>: ids the values belong to (e.g. account ids)
+    @param stream <string>: name of the random value (e.g. 'client_approval'), each name gives independent values
+    """
+    key = (int(entropy) ^ (zlib.crc32(stream.encode('utf-8')) * 0x9E3779B97F4A7C15)) % 2 ** 64
+    values = np.asarray(ids).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(key)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    values = values ^ (values >> np.uint64(31))
+
+    return (values >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+def imap_shards(function, shards_args, workers=1):
+    """
+    Generator of the results of a function applied to each shard, in the same order as the shards
+    With more than one worker, shards are processed in a process pool, keeping at most two shards per worker
+    in flight, so results are yielded (and can be written) while the next shards are being processed
+    @param function <function>: top level function called with the arguments of each shard
+    @param shards_args <iterable>: tuples with the arguments of each shard
+    @param workers <int>: number of worker processes (1 processes the shards in the current process)
+    """
+    if workers is None or workers <= 1:
+        for args in shards_args:
+            yield function(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running_shards = deque()
+        for args in shards_args:
+            running_shards.append(executor.submit(function, *args))
+            if len(running_shards) >= 2 * workers:
+                yield running_shards.popleft().result()
+        while running_shards:
+            yield running_shards.popleft().result()
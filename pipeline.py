@@ -0,0 +1,368 @@
+"""
+This script runs the stages of the project as a DAG, passing dataframes in memory between stages.
+
+Each stage module declares the names of its inputs (STAGE_INPUTS) and outputs (STAGE_OUTPUTS)
+and a run_stage(frames, params) function returning its output dataframes by name.
+Inputs the stage reads in chunks from their intermediate files (STAGE_STREAMED_INPUTS) are not passed to it,
+the stage only runs once they are written.
+Outputs are either rewritten on every run, appended to (STAGE_APPENDED_OUTPUTS) or written as monthly partitions
+(STAGE_PARTITIONED_OUTPUTS), so incremental runs only replace the partitions from the first month that changed.
+Declarations are read from the source of the modules, so a stage module is only imported when it runs.
+Stages whose inputs are ready run concurrently in a process pool, so independent stages
+(cohort, acquisition funnel and transactions) don't wait for each other.
+"""
+
+import ast
+import functools
+import importlib
+import importlib.util
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import storage
+import export
+import instrumentation
+import parallel
+import stage_cache
+
+
+# Modules containing the stages of the pipeline, in execution order
+STAGE_MODULES = [
+    'customer_registration',
+    'customer_funnel',
+    'customer_cohort',
+    'customer_acquisition_funnel',
+    'customer_transactions',
+    'customer_activity',
+    'customer_balance',
+]
+
+# Default parameters for the stages
+DEFAULT_PARAMS = {
+    'number_of_customers': 22785,
+    'months_back': 7,
+    'seed': None,
+    'cohort_sparse': False,
+    'cohort_max_lag_days': None,
+    'cohort_conversion_max_lag_days': 30,
+    'activity_sparse': False,
+    'backend': 'numpy',
+    'duckdb_memory_limit': None,
+    'chunk_size': None,
+    'generation_workers': 1,
+    'profile': False,
+    'export_workers': 1,
+    'export_compression': None,
+    'export_hyper': False,
+    'cache': False,
+    'cache_max_mb': 2048,
+    'now': None,
+    'start': None,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def read_stage_declarations(stage_name):
+    """
+    Function to return the STAGE_* constants of a stage module, read from its source code without importing it
+    (so only the modules of the stages that run, and their dependencies, are ever imported)
+    @param stage_name <string>: name of the stage module
+    """
+    with open(importlib.util.find_spec(stage_name).origin) as module_file:
+        module_tree = ast.parse(module_file.read())
+
+    declarations = {}
+    for node in module_tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            if node.targets[0].id.startswith('STAGE_'):
+                declarations[node.targets[0].id] = ast.literal_eval(node.value)
+
+    return declarations
+
+
+def get_stage_declarations():
+    """
+    Function to return the inputs and outputs declared by each stage module
+    """
+    stages = {}
+    for stage_name in STAGE_MODULES:
+        declarations = read_stage_declarations(stage_name)
+        stages[stage_name] = {
+            'inputs': declarations['STAGE_INPUTS'],
+            'outputs': declarations['STAGE_OUTPUTS'],
+            'appended_outputs': declarations.get('STAGE_APPENDED_OUTPUTS', []),
+            'streamed_inputs': declarations.get('STAGE_STREAMED_INPUTS', []),
+        }
+
+    return stages
+
+
+def get_all_outputs():
+    """
+    Function to return the names of all outputs that can be built by the pipeline
+    """
+    return [output for stage in get_stage_declarations().values() for output in stage['outputs']]
+
+
+def get_stages_to_run(outputs=None):
+    """
+    Function to return the stages producing the requested outputs (all stages if None)
+    @param outputs <list>: names of the outputs to build
+    """
+    stages = get_stage_declarations()
+    if outputs is None:
+        return list(stages)
+
+    unknown_outputs = set(outputs) - set(get_all_outputs())
+    if unknown_outputs:
+        raise ValueError("Unknown outputs: {}".format(", ".join(sorted(unknown_outputs))))
+
+    return [stage_name for stage_name, stage in stages.items() if set(stage['outputs']) & set(outputs)]
+
+
+def run_stage(stage_name, frames, params, return_outputs):
+    """
+    Function to run a single stage and write its output files
+    Returns the outputs needed by other stages, the stage timings in seconds and the stage spans
+    In incremental runs, appended outputs only contain new rows (appended to the existing files) and partitioned
+    outputs the rows of the partitions from their first month on (replacing those partitions), and only these
+    rows are returned to the next stages, which read the older partitions they need by themselves
+    Outputs returned as None were already written by the stage itself (streaming mode)
+    Internal outputs are only written as intermediate files, they aren't exported to Tableau
+    With the cache enabled, the files of unchanged stages are restored instead (see stage_cache.py),
+    and the files written by the other stages are stored on it
+    The spans recorded while running the stage are returned too (see instrumentation.py)
+    @param stage_name <string>: name of the stage module
+    @param frames <dict>: input dataframes by name (streamed inputs are read by the stage itself)
+    @param params <dict>: pipeline parameters
+    @param return_outputs <list>: outputs to be returned to the pipeline
+    """
+    # Stage modules are only imported by the process running them
+    with instrumentation.span('import'):
+        module = importlib.import_module(stage_name)
+    appended_outputs = getattr(module, 'STAGE_APPENDED_OUTPUTS', []) if params['watermark'] is not None else []
+    partitioned_outputs = getattr(module, 'STAGE_PARTITIONED_OUTPUTS', {})
+    internal_outputs = getattr(module, 'STAGE_INTERNAL_OUTPUTS', [])
+    export_options = export.get_export_options(params)
+
+    # Full runs are restored from the cache when the stage already ran with the same key
+    # (random stages are only cached when they are seeded)
+    cache_key = None
+    restored_outputs = None
+    if params['cache'] and params['watermark'] is None and (params['seed'] is not None or not getattr(module, 'STAGE_RANDOM', False)):
+        with instrumentation.span('cache') as record:
+            cache_key = stage_cache.get_stage_key(stage_name, module.STAGE_INPUTS, params, getattr(module, 'STAGE_RANDOM', False))
+            restored_outputs = stage_cache.restore(cache_key, module.STAGE_OUTPUTS)
+            record['name'] = 'cache miss' if restored_outputs is None else 'cache hit'
+
+    # Files written by the stage, collected from here on (the stage itself writes them in streaming mode)
+    storage.pop_written_paths()
+    start = time.perf_counter()
+    if restored_outputs is not None:
+        # Restored outputs are read from their files, like the outputs written by the stage itself
+        outputs = {name: None for name in restored_outputs}
+    else:
+        with instrumentation.span('run'):
+            if params['profile']:
+                outputs = instrumentation.run_profiled(stage_name, module.run_stage, frames, params)
+            else:
+                outputs = module.run_stage(frames, params)
+    run_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name, df in outputs.items():
+        if df is None:
+            continue
+        with instrumentation.span('write ' + name) as record:
+            record['rows'] = len(df)
+            if name in appended_outputs:
+                storage.append_output(df, name, export_options)
+            elif name in partitioned_outputs:
+                storage.write_partitioned_output(
+                    df, name, partitioned_outputs[name], params['watermark'] is not None, name not in internal_outputs, export_options
+                )
+            else:
+                storage.write_output(df, name, intermediate=True, export=name not in internal_outputs, export_options=export_options)
+    written_paths = storage.pop_written_paths()
+    if cache_key is not None and restored_outputs is None:
+        with instrumentation.span('cache store') as record:
+            record['rows'] = stage_cache.store(cache_key, module.STAGE_OUTPUTS, written_paths, params['cache_max_mb'])
+        if not record['rows']:
+            print("Warning: stage {} didn't write any output file, so it can't be restored from the cache".format(stage_name))
+    for name, df in outputs.items():
+        if name in return_outputs and df is None and params['watermark'] is None:
+            with instrumentation.span('read ' + name) as record:
+                outputs[name] = storage.read_intermediate(name)
+                record['rows'] = len(outputs[name])
+    write_seconds = time.perf_counter() - start
+
+    timings = {'run': run_seconds, 'write': write_seconds}
+
+    return {name: df for name, df in outputs.items() if name in return_outputs}, timings, instrumentation.pop_spans()
+
+
+def get_critical_path_seconds(stages, stage_timings):
+    """
+    Function to return the duration of the longest chain of dependent stages
+    @param stages <dict>: stage declarations of the stages that ran
+    @param stage_timings <dict>: timings of each stage that ran
+    """
+    producers = {output: stage_name for stage_name, stage in stages.items() for output in stage['outputs']}
+    finish_seconds = {}
+    for stage_name, stage in stages.items():
+        upstream_seconds = [finish_seconds[producers[name]] for name in stage['inputs'] if name in producers]
+        finish_seconds[stage_name] = max(upstream_seconds, default=0) + stage_timings[stage_name]['run'] + stage_timings[stage_name]['write']
+
+    return max(finish_seconds.values(), default=0)
+
+
+def print_timings_report(stages, stage_timings, wall_seconds, startup_seconds=None):
+    """
+    Function to print the time spent on each stage and the whole pipeline
+    @param stages <dict>: stage declarations of the stages that ran
+    @param stage_timings <dict>: timings of each stage that ran
+    @param wall_seconds <float>: total wall time of the pipeline
+    @param startup_seconds <float>: time spent before the pipeline started (imports and arguments), if measured
+    """
+    if startup_seconds is not None:
+        print("Startup: {:.2f}s".format(startup_seconds))
+    print("{:<30} {:>10} {:>10} {:>10} {:>10}".format("stage", "start", "run", "write", "finish"))
+    for stage_name in stages:
+        timings = stage_timings[stage_name]
+        print("{:<30} {:>9.2f}s {:>9.2f}s {:>9.2f}s {:>9.2f}s".format(
+            stage_name, timings['start'], timings['run'], timings['write'], timings['finish']
+        ))
+    print("Critical path: {:.2f}s - Wall time: {:.2f}s".format(get_critical_path_seconds(stages, stage_timings), wall_seconds))
+
+
+def get_unsatisfiable_stages_error(stages, pending_stages, written_outputs):
+    """
+    Function to return the error raised when none of the pending stages can run (and none is running),
+    naming the stages and the inputs that are never written (e.g. stages depending on each other)
+    @param stages <dict>: declarations of the stages of the run (see get_stage_declarations)
+    @param pending_stages <list>: names of the stages not run yet
+    @param written_outputs <set>: names of the outputs written (or read) so far
+    """
+    missing_inputs = [
+        "{} (missing {})".format(stage_name, ", ".join(name for name in stages[stage_name]['inputs'] if name not in written_outputs))
+        for stage_name in pending_stages
+    ]
+    return ValueError("Stages whose inputs are never written: {}".format("; ".join(missing_inputs)))
+
+
+def run_pipeline(outputs=None, params=None, workers=None, incremental=False, startup_seconds=None):
+    """
+    Function to build the requested outputs, running independent stages concurrently
+    Inputs of the stages that are not built in this run are read from the output folder
+    Every output is also written as an intermediate file, so stages can run on their own (or incrementally) later
+    @param outputs <list>: names of the outputs to build (None for all outputs)
+    @param params <dict>: pipeline parameters (missing ones are taken from DEFAULT_PARAMS, now defaults to the current datetime)
+    @param workers <int>: number of worker processes (1 runs every stage in the current process)
+    @param incremental <bool>: if True, continues the dataset of the last run (with the parameters kept on its
+        watermark) until now, only generating the data that can change after the watermark and recomputing
+        the partitions of the outputs affected by it
+    @param startup_seconds <float>: time spent before the pipeline started (imports and arguments), to be reported
+    """
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    stages_to_run = get_stages_to_run(outputs)
+    stages = {stage_name: stage for stage_name, stage in get_stage_declarations().items() if stage_name in stages_to_run}
+
+    # All data is generated until the same datetime (given to rebuild the same dataset, e.g. with a seed)
+    if params['now'] is None:
+        params['now'] = datetime.now()
+    params['watermark'] = None
+    if incremental:
+        if outputs is not None:
+            raise ValueError("Incremental runs must build all outputs")
+        params['watermark'] = storage.read_watermark()
+        if params['watermark'] is None:
+            print("No watermark found on the output folder, running a full refresh...")
+        elif 'dataset' not in params['watermark']:
+            raise ValueError("The watermark on the output folder was written by an older version, run a full refresh first")
+        else:
+            # Incremental runs continue the same dataset: customers register at the same rate since the same
+            # start, with the same random values, so the data only moves forward in time
+            params.update(params['watermark']['dataset'])
+
+    # Random values are derived from the seed (see parallel.py), and accounts register from months_back before now
+    if params['watermark'] is None:
+        import customer_registration
+        params.update(customer_registration.get_dataset_params(
+            params['number_of_customers'], params['months_back'], params['seed'], parallel.get_seed_entropy(params['seed']), params['now'],
+            params['start']
+        ))
+
+    # Inputs not produced in this run come from the output folder (streamed inputs are read by the stages themselves)
+    produced = [name for stage in stages.values() for name in stage['outputs']]
+    frames = {}
+    written_outputs = set()
+    for stage in stages.values():
+        for name in stage['inputs']:
+            if name in produced:
+                continue
+            written_outputs.add(name)
+            if name not in stage['streamed_inputs'] and name not in frames:
+                with instrumentation.span('read ' + name) as record:
+                    frames[name] = storage.read_intermediate(name)
+                    record['rows'] = len(frames[name])
+    stage_spans = {'inputs': instrumentation.pop_spans()} if frames else {}
+
+    pending_stages = list(stages)
+    stage_timings = {}
+    pipeline_start = time.perf_counter()
+
+    def get_ready_stages():
+        ready_stages = [stage_name for stage_name in pending_stages if all(name in written_outputs for name in stages[stage_name]['inputs'])]
+        for stage_name in ready_stages:
+            pending_stages.remove(stage_name)
+        return ready_stages
+
+    def get_stage_arguments(stage_name):
+        stage = stages[stage_name]
+        stage_frames = {name: frames[name] for name in stage['inputs'] if name not in stage['streamed_inputs']}
+        return_outputs = [
+            name for stage_name_to in pending_stages for name in stages[stage_name_to]['inputs']
+            if name not in stages[stage_name_to]['streamed_inputs']
+        ]
+        return stage_name, stage_frames, params, return_outputs
+
+    def collect_stage_results(stage_name, results, start):
+        stage_outputs, timings, spans = results
+        frames.update(stage_outputs)
+        written_outputs.update(stages[stage_name]['outputs'])
+        stage_spans[stage_name] = spans
+        timings['start'] = start - pipeline_start
+        timings['finish'] = time.perf_counter() - pipeline_start
+        stage_timings[stage_name] = timings
+
+    if workers == 1:
+        while pending_stages:
+            ready_stages = get_ready_stages()
+            # Nothing else will be written, so the pending stages would wait forever
+            if not ready_stages:
+                raise get_unsatisfiable_stages_error(stages, pending_stages, written_outputs)
+            for stage_name in ready_stages:
+                start = time.perf_counter()
+                collect_stage_results(stage_name, run_stage(*get_stage_arguments(stage_name)), start)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            running_stages = {}
+            while pending_stages or running_stages:
+                for stage_name in get_ready_stages():
+                    future = executor.submit(run_stage, *get_stage_arguments(stage_name))
+                    running_stages[future] = (stage_name, time.perf_counter())
+                if not running_stages:
+                    raise get_unsatisfiable_stages_error(stages, pending_stages, written_outputs)
+                done, _ = wait(running_stages, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage_name, start = running_stages.pop(future)
+                    collect_stage_results(stage_name, future.result(), start)
+
+    # Data is complete until now, next incremental runs start from here
+    if outputs is None:
+        storage.write_watermark(params['now'], {name: params[name] for name in ['number_of_customers', 'months_back', 'seed', 'entropy', 'start']})
+
+    print_timings_report(stages, stage_timings, time.perf_counter() - pipeline_start, startup_seconds)
+    instrumentation.print_spans_report({name: stage_spans[name] for name in ['inputs'] + list(stages) if name in stage_spans})
+
+    return stage_timings
@@ -0,0 +1,465 @@
+"""
+This script builds a fast, approximate preview of the cohort conversion and customer activity figures, for
+iterating on the dashboard without waiting for the full cohort and activity stages.
+
+Customers are sampled with a stratified Poisson design: each customer is kept with the sampling rate of its stratum
+(registration month and number of funnel stages reached), decided by a hash of its id, so the same customers
+(and their transactions) are sampled on every file and every run. Small strata are sampled at higher rates,
+so every stratum has enough customers. The exact stage functions run on the sample, and every figure is scaled
+back up with Horvitz-Thompson estimates (each sampled customer counts as 1 / its sampling rate), reported with
+the half width of its 95% confidence interval. Strata with no sampled customer counted on a figure widen its interval
+by an upper bound of the customers they could still have there, which grows with the number of customers not sampled
+(fully sampled strata don't widen it).
+With --check, the exact figures are computed too, and the share of them inside the confidence intervals is reported.
+"""
+
+import argparse
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import storage
+import customer_cohort
+import customer_activity
+from customer_funnel import FUNNEL_STAGES
+
+
+# Default sampling rate of the customers
+DEFAULT_RATE = 0.01
+
+# Default minimum expected number of sampled customers on each stratum (smaller strata are fully sampled)
+DEFAULT_MIN_PER_STRATUM = 2000
+
+# Default number of customers (and transactions) read at a time
+DEFAULT_CHUNK_SIZE = 1000000
+
+# Default minimum share of exact figures (of all figures compared) inside the confidence intervals for the check to pass
+DEFAULT_MIN_COVERAGE = 0.9
+
+# Normal quantile of the 95% confidence intervals
+Z_95 = 1.96
+
+# Probability of sampling none of the customers counted on a figure above its zero count bound (see get_zero_count_bound)
+ZERO_COUNT_ALPHA = 0.05
+
+# Figures below this value are not included on the relative errors of the check (their intervals are relatively wide)
+LARGE_FIGURE = 10000
+
+# Columns of customer_datasource.csv needed by the preview
+CUSTOMER_COLUMNS = ['id', 'account_registration_dt', 'account_email_confirmation_dt', 'client_registration_dt',
+                    'client_approval_dt', 'client_denial_dt', 'client_initial_deposit_dt']
+
+
+def get_sample_values(ids, seed=0):
+    """
+    Function to return a pseudo-random value in [0, 1) for every id (splitmix64 hash of the id and the seed),
+    the same for the same id on every file, chunk and run
+    @param ids <numpy array>: client ids
+    @param seed <int>: seed of the hash
+    """
+    values = ids.astype(np.uint64) + np.uint64(seed * 0x9E3779B97F4A7C15 % 2 ** 64)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    values = values ^ (values >> np.uint64(31))
+
+    return (values >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+def get_strata(df):
+    """
+    Function to return the stratum of every customer: registration month and number of funnel stages reached
+    (encoded as month number * (stages + 1) + stages reached)
+    @param df <pandas DataFrame>: customer registration data (base file), with the CUSTOMER_COLUMNS
+    """
+    # Only the stages reached are needed, so datetimes aren't parsed (the analysis is reached on approval or denial)
+    stages_reached = np.zeros(len(df), dtype=np.int64)
+    for columnname_date, status in FUNNEL_STAGES:
+        if columnname_date == 'client_analysis_dt':
+            stages_reached += (df['client_approval_dt'].notnull() | df['client_denial_dt'].notnull()).to_numpy()
+        else:
+            stages_reached += df[columnname_date].notnull().to_numpy()
+    registration_months = pd.to_datetime(df['account_registration_dt']).to_numpy(dtype='datetime64[M]').astype(np.int64)
+
+    return registration_months * (len(FUNNEL_STAGES) + 1) + stages_reached
+
+
+def get_strata_sizes(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Function to return the number of customers on each stratum, reading the customers one chunk at a time
+    @param chunk_size <int>: number of customers read at a time
+    """
+    strata_sizes = pd.Series(dtype=np.int64)
+    for df in storage.iter_intermediate_chunks('customer_datasource', CUSTOMER_COLUMNS, chunk_size):
+        strata, sizes = np.unique(get_strata(df), return_counts=True)
+        strata_sizes = strata_sizes.add(pd.Series(sizes, index=strata), fill_value=0)
+
+    return strata_sizes.astype(np.int64)
+
+
+def get_sampling_rates(strata_sizes, rate=DEFAULT_RATE, min_per_stratum=DEFAULT_MIN_PER_STRATUM):
+    """
+    Function to return the sampling rate of each stratum: the base rate, raised on small strata so that
+    min_per_stratum customers are expected to be sampled (up to every customer of the stratum)
+    @param strata_sizes <pandas Series>: number of customers on each stratum
+    @param rate <float>: base sampling rate
+    @param min_per_stratum <int>: minimum expected number of sampled customers on each stratum
+    """
+    return np.minimum(1.0, np.maximum(rate, min_per_stratum / strata_sizes))
+
+
+def get_customer_sample(sampling_rates, seed=0, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Function to return the sampled customers, with the stratum and sampling rate of each one (inclusion_probability)
+    @param sampling_rates <pandas Series>: sampling rate of each stratum
+    @param seed <int>: seed of the hash deciding which customers are sampled
+    @param chunk_size <int>: number of customers read at a time
+    """
+    objs = []
+    for df in storage.iter_intermediate_chunks('customer_datasource', CUSTOMER_COLUMNS, chunk_size):
+        strata = get_strata(df)
+        inclusion_probability = sampling_rates.reindex(strata).to_numpy()
+        sampled = get_sample_values(df['id'].to_numpy(), seed) < inclusion_probability
+        objs.append(df[sampled].assign(stratum=strata[sampled], inclusion_probability=inclusion_probability[sampled]))
+
+    return pd.concat(objs=objs, ignore_index=True)
+
+
+def get_sampled_transactions(df_sample, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Function to return the transactions of the sampled customers, reading the transactions one chunk at a time
+    @param df_sample <pandas DataFrame>: sampled customers
+    @param chunk_size <int>: number of transactions read at a time
+    """
+    sampled_ids = df_sample['id'].to_numpy()
+    objs = [
+        df[np.isin(df['id'].to_numpy(), sampled_ids)]
+        for df in storage.iter_intermediate_chunks('customer_transactions', ['id', 'transaction_datetime'], chunk_size)
+    ]
+
+    return pd.concat(objs=objs, ignore_index=True)
+
+
+def get_strata_dataframe(strata_sizes, sampling_rates, df_sample):
+    """
+    Function to return, for every stratum, its registration month (months since 1970-01), number of funnel stages
+    reached, number of customers, number of sampled customers and sampling rate
+    @param strata_sizes <pandas Series>: number of customers on each stratum
+    @param sampling_rates <pandas Series>: sampling rate of each stratum
+    @param df_sample <pandas DataFrame>: sampled customers, with their stratum
+    """
+    strata = strata_sizes.index.to_numpy(dtype=np.int64)
+
+    return pd.DataFrame({
+        'registration_month': strata // (len(FUNNEL_STAGES) + 1),
+        'stages_reached': strata % (len(FUNNEL_STAGES) + 1),
+        'customers': strata_sizes.to_numpy(),
+        'sampled_customers': df_sample['stratum'].value_counts().reindex(strata, fill_value=0).to_numpy(),
+        'rate': sampling_rates.reindex(strata).to_numpy(),
+    }, index=strata)
+
+
+def get_unsampled_customers(df_strata, last_months, min_stages):
+    """
+    Function to return the number of customers not sampled that can be counted on a figure: the customers of the strata
+    registered up to each last month that reached at least each number of funnel stages (stages are reached in order)
+    Returns a (last months x min stages) array
+    @param df_strata <pandas DataFrame>: strata (see get_strata_dataframe)
+    @param last_months <numpy array>: last registration month (months since 1970-01) of each figure
+    @param min_stages <numpy array>: minimum number of funnel stages reached
+    """
+    registered = df_strata['registration_month'].to_numpy()[None, :] <= last_months[:, None]
+    reached = df_strata['stages_reached'].to_numpy()[:, None] >= min_stages[None, :]
+    unsampled = (df_strata['customers'] - df_strata['sampled_customers']).to_numpy()
+
+    return (registered * unsampled[None, :]) @ reached
+
+
+def get_zero_count_bound(unsampled, rate):
+    """
+    Function to return the 95% upper bound of the customers counted on a figure when none of the sampled ones is:
+    with k such customers, each sampled at least at the given rate, none of them is sampled with probability
+    (1 - rate) ** k at most, below 5% once k > log(20) / -log(1 - rate) (about 3 / rate, the "rule of three"),
+    and k can't be larger than the number of customers not sampled
+    @param unsampled <numpy array>: customers not sampled that can be counted on each figure
+    @param rate <numpy array>: lowest sampling rate of those customers (1 if there are none)
+    """
+    with np.errstate(divide='ignore'):
+        return np.minimum(unsampled, np.log(1 / ZERO_COUNT_ALPHA) / -np.log1p(-rate))
+
+
+def add_stratum_counts(totals, counts, rate, unsampled):
+    """
+    Function to add the counts of the customers sampled at one rate to the totals of a figure: the Horvitz-Thompson
+    estimate (each customer counts as 1 / rate) and its variance, and, where none of them is counted, the customers
+    not sampled at that rate that could be (and the lowest of their rates), bounding the counts estimated as zero
+    @param totals <dict>: estimate, variance, zero_unsampled and zero_rate arrays of the figure, updated in place
+    @param counts <numpy array>: counts of the sampled customers
+    @param rate <float>: sampling rate of the customers (strata not sampled at all only add their customers to the bound)
+    @param unsampled <numpy array>: customers not sampled at that rate that can be counted on each figure
+    """
+    zero = (counts == 0) & (unsampled > 0)
+    if rate > 0:
+        totals['estimate'] += counts / rate
+        totals['variance'] += counts * (1 - rate) / rate ** 2
+    totals['zero_unsampled'] += unsampled * zero
+    totals['zero_rate'] = np.where(zero, np.minimum(totals['zero_rate'], rate), totals['zero_rate'])
+
+
+def get_totals_errors(totals):
+    """
+    Function to return the half width of the 95% confidence interval of every figure: normal interval of the
+    Horvitz-Thompson estimate, widened by the bound of the strata with no sampled customer counted (see get_zero_count_bound)
+    @param totals <dict>: estimate, variance, zero_unsampled and zero_rate arrays of the figure (see add_stratum_counts)
+    """
+    return Z_95 * np.sqrt(totals['variance']) + get_zero_count_bound(totals['zero_unsampled'], totals['zero_rate'])
+
+
+def get_empty_totals(shape):
+    """
+    Function to return the totals of a figure before any stratum is added (see add_stratum_counts)
+    @param shape <tuple>: shape of the figure arrays
+    """
+    return {'estimate': np.zeros(shape), 'variance': np.zeros(shape), 'zero_unsampled': np.zeros(shape), 'zero_rate': np.ones(shape)}
+
+
+def get_conversion_estimates(df_sample, df_strata, max_lag_days, period='month', now=None):
+    """
+    Function to return the estimated conversion table (see customer_cohort.get_conversion_dataframe) with the half
+    width of the 95% confidence interval of every count (status_from_count_error and status_to_cumulative_count_error)
+    Customers sampled at the same rate are counted together by the exact cohort functions, and scaled by 1 / rate
+    Rows are returned for every date from, status pair and lag on which any customer can be counted
+    @param df_sample <pandas DataFrame>: sampled customers, with their inclusion_probability
+    @param df_strata <pandas DataFrame>: strata (see get_strata_dataframe)
+    @param max_lag_days <int>: maximum number of days between date from and date to
+    @param period <string>: day, week or month
+    @param now <datetime>: current datetime, lags after it are not observed yet (defaults to current datetime)
+    """
+    if now is None:
+        now = datetime.now()
+    status_pairs = np.array(customer_cohort.get_status_pairs())
+    df_sample = customer_cohort.add_client_analysis_dt(df_sample)
+    groups = {
+        probability: customer_cohort.get_cumulative_conversions(df_group, max_lag_days, now)
+        for probability, df_group in df_sample.groupby('inclusion_probability')
+    }
+
+    # Days from the first registration month until the current date (none without customers)
+    end_day = int(np.datetime64(pd.Timestamp(now).date(), 'D').astype(np.int64))
+    first_day = int(df_strata['registration_month'].min().astype('datetime64[M]').astype('datetime64[D]').astype(np.int64)) if len(df_strata) else end_day + 1
+    num_of_days = max([end_day - first_day + 1] + [conversions['first_day'] + conversions['num_of_days'] - first_day for conversions in groups.values()])
+    num_of_lags = max_lag_days + 1
+
+    # Group days from by period, each lag only sums the days on which it was already observed
+    # (same as customer_cohort.get_conversion_dataframe)
+    days = first_day + np.arange(num_of_days)
+    observed = (days[:, None] + np.arange(num_of_lags)[None, :]) <= end_day
+    period_days = customer_cohort.get_period_start_days(days, period)
+    period_starts = np.flatnonzero(np.r_[True, period_days[1:] != period_days[:-1]]) if num_of_days else np.array([], dtype=np.int64)
+    period_observed = np.add.reduceat(observed, period_starts, axis=0) > 0
+    last_months = np.maximum.reduceat(days, period_starts).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+
+    # Horvitz-Thompson estimates of the counts and their variance, adding the strata sampled at each rate
+    #
+    # Similar to:
+    # SELECT status_datetime_from, status_from, status_to, datetime_diff_days,
+    #        SUM(1 / p) AS estimate, SUM((1 - p) / (p * p)) AS variance
+    # FROM df_sample_conversions
+    # GROUP BY 1, 2, 3, 4
+    shape = (len(period_starts), len(status_pairs), num_of_lags)
+    population_totals = get_empty_totals(shape)
+    cumulative_totals = get_empty_totals(shape)
+    for rate in np.unique(df_strata['rate'].to_numpy()):
+        cumulative = np.zeros((num_of_days, len(status_pairs), num_of_lags), dtype=np.int32)
+        population = np.zeros((num_of_days, len(status_pairs)), dtype=np.int32)
+        if rate in groups:
+            conversions = groups[rate]
+            group_days = slice(conversions['first_day'] - first_day, conversions['first_day'] - first_day + conversions['num_of_days'])
+            cumulative[group_days] = conversions['cumulative']
+            population[group_days] = conversions['population']
+        cumulative = np.add.reduceat(cumulative * observed[:, None, :], period_starts, axis=0)
+        population = np.add.reduceat(population[:, :, None] * observed[:, None, :], period_starts, axis=0)
+
+        # Customers not sampled that can reach the status from (or to) by the end of each period
+        unsampled = get_unsampled_customers(df_strata[df_strata['rate'] == rate], last_months, np.arange(1, len(FUNNEL_STAGES) + 1))
+        add_stratum_counts(population_totals, population, rate, unsampled[:, status_pairs[:, 0], None] * period_observed[:, None, :])
+        add_stratum_counts(cumulative_totals, cumulative, rate, unsampled[:, status_pairs[:, 1], None] * period_observed[:, None, :])
+
+    population_errors = get_totals_errors(population_totals)
+    rows_period, rows_pair, rows_lag = np.nonzero((population_totals['estimate'] > 0) | (population_errors > 0))
+    period_strings = np.datetime_as_string(period_days[period_starts].astype('datetime64[D]')).astype(object)
+
+    return pd.DataFrame({
+        'status_datetime_from': pd.Categorical.from_codes(rows_period, categories=period_strings),
+        'status_from': customer_cohort.get_status_categorical(status_pairs[rows_pair, 0]),
+        'status_to': customer_cohort.get_status_categorical(status_pairs[rows_pair, 1]),
+        'datetime_diff_days': rows_lag.astype(np.int32),
+        'status_from_count': population_totals['estimate'][rows_period, rows_pair, rows_lag],
+        'status_from_count_error': population_errors[rows_period, rows_pair, rows_lag],
+        'status_to_cumulative_count': cumulative_totals['estimate'][rows_period, rows_pair, rows_lag],
+        'status_to_cumulative_count_error': get_totals_errors(cumulative_totals)[rows_period, rows_pair, rows_lag],
+    })
+
+
+def get_activity_flags(df_churn):
+    """
+    Function to return, for every activity figure, the activity rows counted on it
+    @param df_churn <pandas DataFrame>: activity rows (see customer_activity.get_customer_activity_dataframe)
+    """
+    return {
+        'active_clients': df_churn['num_of_transactions'].to_numpy() > 0,
+        'new_active_clients': df_churn['flag_new_active'].to_numpy() == 1,
+        'churned_clients': df_churn['flag_churn'].to_numpy() == 1,
+    }
+
+
+def get_activity_totals(df_churn):
+    """
+    Function to return, for every month, the number of active clients (with transactions), new active clients
+    and churned clients
+    @param df_churn <pandas DataFrame>: activity rows (see customer_activity.get_customer_activity_dataframe)
+    """
+    # Similar to:
+    # SELECT transaction_month, SUM(num_of_transactions > 0), SUM(flag_new_active), SUM(flag_churn)
+    # FROM df_churn
+    # GROUP BY transaction_month
+    months = df_churn['transaction_month'].cat.codes.to_numpy()
+    num_of_months = len(df_churn['transaction_month'].cat.categories)
+
+    df_totals = pd.DataFrame({'transaction_month': df_churn['transaction_month'].cat.categories})
+    for columnname, flags in get_activity_flags(df_churn).items():
+        df_totals[columnname] = np.bincount(months, weights=flags, minlength=num_of_months).astype(np.int64)
+
+    return df_totals
+
+
+def get_activity_estimates(df_sample, df_transactions, df_strata, now=None):
+    """
+    Function to return the estimated number of active, new active and churned clients per month, from the first
+    registration month until the current month, with the half width of the 95% confidence interval of every
+    number (<number>_error)
+    @param df_sample <pandas DataFrame>: sampled customers, with their inclusion_probability
+    @param df_transactions <pandas DataFrame>: transactions of the sampled customers
+    @param df_strata <pandas DataFrame>: strata (see get_strata_dataframe)
+    @param now <datetime>: clients have rows until the month of this datetime (defaults to current datetime)
+    """
+    if now is None:
+        now = datetime.now()
+    df_churn = customer_activity.get_customer_activity_dataframe(df_transactions, now=now)
+    probability = pd.Series(df_sample['inclusion_probability'].to_numpy(), index=df_sample['id'].to_numpy()).reindex(df_churn['id']).to_numpy()
+
+    # Counts of the clients sampled at each rate (first index) on each month (second index)
+    #
+    # Similar to:
+    # SELECT p, transaction_month, SUM(num_of_transactions > 0), SUM(flag_new_active), SUM(flag_churn)
+    # FROM df_sample_churn
+    # GROUP BY 1, 2
+    last_month = customer_activity.get_month_numbers(pd.Series([now]))[0]
+    first_month = min(df_strata['registration_month'].min(), last_month + 1) if len(df_strata) else last_month + 1
+    month_numbers = np.arange(first_month, last_month + 1)
+    category_months = customer_activity.get_month_numbers(pd.Series(df_churn['transaction_month'].cat.categories, dtype=object))
+    row_months = category_months[df_churn['transaction_month'].cat.codes.to_numpy()] - first_month
+    rates = np.unique(df_strata['rate'].to_numpy())
+    row_cells = np.searchsorted(rates, probability) * len(month_numbers) + row_months
+
+    # Clients only have transactions after their initial deposit, the last funnel stage
+    unsampled = [
+        get_unsampled_customers(df_strata[df_strata['rate'] == rate], month_numbers, np.array([len(FUNNEL_STAGES)]))[:, 0] for rate in rates
+    ]
+
+    df_totals = pd.DataFrame({'transaction_month': customer_activity.get_month_categorical(month_numbers)})
+    for columnname, flags in get_activity_flags(df_churn).items():
+        counts = np.bincount(row_cells, weights=flags, minlength=len(rates) * len(month_numbers)).reshape(len(rates), len(month_numbers))
+        totals = get_empty_totals(len(month_numbers))
+        for rate, rate_counts, rate_unsampled in zip(rates, counts, unsampled):
+            add_stratum_counts(totals, rate_counts, rate, rate_unsampled)
+        df_totals[columnname] = totals['estimate']
+        df_totals[columnname + '_error'] = get_totals_errors(totals)
+
+    return df_totals
+
+
+def get_coverage(df_estimates, df_exact, keys, columnnames):
+    """
+    Function to compare estimates with the exact figures, returning for every figure the share of exact values
+    inside the 95% confidence intervals and the largest relative error on figures of at least LARGE_FIGURE
+    Rows on which both the exact value and the estimate are zero are left out (any interval covers them)
+    @param df_estimates <pandas DataFrame>: estimated figures with their <figure>_error columns
+    @param df_exact <pandas DataFrame>: exact figures
+    @param keys <list>: columns identifying each row
+    @param columnnames <list>: figures to be compared
+    """
+    df = df_exact.astype({key: str for key in keys}).merge(
+        df_estimates.astype({key: str for key in keys}), on=keys, how='outer', suffixes=('_exact', '')
+    ).fillna(0)
+
+    coverage = {}
+    for columnname in columnnames:
+        df_figure = df[(df[columnname + '_exact'] != 0) | (df[columnname] != 0)]
+        difference = (df_figure[columnname] - df_figure[columnname + '_exact']).abs()
+        large = df_figure[columnname + '_exact'] >= LARGE_FIGURE
+        covered = int((difference <= df_figure[columnname + '_error'] + 1e-6).sum())
+        coverage[columnname] = {
+            'rows': len(df_figure),
+            'covered': covered,
+            'coverage': covered / len(df_figure) if len(df_figure) else 1.0,
+            'max_relative_error': float((difference[large] / df_figure.loc[large, columnname + '_exact']).max()) if large.any() else 0.0,
+        }
+
+    return coverage
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Approximate preview of the cohort conversion and activity figures from a stratified sample of customers")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="sampling rate of the customers")
+    parser.add_argument("--min-per-stratum", type=int, default=DEFAULT_MIN_PER_STRATUM,
+                        help="minimum expected number of sampled customers on each stratum (registration month and funnel stages reached)")
+    parser.add_argument("--max-lag-days", type=int, default=30, help="conversions up to this many days of lag")
+    parser.add_argument("--period", choices=['day', 'week', 'month'], default='month', help="period of the dates from of the conversion table")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the hash sampling the customers")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="customers and transactions read at a time")
+    parser.add_argument("--check", action="store_true",
+                        help="also compute the exact figures and report the share inside the confidence intervals")
+    parser.add_argument("--min-coverage", type=float, default=DEFAULT_MIN_COVERAGE,
+                        help="with --check, exit with an error if less than this share of all exact figures is inside the intervals")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    now = datetime.now()
+    strata_sizes = get_strata_sizes(args.chunk_size)
+    sampling_rates = get_sampling_rates(strata_sizes, args.rate, args.min_per_stratum)
+    df_sample = get_customer_sample(sampling_rates, args.seed, args.chunk_size)
+    df_strata = get_strata_dataframe(strata_sizes, sampling_rates, df_sample)
+    df_transactions = get_sampled_transactions(df_sample, args.chunk_size)
+    print("Sampled {} customers and {} transactions ({:.2f}s)".format(len(df_sample), len(df_transactions), time.perf_counter() - start))
+
+    df_conversion = get_conversion_estimates(df_sample, df_strata, args.max_lag_days, args.period, now)
+    df_activity = get_activity_estimates(df_sample, df_transactions, df_strata, now)
+    storage.write_output(df_conversion.round(1), 'customer_datasource_cohort_conversion_preview')
+    storage.write_output(df_activity.round(1), 'customer_activity_preview')
+    print("New files customer_datasource_cohort_conversion_preview.csv and customer_activity_preview.csv done! ({:.2f}s)".format(time.perf_counter() - start))
+
+    if args.check:
+        df = storage.read_intermediate('customer_datasource', columns=CUSTOMER_COLUMNS)
+        conversions = customer_cohort.get_cumulative_conversions(customer_cohort.add_client_analysis_dt(df), args.max_lag_days, now)
+        df_conversion_exact = customer_cohort.get_conversion_dataframe(conversions, args.period)
+        df_activity_exact = get_activity_totals(customer_activity.get_customer_activity_dataframe(
+            storage.read_intermediate('customer_transactions', columns=['id', 'transaction_datetime']), now=now
+        ))
+
+        coverage = get_coverage(df_conversion, df_conversion_exact, ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'],
+                                ['status_from_count', 'status_to_cumulative_count'])
+        coverage.update(get_coverage(df_activity, df_activity_exact, ['transaction_month'],
+                                     ['active_clients', 'new_active_clients', 'churned_clients']))
+
+        print("{:<30} {:>8} {:>10} {:>20}".format("figure", "rows", "coverage", "max relative error"))
+        for columnname, figure in coverage.items():
+            print("{:<30} {:>8} {:>9.1%} {:>19.1%}".format(columnname, figure['rows'], figure['coverage'], figure['max_relative_error']))
+
+        # Figures with few rows (e.g. months) can miss by chance, so the check uses the coverage of all figures
+        total_coverage = sum(figure['covered'] for figure in coverage.values()) / max(sum(figure['rows'] for figure in coverage.values()), 1)
+        print("Total coverage: {:.1%}".format(total_coverage))
+        if total_coverage < args.min_coverage:
+            print("Coverage below {:.0%}".format(args.min_coverage))
+            sys.exit(1)
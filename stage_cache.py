@@ -0,0 +1,243 @@
+"""
+This script has the content-addressed cache of the pipeline stages.
+
+Every stage run gets a key: a hash of its input files (the intermediate files written by the previous stages),
+the parameters read by the stage (plus the export options and the run date, or the exact run datetime for
+random stages, which generate data until then) and the source code of the stage module and the project modules it imports. The files written by a stage are copied to output/.cache/<key>, so when a
+stage runs again with the same key, its files are restored from the cache instead of being computed again.
+Stages downstream of a changed stage get a new key (their input files changed), so only those run again.
+The least recently used entries are evicted once the cache gets bigger than its maximum size.
+"""
+
+import ast
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import storage
+
+
+# Folder inside the output folder where the cached stage files are stored
+CACHE_FOLDER = '.cache'
+
+# File of each cache entry listing the outputs it contains
+MANIFEST_FILENAME = 'manifest.json'
+
+# Parameters that don't change the output files of any stage
+IGNORED_PARAMS = ['now', 'watermark', 'generation_workers', 'export_workers', 'profile', 'duckdb_memory_limit', 'cache', 'cache_max_mb']
+
+# Parameters changing the files written by every stage (see export.get_export_options)
+EXPORT_PARAMS = ['export_compression', 'export_hyper']
+
+# Size of the blocks read when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def get_file_hash(path, digest):
+    """
+    Function to add the content of a file to a hash
+    @param path <string>: path of the file
+    @param digest <hashlib hash>: hash being computed
+    """
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+
+def get_module_paths(module_name, paths=None):
+    """
+    Function to return the source files of a project module and of every project module it imports (recursively)
+    Imports are read from the source code, without importing the modules
+    @param module_name <string>: name of the module
+    @param paths <dict>: source files found so far, by module name
+    """
+    paths = {} if paths is None else paths
+    project_folder = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.find_spec(module_name)
+    if module_name in paths or spec is None or spec.origin is None or os.path.dirname(spec.origin) != project_folder:
+        return paths
+
+    paths[module_name] = spec.origin
+    with open(spec.origin) as module_file:
+        module_tree = ast.parse(module_file.read())
+    for node in ast.walk(module_tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                get_module_paths(alias.name, paths)
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+            get_module_paths(node.module, paths)
+
+    return paths
+
+
+def get_stage_params(stage_name):
+    """
+    Function to return the names of the pipeline parameters read by a stage module (params['name'] or params.get('name'))
+    Parameters are read from the source code, so changing a parameter only changes the keys of the stages using it
+    @param stage_name <string>: name of the stage module
+    """
+    with open(importlib.util.find_spec(stage_name).origin) as module_file:
+        module_tree = ast.parse(module_file.read())
+
+    stage_params = set()
+    for node in ast.walk(module_tree):
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == 'params':
+            if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                stage_params.add(node.slice.value)
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'get':
+            if isinstance(node.func.value, ast.Name) and node.func.value.id == 'params' and node.args:
+                if isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+                    stage_params.add(node.args[0].value)
+
+    return stage_params
+
+
+def get_stage_key(stage_name, inputs, params, random=False):
+    """
+    Function to return the cache key of a stage run
+    @param stage_name <string>: name of the stage module
+    @param inputs <list>: names of the stage inputs (their intermediate files must be written already)
+    @param params <dict>: pipeline parameters
+    @param random <bool>: if True, the stage generates random data until the run datetime (see STAGE_RANDOM)
+    """
+    digest = hashlib.sha256()
+    digest.update(stage_name.encode('utf-8'))
+
+    # Input files
+    for name in sorted(inputs):
+        digest.update(name.encode('utf-8'))
+        for path in storage.get_intermediate_files(name):
+            get_file_hash(path, digest)
+
+    # Parameters read by the stage and the export options, with the run date instead of the exact datetime
+    # (random stages generate the data visible until the exact datetime, so it's part of their key)
+    key_params = {
+        name: params.get(name)
+        for name in sorted(get_stage_params(stage_name) | set(EXPORT_PARAMS))
+        if name not in IGNORED_PARAMS
+    }
+    if random:
+        key_params['now'] = params['now'].isoformat()
+    else:
+        key_params['run_date'] = params['now'].strftime('%Y-%m-%d')
+    digest.update(json.dumps(key_params, sort_keys=True, default=str).encode('utf-8'))
+
+    # Code of the stage and of the project modules it uses
+    for module_name, path in sorted(get_module_paths(stage_name).items()):
+        digest.update(module_name.encode('utf-8'))
+        get_file_hash(path, digest)
+
+    return digest.hexdigest()
+
+
+def get_entry_path(key):
+    """
+    Function to return the folder of a cache entry
+    @param key <string>: cache key of the stage run
+    """
+    return os.path.join(storage.get_output_path(CACHE_FOLDER), key)
+
+
+def restore(key, outputs):
+    """
+    Function to copy the files of a cache entry back to the output folder
+    Returns the names of the outputs restored, or None if the key is not on the cache
+    @param key <string>: cache key of the stage run
+    @param outputs <list>: names of the outputs declared by the stage
+    """
+    entry_path = get_entry_path(key)
+    try:
+        with open(os.path.join(entry_path, MANIFEST_FILENAME)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+    for name in outputs:
+        # Files of the previous run (e.g. appended parts or the hyper file of an output with
+        # different export options) don't belong to the restored ones
+        for path in glob.glob(storage.get_output_path(name + '.*')):
+            os.remove(path)
+    for filename in manifest['files']:
+        shutil.copyfile(os.path.join(entry_path, filename), storage.get_output_path(filename))
+
+    # Entries are evicted by least recent use
+    os.utime(entry_path)
+
+    return manifest['outputs']
+
+
+def get_output_name(path):
+    """
+    Function to return the name of the output of a file (e.g. customer_activity for customer_activity.csv.gz)
+    @param path <string>: path of the file
+    """
+    return os.path.basename(path).split('.', 1)[0]
+
+
+def store(key, outputs, paths, max_mb=None):
+    """
+    Function to copy the files written by a stage run to a new cache entry, evicting old entries if needed
+    Returns the number of files stored
+    @param key <string>: cache key of the stage run
+    @param outputs <list>: names of the outputs declared by the stage
+    @param paths <list>: paths of the files written by the stage run (see storage.pop_written_paths)
+    @param max_mb <float>: maximum size of the cache in MB (None for no limit)
+    """
+    files = {}
+    for path in paths:
+        if get_output_name(path) in outputs and os.path.isfile(path):
+            files.setdefault(get_output_name(path), []).append(os.path.basename(path))
+    if not files:
+        return 0
+
+    # The entry is written to a temporary folder first, so a partial entry is never restored
+    entry_path = get_entry_path(key)
+    temp_path = entry_path + '.tmp{}'.format(os.getpid())
+    os.makedirs(temp_path, exist_ok=True)
+    for filenames in files.values():
+        for filename in filenames:
+            shutil.copyfile(storage.get_output_path(filename), os.path.join(temp_path, filename))
+    with open(os.path.join(temp_path, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump({'outputs': sorted(files), 'files': sorted(sum(files.values(), []))}, manifest_file)
+    try:
+        os.rename(temp_path, entry_path)
+    except OSError:
+        # Another process already stored the same key
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    if max_mb is not None:
+        evict(max_mb)
+
+    return sum(len(filenames) for filenames in files.values())
+
+
+def get_entry_size(entry_path):
+    """
+    Function to return the size in bytes of the files of a cache entry
+    @param entry_path <string>: folder of the cache entry
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(entry_path) if entry.is_file())
+
+
+def evict(max_mb):
+    """
+    Function to remove the least recently used cache entries until the cache fits its maximum size
+    @param max_mb <float>: maximum size of the cache in MB
+    """
+    cache_path = storage.get_output_path(CACHE_FOLDER)
+    entries = []
+    for entry in os.scandir(cache_path):
+        if entry.is_dir() and '.tmp' not in entry.name:
+            try:
+                entries.append((entry.stat().st_mtime, get_entry_size(entry.path), entry.path))
+            except FileNotFoundError:
+                continue
+
+    cache_bytes = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if cache_bytes <= max_mb * 1024 * 1024:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        cache_bytes -= size
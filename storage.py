@@ -0,0 +1,729 @@
+"""
+This script handles how files are written to and read from the output folder.
+
+Files handed off between stages (intermediates) are written in a typed columnar format
+(Arrow IPC or Parquet, with real timestamp and categorical columns) and memory-mapped on read,
+while the csv files used by Tableau are still written as the final export (see export.py).
+If pyarrow is not installed, the csv files themselves are used as intermediates.
+"""
+
+import os
+import glob
+import json
+import pandas as pd
+import numpy as np
+import export
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+except ImportError:
+    feather = None
+
+
+OUTPUT_FOLDER = 'output'
+
+# File storing the last generated datetime and the parameters of the dataset (used by incremental runs)
+WATERMARK_FILENAME = 'watermark.json'
+
+# Extension of the file listing the monthly partitions of an output (see write_output_partitions)
+PARTITIONS_EXTENSION = '.partitions.json'
+
+# Extension of each intermediate file format
+INTERMEDIATE_FORMATS = {
+    'arrow': '.arrow',
+    'parquet': '.parquet',
+    'csv': '.csv',
+}
+
+# Arrow IPC files (uncompressed) can be memory-mapped without copying
+INTERMEDIATE_FORMAT = 'arrow' if feather is not None else 'csv'
+
+# Typed columns for each file
+DATETIME_COLUMNS = {
+    'customer_datasource': [
+        'account_registration_dt',
+        'account_email_confirmation_dt',
+        'client_registration_dt',
+        'client_approval_dt',
+        'client_denial_dt',
+        'client_initial_deposit_dt',
+    ],
+    'customer_transactions': ['transaction_datetime'],
+    'customer_balance': ['first_transaction_datetime', 'last_transaction_datetime'],
+    'customer_funnel': [
+        'account_registration_dt',
+        'account_email_confirmation_dt',
+        'client_registration_dt',
+        'client_analysis_dt',
+        'client_initial_deposit_dt',
+    ],
+}
+CATEGORY_COLUMNS = {
+    'customer_datasource': ['status'],
+    'customer_transactions': ['operation'],
+}
+
+# Paths of the files written by the current process since they were last collected (see pop_written_paths)
+WRITTEN_PATHS = []
+
+
+def get_output_path(filename):
+    """
+    Function to return the path of a file inside the output folder (creating the folder if needed)
+    @param filename <string>: name of the file
+    """
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    return os.path.join(OUTPUT_FOLDER, filename)
+
+
+def record_written_path(path):
+    """
+    Function to record that a file of the output folder was written by the current process
+    @param path <string>: path of the file
+    """
+    if path not in WRITTEN_PATHS:
+        WRITTEN_PATHS.append(path)
+
+
+def pop_written_paths():
+    """
+    Function to return the paths of the files written by the current process, in the order they were first
+    written, and clear them (the pipeline collects the files written by each stage, see stage_cache.py)
+    """
+    paths = list(WRITTEN_PATHS)
+    WRITTEN_PATHS.clear()
+
+    return paths
+
+
+def get_typed_dataframe(df, name, categories=True):
+    """
+    Function to convert the datetime and categorical columns of a file to their real dtypes
+    @param df <pandas DataFrame>: dataframe to be converted
+    @param name <string>: name of the file (without extension)
+    @param categories <bool>: if False, categorical columns are kept as strings
+        (chunks written to the same file must share the same schema)
+    """
+    df = df.copy()
+    for columnname in DATETIME_COLUMNS.get(name, []):
+        if columnname in df.columns:
+            df[columnname] = pd.to_datetime(df[columnname], format='%Y-%m-%d %H:%M:%S')
+    for columnname in CATEGORY_COLUMNS.get(name, []):
+        if columnname in df.columns and categories:
+            df[columnname] = df[columnname].astype('category')
+
+    return df
+
+
+def get_values_before(values, value):
+    """
+    Function to flag the values of a column sorting before a value (e.g. dates before '%Y-%m-%d')
+    Categorical columns are compared through their categories, so values are never converted to strings
+    @param values <pandas Series>: column of strings or categorical strings
+    @param value <string>: value to compare with
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        return pd.Series((np.asarray(values.cat.categories) < value)[codes] & (codes >= 0), index=values.index)
+
+    return values < value
+
+
+def concat_dataframes(objs):
+    """
+    Function to union dataframes with the same columns, keeping the columns that are categorical on every
+    dataframe categorical (with the union of their categories), instead of converting them to strings
+    @param objs <list>: dataframes to be unioned
+    """
+    for columnname in objs[0].columns:
+        if all(isinstance(obj[columnname].dtype, pd.CategoricalDtype) for obj in objs):
+            categories = pd.Index(np.concatenate([obj[columnname].cat.categories.to_numpy() for obj in objs])).unique().sort_values()
+            objs = [obj.assign(**{columnname: obj[columnname].cat.set_categories(categories)}) for obj in objs]
+
+    return pd.concat(objs=objs, ignore_index=True)
+
+
+def write_intermediate(df, name, file_format=None):
+    """
+    Function to write a dataframe to be read by other stages
+    @param df <pandas DataFrame>: dataframe to be written
+    @param name <string>: name of the file (without extension)
+    @param file_format <string>: arrow, parquet or csv (defaults to INTERMEDIATE_FORMAT)
+    """
+    file_format = file_format or INTERMEDIATE_FORMAT
+
+    # csv intermediates are the exported csv files themselves
+    if file_format == 'csv':
+        return
+
+    # A new file replaces any part appended to the previous one
+    for path in get_intermediate_paths(name, file_format)[1:]:
+        os.remove(path)
+
+    write_intermediate_part(df, get_output_path(name + INTERMEDIATE_FORMATS[file_format]), name, file_format)
+
+
+def write_intermediate_part(df, path, name, file_format):
+    """
+    Function to write a dataframe to a single intermediate file
+    @param df <pandas DataFrame>: dataframe to be written
+    @param path <string>: path of the file
+    @param name <string>: name of the file (without extension)
+    @param file_format <string>: arrow or parquet
+    """
+    df = get_typed_dataframe(df, name).reset_index(drop=True)
+    if file_format == 'arrow':
+        feather.write_feather(df, path, compression='uncompressed')
+    else:
+        df.to_parquet(path, index=False)
+    record_written_path(path)
+
+
+def get_intermediate_paths(name, file_format):
+    """
+    Function to return the paths of the existing intermediate file and its appended parts, in order
+    @param name <string>: name of the file (without extension)
+    @param file_format <string>: arrow or parquet
+    """
+    extension = INTERMEDIATE_FORMATS[file_format]
+    path = get_output_path(name + extension)
+    if not os.path.exists(path):
+        return []
+    part_paths = glob.glob(get_output_path(name + '.part*' + extension))
+
+    return [path] + sorted(part_paths, key=lambda part_path: int(part_path[:-len(extension)].rsplit('.part', 1)[1]))
+
+
+def append_intermediate(df, name, file_format=None):
+    """
+    Function to append new rows to an intermediate file, written as a new part next to it
+    @param df <pandas DataFrame>: dataframe with the new rows
+    @param name <string>: name of the file (without extension)
+    @param file_format <string>: arrow, parquet or csv (defaults to INTERMEDIATE_FORMAT)
+    """
+    file_format = file_format or INTERMEDIATE_FORMAT
+
+    # csv intermediates are the exported csv files themselves
+    if file_format == 'csv':
+        return
+
+    paths = get_intermediate_paths(name, file_format)
+    if not paths:
+        write_intermediate(df, name, file_format)
+        return
+
+    part_path = get_output_path('{}.part{}{}'.format(name, len(paths), INTERMEDIATE_FORMATS[file_format]))
+    write_intermediate_part(df, part_path, name, file_format)
+
+
+def read_intermediate(name, columns=None, file_format=None, min_partition=None, max_partition=None, since=None):
+    """
+    Function to read a dataframe written by another stage
+    If the columnar file is not available, the exported csv file is read instead
+    @param name <string>: name of the file (without extension)
+    @param columns <list>: columns to be read (None for all columns)
+    @param file_format <string>: arrow, parquet or csv (defaults to INTERMEDIATE_FORMAT)
+    @param min_partition <string>: if set, only reads the monthly partitions from this one on ('%Y-%m', see write_output_partitions)
+    @param max_partition <string>: if set, only reads the monthly partitions up to this one
+    @param since <tuple>: if set, only reads the rows with a datetime column on or after a datetime (columnname, datetime)
+    """
+    file_format = file_format or INTERMEDIATE_FORMAT
+    paths = get_intermediate_paths(name, file_format) if file_format != 'csv' else []
+
+    if file_format != 'csv' and paths:
+        read_columns = columns
+        if since is not None and columns is not None and since[0] not in columns:
+            read_columns = columns + [since[0]]
+        selected_paths = get_partition_paths(name, paths, min_partition, max_partition)
+
+        objs = []
+        for path in selected_paths or paths[-1:]:
+            if file_format == 'arrow':
+                table = feather.read_table(path, columns=read_columns, memory_map=True)
+            else:
+                table = parquet.read_table(path, columns=read_columns)
+            if not selected_paths:
+                table = table.slice(0, 0)
+            if since is not None:
+                # Rows are filtered before being converted to pandas, so only the matching rows are copied
+                column = table[since[0]]
+                table = table.filter(pa.compute.greater_equal(column, pa.scalar(pd.Timestamp(since[1]), type=column.type)))
+            objs.append(table.to_pandas())
+        df = concat_dataframes(objs) if len(objs) > 1 else objs[0]
+        return df[columns] if read_columns is not columns else df
+
+    df = get_typed_dataframe(get_csv_dataframe(pd.read_csv(get_csv_path(name))), name)
+    rows = np.ones(len(df), dtype=bool)
+    partitions = read_partitions(name)
+    if partitions is not None and (min_partition is not None or max_partition is not None):
+        row_partitions = get_partition_values(df[partitions['column']])
+        if min_partition is not None:
+            rows &= row_partitions >= min_partition
+        if max_partition is not None:
+            rows &= row_partitions <= max_partition
+    if since is not None:
+        rows &= (pd.to_datetime(df[since[0]]) >= pd.Timestamp(since[1])).to_numpy()
+    df = df[rows].reset_index(drop=True)
+    if columns is not None:
+        df = df[columns]
+
+    return df
+
+
+def get_intermediate_files(name, file_format=None):
+    """
+    Function to return the paths of the files read by read_intermediate (columnar file and parts, or the csv file)
+    @param name <string>: name of the file (without extension)
+    @param file_format <string>: arrow, parquet or csv (defaults to INTERMEDIATE_FORMAT)
+    """
+    file_format = file_format or INTERMEDIATE_FORMAT
+    paths = get_intermediate_paths(name, file_format) if file_format != 'csv' else []
+
+    return paths or [get_csv_path(name)]
+
+
+def get_csv_path(name):
+    """
+    Function to return the path of the exported csv file of an output (compressed or not)
+    If there's no exported file yet, the path of the uncompressed one is returned
+    @param name <string>: name of the file (without extension)
+    """
+    for compression in [None, 'gzip']:
+        path = get_output_path(name + export.get_csv_extension(compression))
+        if os.path.exists(path):
+            return path
+
+    return get_output_path(name + '.csv')
+
+
+def get_csv_dataframe(df):
+    """
+    Function to return a dataframe read from an exported csv file without the index column
+    written by older versions of the project
+    @param df <pandas DataFrame>: dataframe read from the csv file
+    """
+    return df.drop(columns=['Unnamed: 0'], errors='ignore')
+
+
+def write_export(df, name, append=False, export_options=None):
+    """
+    Function to write the csv file used by Tableau (and, optionally, the Hyper extract)
+    A new csv file replaces the previous one, compressed or not
+    @param df <pandas DataFrame>: dataframe to be written
+    @param name <string>: name of the file (without extension)
+    @param append <bool>: if True, rows are appended to the existing files
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    """
+    export_options = dict(export.DEFAULT_EXPORT_OPTIONS, **(export_options or {}))
+
+    if append and os.path.exists(get_csv_path(name)):
+        path = get_csv_path(name)
+        compression = 'gzip' if path.endswith('.gz') else None
+    else:
+        compression = export_options['compression']
+        path = get_output_path(name + export.get_csv_extension(compression))
+        if get_csv_path(name) != path and os.path.exists(get_csv_path(name)):
+            os.remove(get_csv_path(name))
+        append = False
+    export.write_csv(df, path, append, export_options['workers'], compression)
+    record_written_path(path)
+
+    if export_options['hyper']:
+        export.write_hyper(df, get_output_path(name + '.hyper'), append)
+        record_written_path(get_output_path(name + '.hyper'))
+
+
+def truncate_export(name, csv_offset, column, min_value, export_options=None):
+    """
+    Function to remove the last rows of the csv file used by Tableau (and of the Hyper extract), so new rows can replace them
+    @param name <string>: name of the file (without extension)
+    @param csv_offset <int>: byte offset of the first row removed from the csv file (gzip files are only cut between members)
+    @param column <string>: column of the rows removed from the Hyper extract
+    @param min_value <string>: rows of the Hyper extract with the column on or after this value are removed
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    """
+    with open(get_csv_path(name), 'r+b') as csv_file:
+        csv_file.truncate(csv_offset)
+
+    hyper_path = get_output_path(name + '.hyper')
+    if (export_options or {}).get('hyper') and os.path.exists(hyper_path):
+        export.delete_hyper_rows(hyper_path, column, min_value)
+        record_written_path(hyper_path)
+
+
+def write_output(df, name, intermediate=False, export=True, export_options=None):
+    """
+    Function to write the csv file used by Tableau and, optionally, the intermediate file for other stages
+    @param df <pandas DataFrame>: dataframe to be written
+    @param name <string>: name of the file (without extension)
+    @param intermediate <bool>: if True, also writes the intermediate file
+    @param export <bool>: if False, the csv file is only written when it's the intermediate file itself
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    """
+    if export:
+        write_export(df, name, export_options=export_options)
+    elif INTERMEDIATE_FORMAT == 'csv':
+        write_export(df, name)
+    if intermediate:
+        write_intermediate(df, name)
+
+
+def iter_intermediate_chunks(name, columns=None, chunk_size=100000, min_partition=None):
+    """
+    Function to read a dataframe written by another stage in chunks, so it never has to fit in memory
+    @param name <string>: name of the file (without extension)
+    @param columns <list>: columns to be read (None for all columns)
+    @param chunk_size <int>: maximum number of rows on each chunk
+    @param min_partition <string>: if set, only reads the monthly partitions from this one on ('%Y-%m', see write_output_partitions)
+    """
+    paths = get_intermediate_paths(name, INTERMEDIATE_FORMAT) if INTERMEDIATE_FORMAT != 'csv' else []
+    if paths:
+        paths = get_partition_paths(name, paths, min_partition)
+
+    if INTERMEDIATE_FORMAT == 'arrow' and paths:
+        # Record batches are read one at a time from the memory-mapped file (reading the whole table with
+        # a subset of columns would copy those columns into memory)
+        for path in paths:
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            for batch_index in range(reader.num_record_batches):
+                batch = reader.get_batch(batch_index)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for offset in range(0, batch.num_rows, chunk_size):
+                    yield batch.slice(offset, chunk_size).to_pandas()
+
+    elif INTERMEDIATE_FORMAT == 'parquet' and paths:
+        for path in paths:
+            for batch in parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+                yield batch.to_pandas()
+
+    elif INTERMEDIATE_FORMAT == 'csv' or not get_intermediate_paths(name, INTERMEDIATE_FORMAT):
+        partitions = read_partitions(name)
+        for df in pd.read_csv(get_csv_path(name), chunksize=chunk_size):
+            df = get_csv_dataframe(df)
+            if min_partition is not None and partitions is not None:
+                df = df[get_partition_values(df[partitions['column']]) >= min_partition]
+            if columns is not None:
+                df = df[columns]
+            yield get_typed_dataframe(df, name)
+
+
+def write_output_chunks(chunks, name, append=False, export_options=None):
+    """
+    Function to write the csv file used by Tableau and the intermediate file from a sequence of chunks,
+    writing each chunk as soon as it's created so only one chunk is kept in memory
+    Returns the number of rows written
+    @param chunks <iterable>: dataframes to be written, in order
+    @param name <string>: name of the file (without extension)
+    @param append <bool>: if True, the chunks are appended to the existing files
+    @param export_options <dict>: compression and hyper (see export.get_export_options), chunks are
+        already created one at a time, so each one is formatted by the current process
+    """
+    export_options = dict(export_options or {}, workers=1)
+    num_of_rows = 0
+
+    # Intermediate chunks are written to a new file (or a new part when appending)
+    intermediate_writer = None
+    intermediate_schema = None
+    if INTERMEDIATE_FORMAT != 'csv':
+        extension = INTERMEDIATE_FORMATS[INTERMEDIATE_FORMAT]
+        paths = get_intermediate_paths(name, INTERMEDIATE_FORMAT)
+        if append and paths:
+            intermediate_path = get_output_path('{}.part{}{}'.format(name, len(paths), extension))
+        else:
+            for path in paths:
+                os.remove(path)
+            intermediate_path = get_output_path(name + extension)
+
+    for df in chunks:
+        write_export(df, name, append or num_of_rows > 0, export_options)
+
+        if INTERMEDIATE_FORMAT != 'csv':
+            table = pa.Table.from_pandas(get_typed_dataframe(df, name, categories=False), preserve_index=False)
+            if intermediate_writer is None:
+                intermediate_schema = table.schema
+                if INTERMEDIATE_FORMAT == 'arrow':
+                    intermediate_writer = pa.ipc.new_file(intermediate_path, intermediate_schema)
+                else:
+                    intermediate_writer = parquet.ParquetWriter(intermediate_path, intermediate_schema)
+            intermediate_writer.write_table(table.cast(intermediate_schema))
+
+        num_of_rows += len(df)
+
+    if intermediate_writer is not None:
+        intermediate_writer.close()
+        record_written_path(intermediate_path)
+
+    return num_of_rows
+
+
+def get_month_start(value):
+    """
+    Function to return the first day of the month of a datetime
+    @param value <datetime>: datetime
+    """
+    return pd.Timestamp(value).to_period('M').to_timestamp()
+
+
+def get_partition(value):
+    """
+    Function to return the monthly partition ('%Y-%m') of a datetime
+    @param value <datetime>: datetime
+    """
+    return pd.Timestamp(value).strftime('%Y-%m')
+
+
+def get_partition_values(values):
+    """
+    Function to return the monthly partition ('%Y-%m') of every value of a column
+    Categorical columns are converted through their categories, so each distinct date is only parsed once
+    @param values <pandas Series>: column of datetimes, '%Y-%m-%d...' strings or categorical strings
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = np.append(get_partition_values(pd.Series(np.asarray(values.cat.categories))), None)
+        return categories[values.cat.codes.to_numpy()]
+
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        months = values.to_numpy(dtype='datetime64[M]')
+        return np.where(np.isnat(months), None, np.datetime_as_string(months)).astype(object)
+
+    # Dates are formatted as '%Y-%m-%d...' strings, so the month is their first 7 characters
+    return values.str.slice(0, 7).to_numpy(dtype=object)
+
+
+def iter_partitions(df, column):
+    """
+    Generator of the (partition, rows) of a dataframe sorted by partition
+    @param df <pandas DataFrame>: dataframe sorted by the month of the column
+    @param column <string>: column the rows are partitioned by
+    """
+    row_partitions = get_partition_values(df[column])
+    if pd.isnull(row_partitions).any():
+        raise ValueError("Rows of {} without a partition (null {} values)".format(column, column))
+    starts = np.flatnonzero(np.r_[True, row_partitions[1:] != row_partitions[:-1]]) if len(row_partitions) else []
+    for start, end in zip(starts, np.append(starts[1:], len(row_partitions)).astype(np.int64)):
+        yield row_partitions[start], df.iloc[start:end]
+
+
+def get_partitions_path(name):
+    """
+    Function to return the path of the file listing the monthly partitions of an output
+    @param name <string>: name of the file (without extension)
+    """
+    return get_output_path(name + PARTITIONS_EXTENSION)
+
+
+def read_partitions(name):
+    """
+    Function to read the monthly partitions of an output (None if it wasn't written by partitions)
+    Returns the column the rows are partitioned by and, for every partition in order, its month ('%Y-%m')
+    and the byte offset where its rows start on the exported csv file
+    @param name <string>: name of the file (without extension)
+    """
+    path = get_partitions_path(name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as partitions_file:
+        return json.load(partitions_file)
+
+
+def get_partition_paths(name, paths, min_partition=None, max_partition=None):
+    """
+    Function to return the intermediate paths of the partitions in a range (partitions are written in order, one per file)
+    @param name <string>: name of the file (without extension)
+    @param paths <list>: intermediate paths of the output (see get_intermediate_paths)
+    @param min_partition <string>: first partition ('%Y-%m'), None for the first one
+    @param max_partition <string>: last partition ('%Y-%m'), None for the last one
+    """
+    if min_partition is None and max_partition is None:
+        return paths
+
+    partitions = read_partitions(name)
+    if partitions is None:
+        raise ValueError("{} wasn't written by partitions, run a full refresh first".format(name))
+
+    return [
+        path for path, partition in zip(paths, partitions['partitions'])
+        if (min_partition is None or partition['partition'] >= min_partition) and (max_partition is None or partition['partition'] <= max_partition)
+    ]
+
+
+def write_partitions(chunks, name, column, replace=False, export=True, export_options=None, categories=False):
+    """
+    Function to write an output as monthly partitions (by the month of a column), from chunks sorted by partition
+    Every partition is written to its own intermediate file (the output file and its parts, in order), and the byte
+    offset where its rows start on the csv file is kept (see read_partitions), so the partitions from a month on can
+    be replaced without rewriting the previous ones
+    Returns the number of rows written
+    @param chunks <iterable>: dataframes to be written, sorted by the month of the column
+    @param name <string>: name of the file (without extension)
+    @param column <string>: column the rows are partitioned by
+    @param replace <bool>: if True, the rows replace the partitions from the month of the first row on (the previous
+        partitions are kept), instead of the whole output
+    @param export <bool>: if False, the csv file is only written when it's the intermediate file itself
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    @param categories <bool>: if True, every partition is a single chunk and categorical columns are kept categorical
+        on the intermediate files (chunks written to the same file must share the same schema)
+    """
+    write_csv = export or INTERMEDIATE_FORMAT == 'csv'
+    paths = get_intermediate_paths(name, INTERMEDIATE_FORMAT) if INTERMEDIATE_FORMAT != 'csv' else []
+    previous_partitions = read_partitions(name) if replace else None
+    if replace and previous_partitions is None:
+        raise ValueError("{} wasn't written by partitions, run a full refresh first".format(name))
+    extension = INTERMEDIATE_FORMATS[INTERMEDIATE_FORMAT]
+
+    partitions = None
+    intermediate_writer = None
+    intermediate_schema = None
+    df_empty = None
+    num_of_rows = 0
+    for df in chunks:
+        if df_empty is None:
+            df_empty = df.iloc[:0]
+        for partition, df_partition in iter_partitions(df, column):
+            if partitions is None:
+                # Partitions from the first one written on are removed, the previous ones are kept
+                #
+                # Similar to:
+                # DELETE FROM output WHERE month(column) >= first_partition
+                partitions = []
+                if replace:
+                    partitions = [previous for previous in previous_partitions['partitions'] if previous['partition'] < partition]
+                    if write_csv and len(partitions) < len(previous_partitions['partitions']):
+                        truncate_export(
+                            name, previous_partitions['partitions'][len(partitions)]['csv_offset'], column, partition + '-01',
+                            export_options if export else None
+                        )
+                for path in paths[len(partitions):]:
+                    os.remove(path)
+
+            if not partitions or partitions[-1]['partition'] != partition:
+                if partitions and partition < partitions[-1]['partition']:
+                    raise ValueError("Partitions of {} must be written in order".format(name))
+                if intermediate_writer is not None:
+                    intermediate_writer.close()
+                    intermediate_writer = None
+                csv_offset = os.path.getsize(get_csv_path(name)) if write_csv and partitions else 0
+                partitions.append({'partition': partition, 'csv_offset': csv_offset})
+                new_partition = True
+            elif categories:
+                raise ValueError("Every partition of {} must be a single chunk".format(name))
+            else:
+                new_partition = False
+
+            if write_csv:
+                write_export(df_partition, name, len(partitions) > 1 or not new_partition, export_options if export else None)
+
+            if INTERMEDIATE_FORMAT != 'csv':
+                intermediate_path = get_output_path(name + (extension if len(partitions) == 1 else '.part{}{}'.format(len(partitions) - 1, extension)))
+                if categories:
+                    write_intermediate_part(df_partition, intermediate_path, name, INTERMEDIATE_FORMAT)
+                else:
+                    table = pa.Table.from_pandas(get_typed_dataframe(df_partition, name, categories=False), preserve_index=False)
+                    if intermediate_writer is None:
+                        intermediate_schema = table.schema
+                        if INTERMEDIATE_FORMAT == 'arrow':
+                            intermediate_writer = pa.ipc.new_file(intermediate_path, intermediate_schema)
+                        else:
+                            intermediate_writer = parquet.ParquetWriter(intermediate_path, intermediate_schema)
+                        record_written_path(intermediate_path)
+                    intermediate_writer.write_table(table.cast(intermediate_schema))
+
+            num_of_rows += len(df_partition)
+
+    if intermediate_writer is not None:
+        intermediate_writer.close()
+
+    # Without rows, a full write still leaves empty files with the columns (and nothing is replaced)
+    if partitions is None:
+        if replace or df_empty is None:
+            return 0
+        write_output(df_empty, name, intermediate=True, export=export, export_options=export_options)
+        partitions = []
+
+    with open(get_partitions_path(name), 'w') as partitions_file:
+        json.dump({'column': column, 'partitions': partitions}, partitions_file)
+    record_written_path(get_partitions_path(name))
+
+    return num_of_rows
+
+
+def write_partitioned_output(df, name, column, replace=False, export=True, export_options=None):
+    """
+    Function to write an output as monthly partitions (see write_partitions), sorting its rows by partition first
+    Returns the number of rows written
+    @param df <pandas DataFrame>: dataframe to be written
+    @param name <string>: name of the file (without extension)
+    @param column <string>: column the rows are partitioned by
+    @param replace <bool>: if True, the rows replace the partitions from the month of the first row on
+    @param export <bool>: if False, the csv file is only written when it's the intermediate file itself
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    """
+    # Stable sort, so rows keep their order inside each partition
+    row_partitions = get_partition_values(df[column])
+    if len(row_partitions) > 1 and (row_partitions[1:] < row_partitions[:-1]).any():
+        df = df.iloc[np.argsort(row_partitions, kind='stable')]
+
+    return write_partitions([df], name, column, replace, export, export_options, categories=True)
+
+
+def write_output_partitions(chunks, name, column, replace=False, export_options=None):
+    """
+    Function to write an output as monthly partitions (see write_partitions) from a sequence of chunks sorted by
+    partition, writing each chunk as soon as it's created so only one chunk is kept in memory
+    Returns the number of rows written
+    @param chunks <iterable>: dataframes to be written, sorted by the month of the column
+    @param name <string>: name of the file (without extension)
+    @param column <string>: column the rows are partitioned by
+    @param replace <bool>: if True, the rows replace the partitions from the month of the first row on
+    @param export_options <dict>: compression and hyper (see export.get_export_options), chunks are
+        already created one at a time, so each one is formatted by the current process
+    """
+    return write_partitions(chunks, name, column, replace, export_options=dict(export_options or {}, workers=1))
+
+
+def append_output(df, name, export_options=None):
+    """
+    Function to append new rows to the csv file used by Tableau and to the intermediate file
+    @param df <pandas DataFrame>: dataframe with the new rows
+    @param name <string>: name of the file (without extension)
+    @param export_options <dict>: workers, compression and hyper (see export.get_export_options)
+    """
+    write_export(df, name, append=True, export_options=export_options)
+    append_intermediate(df, name)
+
+
+def read_watermark():
+    """
+    Function to read the watermark of the last run (None if there's no watermark)
+    """
+    path = get_output_path(WATERMARK_FILENAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as watermark_file:
+        watermark = json.load(watermark_file)
+    watermark['last_datetime'] = pd.Timestamp(watermark['last_datetime']).to_pydatetime()
+    if 'dataset' in watermark:
+        watermark['dataset']['start'] = pd.Timestamp(watermark['dataset']['start']).to_pydatetime()
+
+    return watermark
+
+
+def write_watermark(last_datetime, dataset):
+    """
+    Function to write the watermark with the last generated datetime and the parameters of the dataset
+    @param last_datetime <datetime>: datetime until when data was generated
+    @param dataset <dict>: parameters defining the generated dataset, kept by incremental runs
+        (see customer_registration.get_dataset_params)
+    """
+    watermark = {
+        'last_datetime': pd.Timestamp(last_datetime).strftime('%Y-%m-%d %H:%M:%S'),
+        'dataset': dict(dataset, start=pd.Timestamp(dataset['start']).strftime('%Y-%m-%d %H:%M:%S')),
+    }
+    with open(get_output_path(WATERMARK_FILENAME), 'w') as watermark_file:
+        json.dump(watermark, watermark_file)
@@ -0,0 +1,92 @@
+"""
+Fixtures shared by the tests: a small dataset generated once by the whole pipeline, with a fixed seed and run datetime,
+so every test reads the same files
+"""
+
+import os
+import shutil
+import sys
+from datetime import datetime
+import pytest
+
+# Stage modules are top level modules of the project folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+import pipeline
+import customer_registration
+
+
+# Parameters of the test dataset (months back long enough for weekly and monthly rollups and churned clients)
+DATASET_PARAMS = {
+    'number_of_customers': 3000,
+    'months_back': 6,
+    'seed': 42,
+    'now': datetime(2024, 3, 15, 12, 0, 0),
+}
+
+
+def run_pipeline(folder, params=None, outputs=None, incremental=False):
+    """
+    Function to run the pipeline on a folder (in the current process), with the dataset parameters
+    @param folder <string>: output folder
+    @param params <dict>: parameters replacing the dataset ones
+    @param outputs <list>: names of the outputs to build (None for all outputs)
+    @param incremental <bool>: if True, runs an incremental refresh
+    """
+    output_folder = storage.OUTPUT_FOLDER
+    storage.OUTPUT_FOLDER = str(folder)
+    try:
+        pipeline.run_pipeline(outputs, dict(DATASET_PARAMS, **(params or {})), workers=1, incremental=incremental)
+    finally:
+        storage.OUTPUT_FOLDER = output_folder
+
+
+@pytest.fixture(scope='session')
+def dataset_folder(tmp_path_factory):
+    """
+    Output folder of the test dataset, built once for every test
+    """
+    folder = tmp_path_factory.mktemp('dataset')
+    run_pipeline(folder)
+
+    return str(folder)
+
+
+@pytest.fixture
+def output_folder(dataset_folder, monkeypatch):
+    """
+    Output folder of the test dataset, set as the output folder of the storage functions (not to be written)
+    """
+    monkeypatch.setattr(storage, 'OUTPUT_FOLDER', dataset_folder)
+
+    return dataset_folder
+
+
+@pytest.fixture
+def new_output_folder(dataset_folder, tmp_path, monkeypatch):
+    """
+    Empty output folder, set as the output folder of the storage functions
+    The faker value pools of the test dataset are copied to it, so new runs don't generate them again
+    """
+    folder = tmp_path / 'output'
+    shutil.copytree(os.path.join(dataset_folder, customer_registration.POOLS_FOLDER), folder / customer_registration.POOLS_FOLDER)
+    monkeypatch.setattr(storage, 'OUTPUT_FOLDER', str(folder))
+
+    return str(folder)
+
+
+@pytest.fixture
+def pipeline_runner():
+    """
+    Function running the pipeline on a folder with the dataset parameters (see run_pipeline)
+    """
+    return run_pipeline
+
+
+@pytest.fixture
+def dataset_params():
+    """
+    Parameters of the test dataset
+    """
+    return dict(DATASET_PARAMS)
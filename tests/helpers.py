@@ -0,0 +1,35 @@
+"""
+Helpers shared by the tests
+"""
+
+import pandas as pd
+
+
+def get_comparable_dataframe(df, keys):
+    """
+    Function to return a dataframe with plain columns (categories as strings, integers as int64) sorted by its keys,
+    so dataframes built in different ways can be compared row by row
+    @param df <pandas DataFrame>: dataframe to be compared
+    @param keys <list>: columns identifying each row
+    """
+    df = df.copy()
+    for columnname in df.columns:
+        if isinstance(df[columnname].dtype, pd.CategoricalDtype) or pd.api.types.is_string_dtype(df[columnname]):
+            df[columnname] = df[columnname].astype(object).astype(str)
+        elif pd.api.types.is_integer_dtype(df[columnname]):
+            df[columnname] = df[columnname].astype('int64')
+
+    return df.sort_values(by=keys).reset_index(drop=True)
+
+
+def assert_same_rows(df, df_expected, keys):
+    """
+    Function to assert that two dataframes have the same columns and rows (in any order)
+    @param df <pandas DataFrame>: dataframe to be checked
+    @param df_expected <pandas DataFrame>: expected dataframe
+    @param keys <list>: columns identifying each row
+    """
+    assert sorted(df.columns) == sorted(df_expected.columns)
+    pd.testing.assert_frame_equal(
+        get_comparable_dataframe(df[df_expected.columns], keys), get_comparable_dataframe(df_expected, keys), check_dtype=False
+    )
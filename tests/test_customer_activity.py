@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+import storage
+import customer_activity
+from helpers import assert_same_rows
+
+
+# Columns identifying each activity row
+ACTIVITY_KEYS = ['id', 'transaction_month']
+
+
+def get_reference_activity_dataframe(df_transactions, now):
+    """
+    Function to return the activity rows as the original implementation computed them: every client joined with
+    every month from its first transaction until the current month, left joined with its transactions per month
+    @param df_transactions <pandas DataFrame>: dataframe from the customer_transactions.csv file
+    @param now <datetime>: current datetime
+    """
+    df_transactions = df_transactions.assign(transaction_month=df_transactions['transaction_datetime'].dt.strftime('%Y-%m-01'))
+    df_by_month = df_transactions.groupby(['id', 'transaction_month']).size().rename('num_of_transactions').reset_index()
+    df_months = pd.DataFrame({'month': pd.date_range(df_by_month['transaction_month'].min(), now, freq='MS').strftime('%Y-%m-01')})
+
+    df_client_months = pd.merge(df_by_month.groupby('id')['transaction_month'].min().reset_index(), df_months, how='cross')
+    df_client_months = df_client_months[df_client_months['month'] >= df_client_months['transaction_month']]
+    df_client_months = df_client_months[['id', 'month']].rename(columns={'month': 'transaction_month'})
+
+    df_churn = pd.merge(df_client_months, df_by_month, how='left', on=ACTIVITY_KEYS).sort_values(by=ACTIVITY_KEYS)
+    df_churn['num_of_transactions'] = df_churn['num_of_transactions'].fillna(0).astype(np.int64)
+    df_churn['num_of_transactions_prev'] = df_churn.groupby('id')['num_of_transactions'].shift(1).fillna(0).astype(np.int64)
+    df_churn['flag_new_active'] = np.where((df_churn['num_of_transactions'] > 0) & (df_churn['num_of_transactions_prev'] == 0), 1, 0)
+    df_churn['flag_churn'] = np.where((df_churn['num_of_transactions'] == 0) & (df_churn['num_of_transactions_prev'] > 0), 1, 0)
+
+    return df_churn
+
+
+@pytest.fixture
+def df_transactions(output_folder):
+    return storage.read_intermediate('customer_transactions', columns=['id', 'transaction_datetime'])
+
+
+def test_activity_matches_original_implementation(output_folder, df_transactions, dataset_params):
+    df_expected = get_reference_activity_dataframe(df_transactions, dataset_params['now'])
+
+    assert df_expected['flag_churn'].sum() > 0
+    assert_same_rows(storage.read_intermediate('customer_activity'), df_expected, ACTIVITY_KEYS)
+
+
+def test_sparse_activity_keeps_months_with_transactions_or_churn(df_transactions, dataset_params):
+    df_churn = customer_activity.get_customer_activity_dataframe(df_transactions, now=dataset_params['now'])
+    df_sparse = customer_activity.get_customer_activity_dataframe(df_transactions, sparse=True, now=dataset_params['now'])
+
+    assert_same_rows(df_sparse, df_churn[(df_churn['num_of_transactions'] > 0) | (df_churn['flag_churn'] == 1)], ACTIVITY_KEYS)
+
+
+def test_activity_from_a_month_keeps_the_previous_month_transactions(df_transactions, dataset_params):
+    df_churn = customer_activity.get_customer_activity_dataframe(df_transactions, now=dataset_params['now'])
+    df_recent = customer_activity.get_customer_activity_dataframe(df_transactions, '2024-02-01', now=dataset_params['now'])
+
+    assert_same_rows(df_recent, df_churn[df_churn['transaction_month'].astype(str) >= '2024-02-01'], ACTIVITY_KEYS)
+
+
+def test_activity_dtypes(df_transactions, dataset_params):
+    df_churn = customer_activity.get_customer_activity_dataframe(df_transactions, now=dataset_params['now'])
+
+    assert isinstance(df_churn['transaction_month'].dtype, pd.CategoricalDtype)
+    assert df_churn['num_of_transactions'].dtype == 'int32'
+    assert df_churn['flag_new_active'].dtype == 'int8'
+    assert df_churn['flag_churn'].dtype == 'int8'
+
+
+def test_activity_of_no_transactions_is_empty(df_transactions, dataset_params):
+    df_churn = customer_activity.get_customer_activity_dataframe(df_transactions.iloc[:0], now=dataset_params['now'])
+
+    assert len(df_churn) == 0
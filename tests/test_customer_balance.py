@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+import storage
+import customer_balance
+from helpers import assert_same_rows
+
+
+def get_reference_balance_dataframes(df_transactions, now):
+    """
+    Function to return the balance of every client and of every client and month with pandas groupby sums
+    and running sums over the months of each client
+    @param df_transactions <pandas DataFrame>: dataframe from the customer_transactions.csv file
+    @param now <datetime>: date the days since the last transaction are counted until
+    """
+    income = df_transactions['operation'].astype(str) == customer_balance.INCOME_OPERATION
+    df = df_transactions.assign(
+        signed_amount=np.where(income, df_transactions['amount'], -df_transactions['amount']),
+        revenue=np.where(income, df_transactions['amount'], 0.0),
+        transaction_month=df_transactions['transaction_datetime'].dt.strftime('%Y-%m-01'),
+    )
+
+    df_balance = df.groupby('id', as_index=False).agg(
+        first_transaction_datetime=('transaction_datetime', 'min'),
+        last_transaction_datetime=('transaction_datetime', 'max'),
+        num_of_transactions=('amount', 'size'),
+        balance=('signed_amount', 'sum'),
+        lifetime_value=('revenue', 'sum'),
+    )
+    df_balance['days_since_last_transaction'] = (pd.Timestamp(now).normalize() - df_balance['last_transaction_datetime'].dt.normalize()).dt.days
+
+    df_monthly = df.groupby(['id', 'transaction_month'], as_index=False).agg(
+        num_of_transactions=('amount', 'size'),
+        revenue=('revenue', 'sum'),
+        net_amount=('signed_amount', 'sum'),
+    )
+    df_monthly['balance'] = df_monthly.groupby('id')['net_amount'].cumsum()
+    df_monthly['lifetime_value'] = df_monthly.groupby('id')['revenue'].cumsum()
+
+    return df_balance, df_monthly
+
+
+@pytest.fixture
+def df_transactions(output_folder):
+    return storage.read_intermediate('customer_transactions', columns=customer_balance.TRANSACTION_COLUMNS)
+
+
+def test_balance_files_match_running_sums(output_folder, df_transactions, dataset_params):
+    df_balance, df_monthly = get_reference_balance_dataframes(df_transactions, dataset_params['now'])
+
+    assert_same_rows(storage.read_intermediate('customer_balance'), df_balance, ['id'])
+    assert_same_rows(storage.read_intermediate('customer_balance_monthly'), df_monthly, ['id', 'transaction_month'])
+
+
+def test_balances_subtract_other_operations_in_any_order(df_transactions, dataset_params):
+    # Every third transaction is a withdrawal, and transactions are no longer sorted by client and datetime
+    df_transactions = df_transactions.assign(operation=np.where(np.arange(len(df_transactions)) % 3 == 2, 'Withdrawal', customer_balance.INCOME_OPERATION))
+    df_transactions = df_transactions.sample(frac=1, random_state=0).reset_index(drop=True)
+    df_balance, df_monthly = customer_balance.get_balance_dataframes(df_transactions, dataset_params['now'])
+    df_balance_expected, df_monthly_expected = get_reference_balance_dataframes(df_transactions, dataset_params['now'])
+
+    assert (df_balance['balance'] < df_balance['lifetime_value']).any()
+    assert_same_rows(df_balance, df_balance_expected, ['id'])
+    assert_same_rows(df_monthly, df_monthly_expected, ['id', 'transaction_month'])
+
+
+def test_streamed_partitions_match_a_single_partition(df_transactions, dataset_params):
+    balance_chunks = list(customer_balance.iter_balance_chunks(dataset_params['now'], chunk_size=50, read_chunk_size=200))
+    df_balance, df_monthly = customer_balance.get_balance_dataframes(df_transactions, dataset_params['now'])
+
+    assert len(balance_chunks) > 1
+    assert_same_rows(pd.concat([df_balance_chunk for df_balance_chunk, df_monthly_chunk in balance_chunks]), df_balance, ['id'])
+    assert_same_rows(pd.concat([df_monthly_chunk for df_balance_chunk, df_monthly_chunk in balance_chunks]), df_monthly, ['id', 'transaction_month'])
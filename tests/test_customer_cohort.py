@@ -0,0 +1,162 @@
+import itertools
+import pandas as pd
+import pytest
+import storage
+import pipeline
+import customer_cohort
+from helpers import assert_same_rows
+
+
+# Columns identifying each cohort row
+COHORT_KEYS = ['status_datetime_from', 'status_datetime_to', 'status_from', 'status_to']
+
+# Funnel stages of the original implementation, in order
+STATUS_COLUMNS = [
+    ('account_registration_dt', 'Account registered'),
+    ('account_email_confirmation_dt', 'Email confirmed'),
+    ('client_registration_dt', 'Client registered'),
+    ('client_analysis_dt', 'Client analyzed (approved or denied)'),
+    ('client_initial_deposit_dt', 'Initial deposit'),
+]
+
+
+def get_reference_cohort_dataframe(df, now):
+    """
+    Function to return the cohort rows as the original implementation computed them: every date and status
+    combination, left joined with the number of clients per date from and date to
+    @param df <pandas DataFrame>: customer registration data (base file)
+    @param now <datetime>: end datetime of the cohort
+    """
+    df = df.assign(client_analysis_dt=df['client_approval_dt'].fillna(df['client_denial_dt']))
+    dates = pd.date_range(df['account_registration_dt'].min().normalize(), pd.Timestamp(now).normalize()).strftime('%Y-%m-%d')
+    df_dates = pd.merge(pd.DataFrame({'status_datetime_from': dates}), pd.DataFrame({'status_datetime_to': dates}), how='cross')
+    df_dates = df_dates[df_dates['status_datetime_from'] <= df_dates['status_datetime_to']]
+    df_dates['datetime_diff_days'] = (pd.to_datetime(df_dates['status_datetime_to']) - pd.to_datetime(df_dates['status_datetime_from'])).dt.days
+
+    objs = []
+    for (columnname_from, status_from), (columnname_to, status_to) in itertools.combinations(STATUS_COLUMNS, 2):
+        df_pair = pd.DataFrame({
+            'status_datetime_from': df[columnname_from].dt.strftime('%Y-%m-%d'),
+            'status_datetime_to': df[columnname_to].dt.strftime('%Y-%m-%d'),
+        })
+        df_pair = df_pair[df_pair['status_datetime_from'].notnull()]
+        df_counts = df_pair.groupby(['status_datetime_from', 'status_datetime_to']).size().rename('status_to_count').reset_index()
+        df_counts = df_counts.merge(df_pair.groupby('status_datetime_from').size().rename('status_from_count').reset_index(), on='status_datetime_from')
+        df_rows = df_dates.assign(status_from=status_from, status_to=status_to).merge(
+            df_counts, on=['status_datetime_from', 'status_datetime_to'], how='left'
+        )
+        objs.append(df_rows)
+
+    return pd.concat(objs=objs, ignore_index=True).fillna({'status_to_count': 0, 'status_from_count': 0})
+
+
+@pytest.fixture
+def df_funnel(output_folder):
+    return storage.read_intermediate('customer_funnel')
+
+
+def test_dense_cohort_matches_original_implementation(output_folder, dataset_params):
+    df_expected = get_reference_cohort_dataframe(storage.read_intermediate('customer_datasource'), dataset_params['now'])
+
+    assert_same_rows(storage.read_intermediate('customer_datasource_cohort'), df_expected, COHORT_KEYS)
+
+
+def test_sparse_cohort_keeps_the_observed_dense_rows(df_funnel, dataset_params):
+    df_dense = customer_cohort.get_customer_cohort_dataframe(df_funnel, now=dataset_params['now'])
+    df_sparse = customer_cohort.get_customer_cohort_dataframe(df_funnel, sparse=True, now=dataset_params['now'])
+
+    assert_same_rows(df_sparse, df_dense[df_dense['status_to_count'] > 0], COHORT_KEYS)
+
+
+@pytest.mark.parametrize('max_lag_days', [0, 7])
+def test_sparse_cohort_is_dense_inside_the_lag_window(df_funnel, dataset_params, max_lag_days):
+    df_dense = customer_cohort.get_customer_cohort_dataframe(df_funnel, now=dataset_params['now'])
+    df_sparse = customer_cohort.get_customer_cohort_dataframe(df_funnel, sparse=True, max_lag_days=max_lag_days, now=dataset_params['now'])
+
+    df_expected = df_dense[(df_dense['status_to_count'] > 0) | (df_dense['datetime_diff_days'] <= max_lag_days)]
+    assert_same_rows(df_sparse, df_expected, COHORT_KEYS)
+
+
+def test_denominators_are_the_status_from_counts(df_funnel, dataset_params):
+    df_dense = customer_cohort.get_customer_cohort_dataframe(df_funnel, now=dataset_params['now'])
+    df_denominators = customer_cohort.get_all_denominators_dataframe(df_funnel)
+
+    # Every status from has its population on the rows of its date from with clients converting
+    df_expected = df_dense[df_dense['status_from_count'] > 0].drop_duplicates(['status_datetime_from', 'status_from'])
+    df_expected = df_expected[['status_datetime_from', 'status_from', 'status_from_count']]
+    df_denominators = df_denominators.merge(df_expected.astype({'status_datetime_from': str, 'status_from': str}), on=['status_datetime_from', 'status_from'],
+                                            suffixes=('', '_expected'))
+    assert len(df_denominators)
+    assert (df_denominators['status_from_count'] == df_denominators['status_from_count_expected']).all()
+
+
+@pytest.mark.parametrize('max_lag_days, min_date_to', [(None, None), (10, None), (None, '2024-03-01'), (3, '2024-02-20')])
+def test_date_grid_has_every_date_combination(df_funnel, dataset_params, max_lag_days, min_date_to):
+    df_dates = customer_cohort.get_all_dates_dataframe(df_funnel, max_lag_days, min_date_to, dataset_params['now'])
+
+    dates = pd.date_range(df_funnel['account_registration_dt'].min().normalize(), pd.Timestamp(dataset_params['now']).normalize())
+    df_expected = pd.merge(pd.DataFrame({'date_x': dates}), pd.DataFrame({'date_y': dates}), how='cross')
+    df_expected['datetime_diff_days'] = (df_expected['date_y'] - df_expected['date_x']).dt.days
+    df_expected = df_expected[
+        (df_expected['datetime_diff_days'] >= 0)
+        & (df_expected['datetime_diff_days'] <= (max_lag_days if max_lag_days is not None else len(dates)))
+        & (df_expected['date_y'] >= pd.Timestamp(min_date_to or dates[0]))
+    ]
+    df_expected = df_expected.assign(date_x=df_expected['date_x'].dt.strftime('%Y-%m-%d'), date_y=df_expected['date_y'].dt.strftime('%Y-%m-%d'), id=1)
+
+    assert_same_rows(df_dates, df_expected, ['date_x', 'date_y'])
+
+
+@pytest.mark.parametrize('sparse, max_lag_days', [(False, None), (True, None), (True, 7)])
+@pytest.mark.parametrize('days_after', [0, 30])
+def test_cohort_dates_and_statuses_stay_categorical(df_funnel, dataset_params, sparse, max_lag_days, days_after):
+    # The lag window can end after the last date with clients (the run datetime is after every event)
+    now = dataset_params['now'] + pd.Timedelta(days=days_after)
+    df_cohort = customer_cohort.get_customer_cohort_dataframe(df_funnel, sparse, max_lag_days, now=now)
+
+    for columnname in COHORT_KEYS:
+        assert isinstance(df_cohort[columnname].dtype, pd.CategoricalDtype), columnname
+    for columnname in ['datetime_diff_days', 'status_to_count', 'status_from_count']:
+        assert df_cohort[columnname].dtype == 'int32', columnname
+
+
+def get_reference_conversion_dataframe(df_dense, df_denominators, max_lag_days, period):
+    """
+    Function to return the conversion table summing the dense cohort rows: clients reaching the status to within
+    each number of days, out of the clients reaching the status from, per date from (or first day of its period)
+    @param df_dense <pandas DataFrame>: dense cohort rows (every lag observed until the run datetime)
+    @param df_denominators <pandas DataFrame>: clients reaching each status per day
+    @param max_lag_days <int>: maximum number of days between date from and date to
+    @param period <string>: day, week or month
+    """
+    df = df_dense[df_dense['datetime_diff_days'] <= max_lag_days].astype({'status_datetime_from': str, 'status_from': str, 'status_to': str})
+    df = df.sort_values(by=['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'])
+    df['status_to_cumulative_count'] = df.groupby(['status_datetime_from', 'status_from', 'status_to'])['status_to_count'].cumsum()
+    df = df.drop(columns=['status_from_count']).merge(df_denominators, on=['status_datetime_from', 'status_from'])
+
+    dates = pd.to_datetime(df['status_datetime_from'])
+    if period == 'week':
+        dates = dates - pd.to_timedelta(dates.dt.weekday, unit='D')
+    elif period == 'month':
+        dates = dates.dt.to_period('M').dt.start_time
+    df['status_datetime_from'] = dates.dt.strftime('%Y-%m-%d')
+
+    return df.groupby(['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'], as_index=False)[
+        ['status_from_count', 'status_to_cumulative_count']
+    ].sum()
+
+
+@pytest.mark.parametrize('period, name', [
+    ('day', 'customer_datasource_cohort_conversion'),
+    ('week', 'customer_datasource_cohort_conversion_weekly'),
+    ('month', 'customer_datasource_cohort_conversion_monthly'),
+])
+def test_conversion_tables_sum_the_cohort_rows(df_funnel, output_folder, dataset_params, period, name):
+    df_expected = get_reference_conversion_dataframe(
+        storage.read_intermediate('customer_datasource_cohort'),
+        customer_cohort.get_all_denominators_dataframe(df_funnel),
+        pipeline.DEFAULT_PARAMS['cohort_conversion_max_lag_days'],
+        period
+    )
+
+    assert_same_rows(storage.read_intermediate(name), df_expected, ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'])
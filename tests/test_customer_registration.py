@@ -0,0 +1,50 @@
+import os
+import numpy as np
+import storage
+import customer_registration
+
+
+def get_small_pools():
+    """
+    Function to return value pools with only 18 names (3 first names and 2 last names)
+    """
+    return {
+        'first_name': np.array(['Ann', 'Bob', 'Eve'], dtype=object),
+        'last_name': np.array(['Lee', 'Smith'], dtype=object),
+        'address': np.array(['1 Main St'], dtype=object),
+        'name_multiplier': 5,
+        'name_offset': 4,
+    }
+
+
+def test_names_are_unique_beyond_the_number_of_names():
+    names = customer_registration.get_unique_names(np.arange(100), get_small_pools())
+
+    assert len(set(names)) == len(names)
+    # The first ids get every name of the pools once, then names get a numeric suffix
+    assert sorted(name.split(' ')[0] for name in names[:18]) == sorted(['Ann', 'Bob', 'Eve'] * 6)
+    assert all(len(name.split(' ')) == 3 for name in names[:18])
+    assert names[18].endswith(' 2') and names[99].endswith(' 6')
+
+
+def test_names_are_unique_across_batches(output_folder, dataset_params):
+    pools = customer_registration.get_faker_value_pools(seed=dataset_params['seed'])
+    names = np.concatenate([
+        customer_registration.get_unique_names(np.arange(start_id, start_id + 100000), pools)
+        for start_id in range(0, 1000000, 100000)
+    ])
+
+    assert len(set(names)) == len(names)
+    assert storage.read_intermediate('customer_datasource', columns=['name'])['name'].is_unique
+
+
+def test_cached_pools_are_reused(dataset_folder, new_output_folder, pipeline_runner, monkeypatch):
+    def create_faker_value_pools(*args, **kwargs):
+        raise AssertionError('faker value pools generated again')
+
+    monkeypatch.setattr(customer_registration, 'create_faker_value_pools', create_faker_value_pools)
+    pipeline_runner(new_output_folder, outputs=['customer_datasource'])
+
+    with open(os.path.join(dataset_folder, 'customer_datasource.csv'), 'rb') as expected_file, \
+            open(os.path.join(new_output_folder, 'customer_datasource.csv'), 'rb') as csv_file:
+        assert csv_file.read() == expected_file.read()
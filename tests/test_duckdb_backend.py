@@ -0,0 +1,33 @@
+import pandas as pd
+import pytest
+import storage
+import customer_cohort
+import customer_activity
+from helpers import assert_same_rows
+
+pytest.importorskip('duckdb')
+
+
+@pytest.mark.parametrize('sparse, max_lag_days, min_date_to', [
+    (False, None, None),
+    (False, None, '2024-03-01'),
+    (True, None, None),
+    (True, 7, None),
+    (True, 7, '2024-03-01'),
+])
+def test_duckdb_cohort_matches_numpy(output_folder, dataset_params, sparse, max_lag_days, min_date_to):
+    df_funnel = storage.read_intermediate('customer_funnel')
+    df_numpy = customer_cohort.get_customer_cohort_dataframe(df_funnel, sparse, max_lag_days, min_date_to, now=dataset_params['now'])
+    df_duckdb = customer_cohort.get_customer_cohort_dataframe(df_funnel, sparse, max_lag_days, min_date_to, 'duckdb', now=dataset_params['now'])
+
+    assert list(df_duckdb.dtypes) == list(df_numpy.dtypes)
+    assert_same_rows(df_duckdb, df_numpy, ['status_datetime_from', 'status_datetime_to', 'status_from', 'status_to'])
+
+
+@pytest.mark.parametrize('sparse, min_month', [(False, None), (True, None), (False, '2024-02-01')])
+def test_duckdb_activity_matches_numpy(output_folder, dataset_params, sparse, min_month):
+    df_transactions = storage.read_intermediate('customer_transactions', columns=['id', 'transaction_datetime'])
+    df_numpy = customer_activity.get_customer_activity_dataframe(df_transactions, min_month, sparse, now=dataset_params['now'])
+    df_duckdb = customer_activity.get_customer_activity_dataframe(df_transactions, min_month, sparse, 'duckdb', now=dataset_params['now'])
+
+    pd.testing.assert_frame_equal(df_duckdb, df_numpy)
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+import storage
+import event_replay
+
+
+# Number of events replayed by the tests
+MAX_EVENTS = 2000
+
+
+@pytest.fixture
+def df_events(output_folder):
+    """
+    First events of the test dataset
+    """
+    return event_replay.get_events_dataframe(MAX_EVENTS)
+
+
+def get_collecting_sink(sent, seconds=0.0):
+    """
+    Function to return a get_sink replacement sending batches to a list, waiting some seconds on each send
+    @param sent <list>: list where the (loop time, data) of each batch are added
+    @param seconds <float>: seconds each send takes (a slow sink)
+    """
+    async def get_sink(sink):
+        loop = asyncio.get_running_loop()
+
+        async def send(data):
+            await asyncio.sleep(seconds)
+            sent.append((loop.time(), data))
+
+        async def close():
+            pass
+
+        return send, close
+
+    return get_sink
+
+
+def replay(df_events, **kwargs):
+    """
+    Function to replay events, returning the replay counters and the seconds it took
+    @param df_events <pandas DataFrame>: events sorted by datetime
+    @param kwargs <dict>: arguments of replay_events
+    """
+    start = time.perf_counter()
+    stats = asyncio.run(event_replay.replay_events(df_events, **kwargs))
+
+    return stats, time.perf_counter() - start
+
+
+def test_events_are_sorted_by_datetime(df_events, dataset_params):
+    assert len(df_events) == MAX_EVENTS
+    assert df_events['ts'].is_monotonic_increasing
+    assert df_events['ts'].max() < dataset_params['now']
+    transactions = df_events['event'] == event_replay.TRANSACTION_EVENT
+    assert df_events.loc[transactions, 'amount'].notnull().all()
+    assert df_events.loc[~transactions, 'amount'].isnull().all()
+
+
+def test_rate_paces_the_events(df_events, monkeypatch):
+    sent = []
+    monkeypatch.setattr(event_replay, 'get_sink', get_collecting_sink(sent))
+    stats, seconds = replay(df_events.iloc[:500], rate=2000, batch_size=50)
+
+    assert stats['events'] == 500
+    # The last event is due after 499 / 2000 seconds
+    assert 0.24 <= seconds < 2
+    assert len(sent) > 500 / 50 / 2
+
+
+def test_speedup_keeps_the_original_pace(monkeypatch):
+    # 10 events a second apart, replayed 20 times faster
+    df = pd.DataFrame({'ts': pd.date_range('2024-01-01', periods=10, freq='s'), 'id': np.arange(10)})
+    sent = []
+    monkeypatch.setattr(event_replay, 'get_sink', get_collecting_sink(sent))
+    stats, seconds = replay(df, speedup=20, batch_size=1)
+
+    assert stats['events'] == 10
+    intervals = np.diff([sent_time for sent_time, data in sent])
+    assert 0.4 <= sent[-1][0] - sent[0][0] < 1
+    assert intervals.min() >= 0.04
+
+
+def test_slow_sinks_fill_the_queue_instead_of_memory(df_events, monkeypatch):
+    produced = []
+    get_batch_data = event_replay.get_batch_data
+
+    def get_batch_data_spy(df_batch):
+        produced.append(len(df_batch))
+        return get_batch_data(df_batch)
+
+    # Batches produced but not sent yet: the queue, the one being put and the one being sent
+    sent = []
+    unsent = []
+    get_sink = get_collecting_sink(sent, seconds=0.01)
+
+    async def get_sink_spy(sink):
+        send, close = await get_sink(sink)
+
+        async def send_spy(data):
+            unsent.append(len(produced) - len(sent))
+            await send(data)
+
+        return send_spy, close
+
+    monkeypatch.setattr(event_replay, 'get_batch_data', get_batch_data_spy)
+    monkeypatch.setattr(event_replay, 'get_sink', get_sink_spy)
+    stats, seconds = replay(df_events, batch_size=20, queue_size=3)
+
+    assert stats['events'] == len(df_events)
+    assert len(sent) == len(df_events) / 20
+    assert max(unsent) <= 3 + 2
+    assert b''.join(data for sent_time, data in sent) == get_batch_data(df_events)
+
+
+def get_free_port():
+    """
+    Function to return a local TCP port nobody is listening on
+    """
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        return free_socket.getsockname()[1]
+
+
+async def replay_to_receiver(df_events, sink):
+    """
+    Coroutine replaying events to the stand-in receiver of a sink, returning the replay and receiver counters
+    @param df_events <pandas DataFrame>: events sorted by datetime
+    @param sink <string>: unix:<path of the socket> or http://<host>:<port>/<path>
+    """
+    receiver_stats = event_replay.get_stats()
+    receiver = asyncio.create_task(event_replay.receive_events(sink, report_seconds=60, stats=receiver_stats))
+    try:
+        for attempt in range(100):
+            try:
+                stats = await event_replay.replay_events(df_events, sink, batch_size=100, report_seconds=60)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The receiver isn't listening yet
+                await asyncio.sleep(0.05)
+        # Everything sent is received once the receiver read the end of the stream
+        for attempt in range(100):
+            if receiver_stats['bytes'] == stats['bytes']:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        receiver.cancel()
+
+    return stats, receiver_stats
+
+
+@pytest.mark.parametrize('sink', ['unix', 'http'])
+def test_sinks_deliver_every_event_to_the_receiver(df_events, tmp_path, sink):
+    if sink == 'unix':
+        sink = 'unix:' + str(tmp_path / 'events.sock')
+    else:
+        sink = 'http://127.0.0.1:{}/events'.format(get_free_port())
+    stats, receiver_stats = asyncio.run(replay_to_receiver(df_events, sink))
+
+    assert stats['events'] == receiver_stats['events'] == len(df_events)
+    assert stats['bytes'] == receiver_stats['bytes'] == len(event_replay.get_batch_data(df_events))
+
+
+# Script replaying the first events of an output folder to stdout
+STDOUT_REPLAY_SCRIPT = """
+import asyncio, sys
+sys.path.insert(0, sys.argv[1])
+import storage, event_replay
+storage.OUTPUT_FOLDER = sys.argv[2]
+asyncio.run(event_replay.replay_events(event_replay.get_events_dataframe({}), 'stdout', batch_size=64, report_seconds=60))
+""".format(MAX_EVENTS)
+
+
+@pytest.mark.parametrize('redirect', ['pipe', 'file'])
+def test_stdout_sink_writes_every_event(df_events, tmp_path, redirect):
+    arguments = [sys.executable, '-c', STDOUT_REPLAY_SCRIPT, os.path.dirname(os.path.abspath(event_replay.__file__)), storage.OUTPUT_FOLDER]
+    if redirect == 'pipe':
+        stdout = subprocess.run(arguments, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    else:
+        with open(tmp_path / 'events.ndjson', 'wb') as events_file:
+            subprocess.run(arguments, stdout=events_file, stderr=subprocess.DEVNULL, check=True)
+        stdout = (tmp_path / 'events.ndjson').read_bytes()
+
+    assert stdout == event_replay.get_batch_data(df_events)
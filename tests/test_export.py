@@ -0,0 +1,42 @@
+import gzip
+import numpy as np
+import pandas as pd
+import pytest
+import export
+
+
+@pytest.fixture
+def df_export():
+    """
+    Dataframe with every kind of column written by the stages (text needing quotes, categories, missing values)
+    """
+    rows = 1000
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'amount': np.round(np.linspace(-50.5, 1000.25, rows), 2),
+        'name': ['Lee, Ann "{}"'.format(i) if i % 7 == 0 else 'Bob Smith {}'.format(i) for i in range(rows)],
+        'status': pd.Categorical(np.where(np.arange(rows) % 3 == 0, 'Client approved', 'Client denied')),
+        'transaction_datetime': pd.date_range('2024-01-01', periods=rows, freq='37min'),
+        'churn_datetime': pd.Series(pd.date_range('2024-02-01', periods=rows, freq='D')).where(np.arange(rows) % 5 == 0),
+    }, index=np.arange(rows) * 2)
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('chunk_size', [64, 1000, export.DEFAULT_CHUNK_SIZE])
+def test_csv_matches_pandas_without_index(tmp_path, df_export, chunk_size, workers, compression):
+    path = tmp_path / ('output' + export.get_csv_extension(compression))
+    assert export.write_csv(df_export, path, workers=workers, compression=compression, chunk_size=chunk_size) == len(df_export)
+
+    csv_bytes = path.read_bytes()
+    if compression == 'gzip':
+        csv_bytes = gzip.decompress(csv_bytes)
+    assert csv_bytes == df_export.to_csv(index=False).encode('utf-8')
+
+
+def test_appended_csv_rows_have_no_header(tmp_path, df_export):
+    path = tmp_path / 'output.csv'
+    export.write_csv(df_export.iloc[:300], path, chunk_size=64)
+    export.write_csv(df_export.iloc[300:], path, append=True, chunk_size=64)
+
+    assert path.read_bytes() == df_export.to_csv(index=False).encode('utf-8')
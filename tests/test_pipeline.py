@@ -0,0 +1,132 @@
+import functools
+import importlib.util
+import os
+import shutil
+from datetime import timedelta
+import pandas as pd
+import pytest
+import storage
+import export
+import pipeline
+import customer_registration
+from helpers import assert_same_rows
+
+
+# Every output with the columns identifying its rows (transactions have no key, so all their columns are compared)
+OUTPUTS = {
+    'customer_datasource': ['id'],
+    'customer_funnel': ['id'],
+    'customer_transactions': ['id', 'transaction_datetime', 'amount'],
+    'customer_datasource_cohort': ['status_datetime_from', 'status_datetime_to', 'status_from', 'status_to'],
+    'customer_datasource_cohort_denominators': ['status_datetime_from', 'status_from'],
+    'customer_datasource_cohort_conversion': ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'],
+    'customer_datasource_cohort_conversion_weekly': ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'],
+    'customer_datasource_cohort_conversion_monthly': ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days'],
+    'customer_datasource_acquisition_funnel': ['id', 'status'],
+    'customer_activity': ['id', 'transaction_month'],
+    'customer_balance': ['id'],
+    'customer_balance_monthly': ['id', 'transaction_month'],
+}
+
+# Outputs only written as intermediate files (not exported to csv)
+INTERNAL_OUTPUTS = ['customer_funnel']
+
+
+def read_outputs(folder, names, csv=False):
+    """
+    Function to return the intermediate files (or the exported csv files) of a folder by name
+    @param folder <string>: output folder
+    @param names <list>: names of the files
+    @param csv <bool>: if True, the exported csv files are read instead
+    """
+    output_folder = storage.OUTPUT_FOLDER
+    storage.OUTPUT_FOLDER = folder
+    try:
+        if csv:
+            return {name: pd.read_csv(storage.get_csv_path(name)) for name in names}
+        return {name: storage.read_intermediate(name) for name in names}
+    finally:
+        storage.OUTPUT_FOLDER = output_folder
+
+
+@pytest.mark.parametrize('days_before', [3, 40])
+@pytest.mark.parametrize('params', [
+    {},
+    {'cohort_sparse': True, 'cohort_max_lag_days': 7, 'activity_sparse': True, 'export_compression': 'gzip'},
+    {'chunk_size': 500},
+    pytest.param({'backend': 'duckdb'}, marks=pytest.mark.skipif(importlib.util.find_spec('duckdb') is None, reason="duckdb is not installed")),
+])
+def test_incremental_refresh_matches_a_full_recompute(new_output_folder, tmp_path, pipeline_runner, dataset_params, params, days_before):
+    pipeline_runner(new_output_folder, dict(params, now=dataset_params['now'] - timedelta(days=days_before)))
+    number_of_customers = len(storage.read_intermediate('customer_datasource', columns=['id']))
+    pipeline_runner(new_output_folder, params, incremental=True)
+    watermark = storage.read_watermark()
+    assert watermark['last_datetime'] == dataset_params['now']
+    assert len(storage.read_intermediate('customer_datasource', columns=['id'])) > number_of_customers
+
+    # The same dataset (same seed and registration start) generated from scratch until the same datetime
+    full_folder = str(tmp_path / 'full')
+    shutil.copytree(os.path.join(new_output_folder, customer_registration.POOLS_FOLDER), os.path.join(full_folder, customer_registration.POOLS_FOLDER))
+    pipeline_runner(full_folder, dict(params, start=watermark['dataset']['start']))
+
+    names = [name for name in OUTPUTS if name != 'customer_datasource_cohort_denominators' or params.get('cohort_sparse')]
+    incremental_outputs = read_outputs(new_output_folder, names)
+    full_outputs = read_outputs(full_folder, names)
+    for name in names:
+        assert_same_rows(incremental_outputs[name], full_outputs[name], OUTPUTS[name])
+
+    # The csv files keep the previous partitions and replace the rest
+    exported_names = [name for name in names if name not in INTERNAL_OUTPUTS]
+    incremental_outputs = read_outputs(new_output_folder, exported_names, csv=True)
+    full_outputs = read_outputs(full_folder, exported_names, csv=True)
+    for name in exported_names:
+        assert_same_rows(incremental_outputs[name], full_outputs[name], OUTPUTS[name])
+
+
+def test_seeded_runs_build_the_same_files(dataset_folder, new_output_folder, pipeline_runner):
+    pipeline_runner(new_output_folder)
+
+    filenames = sorted(filename for filename in os.listdir(dataset_folder) if filename.endswith('.csv'))
+    assert filenames
+    for filename in filenames:
+        with open(os.path.join(dataset_folder, filename), 'rb') as expected_file, open(os.path.join(new_output_folder, filename), 'rb') as csv_file:
+            assert csv_file.read() == expected_file.read(), filename
+
+
+@pytest.mark.parametrize('params', [{}, {'chunk_size': 500, 'export_compression': 'gzip'}])
+def test_worker_processes_build_the_same_files(dataset_folder, tmp_path, pipeline_runner, monkeypatch, params):
+    # Small csv chunks, so the exports are split between the workers too
+    monkeypatch.setattr(export, 'write_csv', functools.partial(export.write_csv, chunk_size=1000))
+
+    csv_files = {}
+    for workers in [1, 3]:
+        folder = tmp_path / 'workers{}'.format(workers)
+        shutil.copytree(os.path.join(dataset_folder, customer_registration.POOLS_FOLDER), folder / customer_registration.POOLS_FOLDER)
+        pipeline_runner(folder, dict(params, generation_workers=workers, export_workers=workers))
+        csv_files[workers] = {
+            filename: (folder / filename).read_bytes() for filename in sorted(os.listdir(folder)) if '.csv' in filename
+        }
+
+    assert csv_files[1]
+    assert csv_files[3] == csv_files[1]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_stages_that_can_never_run_raise(new_output_folder, dataset_params, monkeypatch, workers):
+    # Two stages waiting on each other's outputs
+    stages = {
+        'stage_a': {'inputs': ['output_b'], 'outputs': ['output_a'], 'appended_outputs': [], 'streamed_inputs': []},
+        'stage_b': {'inputs': ['output_a'], 'outputs': ['output_b'], 'appended_outputs': [], 'streamed_inputs': []},
+    }
+    monkeypatch.setattr(pipeline, 'get_stage_declarations', lambda: stages)
+
+    with pytest.raises(ValueError, match=r'stage_a \(missing output_b\); stage_b \(missing output_a\)'):
+        pipeline.run_pipeline(params=dataset_params, workers=workers)
+
+
+@pytest.mark.parametrize('params', [{'number_of_customers': 0}, {'months_back': 0}])
+def test_empty_datasets_are_rejected(new_output_folder, pipeline_runner, params):
+    with pytest.raises(ValueError, match='must be'):
+        pipeline_runner(new_output_folder, params)
+
+    assert not [filename for filename in os.listdir(new_output_folder) if filename.endswith('.csv')]
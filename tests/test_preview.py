@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import pytest
+import storage
+import customer_cohort
+import customer_activity
+import preview
+
+
+# Columns identifying each row of the conversion and activity tables
+CONVERSION_KEYS = ['status_datetime_from', 'status_from', 'status_to', 'datetime_diff_days']
+ACTIVITY_KEYS = ['transaction_month']
+
+# Figures of the conversion and activity tables
+CONVERSION_FIGURES = ['status_from_count', 'status_to_cumulative_count']
+ACTIVITY_FIGURES = ['active_clients', 'new_active_clients', 'churned_clients']
+
+
+def get_preview(rate, min_per_stratum, seed, now, max_lag_days=30):
+    """
+    Function to return the estimated conversion (monthly) and activity tables of a sample of the output folder customers
+    @param rate <float>: sampling rate of the customers
+    @param min_per_stratum <int>: minimum expected number of sampled customers on each stratum
+    @param seed <int>: seed of the hash sampling the customers
+    @param now <datetime>: current datetime
+    @param max_lag_days <int>: maximum number of days between date from and date to
+    """
+    strata_sizes = preview.get_strata_sizes()
+    sampling_rates = preview.get_sampling_rates(strata_sizes, rate, min_per_stratum)
+    df_sample = preview.get_customer_sample(sampling_rates, seed)
+    df_strata = preview.get_strata_dataframe(strata_sizes, sampling_rates, df_sample)
+
+    return (
+        preview.get_conversion_estimates(df_sample, df_strata, max_lag_days, 'month', now),
+        preview.get_activity_estimates(df_sample, preview.get_sampled_transactions(df_sample), df_strata, now),
+    )
+
+
+@pytest.fixture
+def exact_tables(output_folder, dataset_params):
+    """
+    Exact conversion (monthly) and activity tables of the output folder customers
+    """
+    df = storage.read_intermediate('customer_datasource', columns=preview.CUSTOMER_COLUMNS)
+    conversions = customer_cohort.get_cumulative_conversions(customer_cohort.add_client_analysis_dt(df), 30, dataset_params['now'])
+    df_transactions = storage.read_intermediate('customer_transactions', columns=['id', 'transaction_datetime'])
+
+    return (
+        customer_cohort.get_conversion_dataframe(conversions, 'month'),
+        preview.get_activity_totals(customer_activity.get_customer_activity_dataframe(df_transactions, now=dataset_params['now'])),
+    )
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_intervals_cover_the_exact_figures(exact_tables, dataset_params, seed):
+    df_conversion, df_activity = get_preview(0.2, 20, seed, dataset_params['now'])
+    df_conversion_exact, df_activity_exact = exact_tables
+
+    coverage = preview.get_coverage(df_conversion, df_conversion_exact, CONVERSION_KEYS, CONVERSION_FIGURES)
+    coverage.update(preview.get_coverage(df_activity, df_activity_exact, ACTIVITY_KEYS, ACTIVITY_FIGURES))
+    for columnname, figure in coverage.items():
+        assert figure['rows'] > 0, columnname
+        assert figure['coverage'] >= 0.9, columnname
+
+
+def test_intervals_narrow_with_the_sampling_rate(output_folder, dataset_params):
+    # Without a variance floor, the relative width of the large figures only depends on the customers sampled
+    relative_errors = []
+    for rate in [0.1, 0.3, 0.6]:
+        df_conversion, df_activity = get_preview(rate, 0, 0, dataset_params['now'])
+        large = df_conversion['status_from_count'] >= 100
+        relative_errors.append((df_conversion.loc[large, 'status_from_count_error'] / df_conversion.loc[large, 'status_from_count']).median())
+
+    assert relative_errors == sorted(relative_errors, reverse=True)
+    assert relative_errors[-1] < 0.2
+
+
+def test_fully_sampled_figures_are_exact(exact_tables, dataset_params):
+    df_conversion, df_activity = get_preview(1.0, 0, 0, dataset_params['now'])
+    df_conversion_exact, df_activity_exact = exact_tables
+
+    for df_estimates, df_exact, keys, columnnames in [
+        (df_conversion, df_conversion_exact, CONVERSION_KEYS, CONVERSION_FIGURES),
+        (df_activity, df_activity_exact, ACTIVITY_KEYS, ACTIVITY_FIGURES),
+    ]:
+        df = df_exact.astype({key: str for key in keys}).merge(df_estimates.astype({key: str for key in keys}), on=keys, suffixes=('_exact', ''))
+        assert len(df) == len(df_exact)
+        for columnname in columnnames:
+            np.testing.assert_allclose(df[columnname], df[columnname + '_exact'])
+            assert (df_estimates[columnname + '_error'] == 0).all()
+
+
+def test_figures_of_fully_sampled_strata_have_no_error(exact_tables, dataset_params):
+    # Small strata are fully sampled, so the figures only counting their customers are known exactly
+    df_conversion, df_activity = get_preview(0.1, 50, 0, dataset_params['now'])
+    df_conversion_exact, df_activity_exact = exact_tables
+
+    for df_estimates, df_exact, keys, columnnames in [
+        (df_conversion, df_conversion_exact, CONVERSION_KEYS, CONVERSION_FIGURES),
+        (df_activity, df_activity_exact, ACTIVITY_KEYS, ACTIVITY_FIGURES),
+    ]:
+        df = df_estimates.astype({key: str for key in keys}).merge(df_exact.astype({key: str for key in keys}), on=keys, how='left', suffixes=('', '_exact'))
+        for columnname in columnnames:
+            exact = df[columnname + '_error'] == 0
+            assert exact.any(), columnname
+            np.testing.assert_allclose(df.loc[exact, columnname], df.loc[exact, columnname + '_exact'].fillna(0))
+
+
+def test_zero_count_bound_grows_with_the_customers_not_sampled():
+    bounds = preview.get_zero_count_bound(np.array([0, 2, 1000, 1000]), np.array([1.0, 0.5, 0.5, 0.01]))
+
+    # Rule of three: about 3 / rate customers, up to the customers not sampled
+    np.testing.assert_allclose(bounds, [0, 2, np.log(20) / -np.log(0.5), np.log(20) / -np.log(0.99)])
+
+
+def test_empty_sample_only_has_zero_count_bounds(output_folder, dataset_params):
+    df_conversion, df_activity = get_preview(0.0, 0, 0, dataset_params['now'])
+
+    assert list(df_conversion.columns) == CONVERSION_KEYS + ['status_from_count', 'status_from_count_error', 'status_to_cumulative_count', 'status_to_cumulative_count_error']
+    assert len(df_conversion) and len(df_activity)
+    for df, columnnames in [(df_conversion, CONVERSION_FIGURES), (df_activity, ACTIVITY_FIGURES)]:
+        for columnname in columnnames:
+            assert (df[columnname] == 0).all()
+            assert (df[columnname + '_error'] >= 0).all()
+            assert (df[columnname + '_error'] > 0).any()
+
+
+def test_no_customers_give_empty_tables(output_folder, dataset_params):
+    strata_sizes = preview.get_strata_sizes().iloc[:0]
+    sampling_rates = preview.get_sampling_rates(strata_sizes)
+    df_sample = preview.get_customer_sample(sampling_rates).iloc[:0]
+    df_strata = preview.get_strata_dataframe(strata_sizes, sampling_rates, df_sample)
+
+    df_conversion = preview.get_conversion_estimates(df_sample, df_strata, 30, 'month', dataset_params['now'])
+    df_activity = preview.get_activity_estimates(df_sample, preview.get_sampled_transactions(df_sample), df_strata, dataset_params['now'])
+
+    assert len(df_conversion) == 0 and len(df_activity) == 0
+    assert list(df_conversion.columns) == CONVERSION_KEYS + ['status_from_count', 'status_from_count_error', 'status_to_cumulative_count', 'status_to_cumulative_count_error']
+    assert list(df_activity.columns) == ACTIVITY_KEYS + [columnname + suffix for columnname in ACTIVITY_FIGURES for suffix in ['', '_error']]
+    assert pd.api.types.is_integer_dtype(df_conversion['datetime_diff_days'])
@@ -0,0 +1,109 @@
+import os
+from datetime import timedelta
+import pytest
+import stage_cache
+
+
+@pytest.fixture
+def cache_lookups(monkeypatch):
+    """
+    Stages looked up on the cache by the pipeline, with True for hits and False for misses (in lookup order)
+    """
+    lookups = []
+    stage_names = {}
+    get_stage_key = stage_cache.get_stage_key
+    restore = stage_cache.restore
+
+    def get_stage_key_spy(stage_name, inputs, params, random=False):
+        key = get_stage_key(stage_name, inputs, params, random)
+        stage_names[key] = stage_name
+        return key
+
+    def restore_spy(key, outputs):
+        outputs = restore(key, outputs)
+        lookups.append((stage_names[key], outputs is not None))
+        return outputs
+
+    monkeypatch.setattr(stage_cache, 'get_stage_key', get_stage_key_spy)
+    monkeypatch.setattr(stage_cache, 'restore', restore_spy)
+
+    return lookups
+
+
+def read_csv_files(folder):
+    """
+    Function to return the bytes of the csv files of a folder by filename
+    @param folder <string>: output folder
+    """
+    csv_files = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith('.csv'):
+            with open(os.path.join(folder, filename), 'rb') as csv_file:
+                csv_files[filename] = csv_file.read()
+
+    return csv_files
+
+
+def test_unchanged_stages_are_restored(dataset_folder, new_output_folder, pipeline_runner, cache_lookups):
+    pipeline_runner(new_output_folder, {'cache': True})
+    assert cache_lookups and not any(hit for stage_name, hit in cache_lookups)
+
+    cache_lookups.clear()
+    pipeline_runner(new_output_folder, {'cache': True})
+    assert cache_lookups and all(hit for stage_name, hit in cache_lookups)
+    assert read_csv_files(new_output_folder) == read_csv_files(dataset_folder)
+
+
+@pytest.mark.parametrize('params, changed_stages', [
+    ({'cohort_conversion_max_lag_days': 7}, ['customer_cohort']),
+    ({'activity_sparse': True}, ['customer_activity']),
+    ({'number_of_customers': 2000}, ['customer_registration', 'customer_funnel', 'customer_cohort', 'customer_acquisition_funnel',
+                                     'customer_transactions', 'customer_activity', 'customer_balance']),
+])
+def test_changed_parameters_and_inputs_invalidate_their_stages(new_output_folder, pipeline_runner, cache_lookups, params, changed_stages):
+    pipeline_runner(new_output_folder, {'cache': True})
+
+    cache_lookups.clear()
+    pipeline_runner(new_output_folder, dict(params, cache=True))
+    assert sorted(stage_name for stage_name, hit in cache_lookups if not hit) == sorted(changed_stages)
+
+
+def test_random_stages_are_only_cached_with_a_seed(new_output_folder, pipeline_runner, cache_lookups):
+    pipeline_runner(new_output_folder, {'cache': True, 'seed': None})
+
+    stage_names = [stage_name for stage_name, hit in cache_lookups]
+    assert 'customer_registration' not in stage_names
+    assert 'customer_transactions' not in stage_names
+    assert 'customer_cohort' in stage_names
+
+
+def test_random_stages_are_keyed_on_the_exact_datetime(new_output_folder, pipeline_runner, cache_lookups, dataset_params):
+    pipeline_runner(new_output_folder, {'cache': True})
+
+    # Same run date, but an hour more of generated data
+    cache_lookups.clear()
+    pipeline_runner(new_output_folder, {'cache': True, 'now': dataset_params['now'] + timedelta(hours=1)})
+    missed_stages = [stage_name for stage_name, hit in cache_lookups if not hit]
+    assert 'customer_registration' in missed_stages
+    assert 'customer_transactions' in missed_stages
+
+
+def test_restored_outputs_replace_every_file_of_the_previous_run(dataset_folder, new_output_folder, pipeline_runner):
+    pipeline_runner(new_output_folder, {'cache': True})
+
+    # Denominators are only written in sparse mode, so the dense entry of the cohort stage doesn't have them
+    pipeline_runner(new_output_folder, {'cohort_sparse': True})
+    assert os.path.exists(os.path.join(new_output_folder, 'customer_datasource_cohort_denominators.csv'))
+
+    pipeline_runner(new_output_folder, {'cache': True})
+    assert not [filename for filename in os.listdir(new_output_folder) if filename.startswith('customer_datasource_cohort_denominators.')]
+    assert read_csv_files(new_output_folder) == read_csv_files(dataset_folder)
+
+
+def test_least_recently_used_entries_are_evicted(new_output_folder, pipeline_runner):
+    pipeline_runner(new_output_folder, {'cache': True, 'cache_max_mb': 0.5})
+
+    cache_path = os.path.join(new_output_folder, stage_cache.CACHE_FOLDER)
+    entry_paths = [entry.path for entry in os.scandir(cache_path) if entry.is_dir()]
+    assert entry_paths
+    assert sum(stage_cache.get_entry_size(entry_path) for entry_path in entry_paths) <= 0.5 * 1024 * 1024
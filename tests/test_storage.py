@@ -0,0 +1,75 @@
+import os
+import pandas as pd
+import pytest
+import storage
+import parallel
+import customer_registration
+import customer_transactions
+from helpers import assert_same_rows
+
+
+def get_generated_chunks(name, dataset_params, chunk_size):
+    """
+    Function to return the chunks of an output generated in streaming mode (customers or their transactions)
+    @param name <string>: customer_datasource or customer_transactions
+    @param dataset_params <dict>: parameters of the test dataset
+    @param chunk_size <int>: number of customers of each chunk
+    """
+    params = customer_registration.get_dataset_params(
+        dataset_params['number_of_customers'], dataset_params['months_back'], dataset_params['seed'],
+        parallel.get_seed_entropy(dataset_params['seed']), dataset_params['now']
+    )
+    chunks = list(customer_registration.iter_customer_registration_chunks(
+        params['number_of_customers'], params['months_back'], chunk_size, params['seed'], params['entropy'], params['start'], dataset_params['now']
+    ))
+    if name == 'customer_transactions':
+        df_chunks = (df[['id', 'client_initial_deposit_dt']] for df in chunks)
+        chunks = list(customer_transactions.iter_transactions_chunks(df_chunks, params['entropy'], dataset_params['now']))
+
+    return chunks
+
+
+def write_chunks(folder, name, chunks, streaming):
+    """
+    Function to write the chunks of an output to a folder, returning its intermediate dataframe and csv bytes
+    @param folder <pathlib Path>: output folder
+    @param name <string>: customer_datasource or customer_transactions
+    @param chunks <list>: dataframes to be written
+    @param streaming <bool>: if True, the chunks are written one at a time, else their concatenation is written at once
+    """
+    os.makedirs(folder)
+    output_folder = storage.OUTPUT_FOLDER
+    storage.OUTPUT_FOLDER = str(folder)
+    try:
+        # Same writes as the stages (streaming mode) and the pipeline (in memory mode)
+        if name == 'customer_datasource' and streaming:
+            storage.write_output_partitions(iter(chunks), name, 'account_registration_dt')
+        elif name == 'customer_datasource':
+            storage.write_partitioned_output(pd.concat(objs=chunks, ignore_index=True), name, 'account_registration_dt')
+        elif streaming:
+            storage.write_output_chunks(iter(chunks), name)
+        else:
+            storage.write_output(pd.concat(objs=chunks, ignore_index=True), name, intermediate=True)
+
+        with open(storage.get_csv_path(name), 'rb') as csv_file:
+            return storage.read_intermediate(name), csv_file.read()
+    finally:
+        storage.OUTPUT_FOLDER = output_folder
+
+
+@pytest.mark.parametrize('chunk_size', [500, 1700])
+@pytest.mark.parametrize('name, keys', [
+    ('customer_datasource', ['id']),
+    ('customer_transactions', ['id', 'transaction_datetime', 'amount']),
+])
+def test_streamed_chunks_write_the_same_rows_as_in_memory(new_output_folder, tmp_path, dataset_params, name, keys, chunk_size):
+    chunks = get_generated_chunks(name, dataset_params, chunk_size)
+    assert len(chunks) > 1
+
+    df_streamed, csv_streamed = write_chunks(tmp_path / 'streamed', name, chunks, streaming=True)
+    df_in_memory, csv_in_memory = write_chunks(tmp_path / 'in_memory', name, chunks, streaming=False)
+
+    assert len(df_streamed) == sum(len(df) for df in chunks)
+    # Streamed chunks keep their text columns as strings instead of categories (their categories change by chunk)
+    assert_same_rows(df_streamed, df_in_memory, keys)
+    assert csv_streamed == csv_in_memory